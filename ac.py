@@ -0,0 +1,606 @@
+"""
+Assetto Corsa UDP telemetry
+
+The handshake and RTCarInfo update packets, the asyncio listener that
+subscribes to a running instance of AC (or replays a capture of one), and
+the Recorder that logs its updates to lap files.
+Decoded updates are handed straight to the subscribed consumers on the
+event loop, so there is no thread or queue between the socket and the log.
+"""
+
+import asyncio
+import math
+import operator
+import socket
+import struct
+import os
+import time
+from datetime import datetime
+import numpy
+import lapfile
+import metrics
+from capture import areplay
+
+# operation ids for the 'iii' (identifier, version, operation) command packet
+HANDSHAKE = 0
+SUBSCRIBE_UPDATE = 1
+SUBSCRIBE_SPOT = 2
+DISMISS = 3
+
+class Handshake:
+    fmt = '<100s100sII100s100s'
+    size = struct.calcsize(fmt)
+
+    def __init__(self, t):
+        carName, driverName, self.identifier, self.version, trackName, trackConfig = t
+
+        self.carName, self.driverName, self.trackName, self.trackConfig = map(
+            lambda s: s.decode('utf-16', errors='ignore').split('%')[0] ,
+            [carName, driverName, trackName, trackConfig]
+        )
+
+    @classmethod
+    def fromData(cls, d):
+        return cls(struct.unpack(Handshake.fmt, d))
+        
+    def __str__(self):
+        return '{self.carName}, {self.driverName}, {self.trackName}, {self.trackConfig}'.format(self=self)
+
+
+update_types = {
+    'FLOAT': { 'struct': 'f', 'dtype': '<f4', 'log': 'f4', 'bytes': 4 },
+    'INT': { 'struct': 'i', 'dtype': '<i4', 'log': 'i4', 'bytes': 4 },
+    'UINT': { 'struct': 'I', 'dtype': '<u4', 'log': 'i4', 'bytes': 4 },
+    'BOOL': { 'struct': 'B', 'dtype': 'u1', 'log': 'u1', 'bytes': 1 },
+}
+
+# RTCarInfo, as (offset, count, type, name).  Fields of four are per wheel, and
+# are logged as one channel per wheel, e.g. slipRatio_FL.  Some of the names are
+# shortened from AC's to fit the lap file's 16 byte channel names
+update_layout = [
+    (8, 1, 'FLOAT', 'speed_Kmh'),
+    (12, 1, 'FLOAT', 'speed_Mph'),
+    (16, 1, 'FLOAT', 'speed_Ms'),
+    (20, 1, 'BOOL', 'isAbsEnabled'),
+    (21, 1, 'BOOL', 'isAbsInAction'),
+    (22, 1, 'BOOL', 'isTcInAction'),
+    (23, 1, 'BOOL', 'isTcEnabled'),
+    (24, 1, 'BOOL', 'isInPit'),
+    (25, 1, 'BOOL', 'limiterOn'),
+    (28, 1, 'FLOAT', 'accG_vertical'),
+    (32, 1, 'FLOAT', 'accG_horizontal'),
+    (36, 1, 'FLOAT', 'accG_frontal'),
+    (40, 1, 'UINT', 'lapTime'),
+    (44, 1, 'UINT', 'lastLap'),
+    (48, 1, 'UINT', 'bestLap'),
+    (52, 1, 'UINT', 'lapCount'),
+    (56, 1, 'FLOAT', 'gas'),
+    (60, 1, 'FLOAT', 'brake'),
+    (64, 1, 'FLOAT', 'clutch'),
+    (68, 1, 'FLOAT', 'engineRPM'),
+    (72, 1, 'FLOAT', 'steer'),
+    (76, 1, 'UINT', 'gear'),
+    (80, 1, 'FLOAT', 'cgHeight'),
+    (84, 4, 'FLOAT', 'wheelSpeed'),
+    (100, 4, 'FLOAT', 'slipAngle'),
+    (116, 4, 'FLOAT', 'slipAngleCP'),
+    (132, 4, 'FLOAT', 'slipRatio'),
+    (148, 4, 'FLOAT', 'tyreSlip'),
+    (164, 4, 'FLOAT', 'ndSlip'),
+    (180, 4, 'FLOAT', 'load'),
+    (196, 4, 'FLOAT', 'Dy'),
+    (212, 4, 'FLOAT', 'Mz'),
+    (228, 4, 'FLOAT', 'tyreDirt'),
+    (244, 4, 'FLOAT', 'camber'),
+    (260, 4, 'FLOAT', 'tyreRadius'),
+    (276, 4, 'FLOAT', 'loadedRadius'),
+    (292, 4, 'FLOAT', 'suspHeight'),
+    (308, 1, 'FLOAT', 'splinePosition'),
+    (312, 1, 'FLOAT', 'carSlope'),
+    (316, 1, 'FLOAT', 'x'),
+    (320, 1, 'FLOAT', 'y'),
+    (324, 1, 'FLOAT', 'z'),
+]
+
+UPDATE_SIZE = 328
+
+WHEELS = ['FL', 'FR', 'RL', 'RR']
+
+# sent in ms, decoded to seconds
+update_scale = { 'lapTime': 1000, 'lastLap': 1000, 'bestLap': 1000 }
+
+
+def expand(layout):
+    """ the layout as one (offset, type, name) per channel, with a channel per wheel """
+    channels = []
+    for start, count, t, name in layout:
+        if count == 1:
+            channels.append((start, t, name))
+        else:
+            size = update_types[t]['bytes']
+            channels.extend((start + i * size, t, name + '_' + wheel) for i, wheel in enumerate(WHEELS))
+    return channels
+
+
+update_channels = expand(update_layout)
+
+# the lap file type of every channel
+log_types = { name: 'f8' if name in update_scale else update_types[t]['log'] for _, t, name in update_channels }
+
+
+def channel_names(names):
+    """ the channels for a list of names, where the name of a per wheel field means all four wheels """
+    groups = { name: [name + '_' + wheel for wheel in WHEELS] for _, count, _, name in update_layout if count > 1 }
+    out = []
+    for name in names:
+        for channel in groups.get(name, [name]):
+            if channel not in out:
+                out.append(channel)
+    unknown = [name for name in out if name not in log_types]
+    if unknown:
+        raise ValueError('unknown AC channels: ' + ', '.join(unknown))
+    return out
+
+
+class Update:
+    """ a decoded update, with a slot per channel and the set() made by UpdateDecoder """
+
+    size = UPDATE_SIZE
+    unpacker = None
+    names = []
+
+    __slots__ = ()
+
+    def __init__(self, t=None):
+        if t is not None:
+            self.set(t)
+
+    @classmethod
+    def fromData(cls, d):
+        return cls(cls.unpacker.unpack(d))
+
+    def unpack_from(self, buf, offset=0):
+        """ decode a packet into this update, replacing its values """
+        self.set(self.unpacker.unpack_from(buf, offset))
+        return self
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __str__(self):
+        return ', '.join('{name}={value}'.format(name=name, value=getattr(self, name)) for name in self.names)
+
+    def coords(self):
+        return [self.x, self.y, self.z]
+
+    def distanceFrom(self, other):
+        return math.sqrt((other.x - self.x) ** 2 + (other.y - self.y) ** 2 + (other.z - self.z) ** 2)
+
+
+class UpdateDecoder:
+    """
+    compiles the RTCarInfo layout for a selection of channels into one struct.Struct,
+    a numpy dtype and an Update class to decode into
+
+    Only the channels in `names` are decoded (all of them by default), the rest of
+    the packet is skipped as padding.  The lap times are converted to seconds by the
+    Update, but left in ms by decode_many.
+
+    The Update keeps each channel in a slot, as the recorder reads several channels
+    of every update and slots are several times faster to read than properties.
+    """
+
+    def __init__(self, names=None):
+
+        names = None if names is None else channel_names(names)
+        fmt = ['<']
+        dt = { 'names': [], 'formats': [], 'offsets': [], 'itemsize': UPDATE_SIZE }
+        pos = 0
+
+        for start, t, name in sorted(update_channels):
+            if names is not None and name not in names:
+                continue
+
+            spec = update_types[t]
+            if start > pos:
+                fmt.append('{pad}x'.format(pad=start - pos))
+            fmt.append(spec['struct'])
+
+            dt['names'].append(name)
+            dt['formats'].append(spec['dtype'])
+            dt['offsets'].append(start)
+            pos = start + spec['bytes']
+
+        if pos < UPDATE_SIZE:
+            fmt.append('{pad}x'.format(pad=UPDATE_SIZE - pos))
+
+        self.names = dt['names']
+        self.struct = struct.Struct(''.join(fmt))
+        self.dtype = numpy.dtype(dt)
+
+        slots = self.names
+        scaled = [(n, update_scale[n]) for n in self.names if n in update_scale]
+
+        def set_values(self, t):
+            for name, value in zip(slots, t):
+                setattr(self, name, value)
+            for name, scale in scaled:
+                setattr(self, name, getattr(self, name) / scale)
+
+        self.Update = type('Update', (Update,), dict(__slots__=tuple(self.names), names=self.names,
+            unpacker=self.struct, set=set_values))
+
+    def decode(self, buf, offset=0):
+        """ decode a single update packet """
+        return self.Update(self.struct.unpack_from(buf, offset))
+
+    def decode_many(self, buf):
+        """ decode a contiguous buffer of update packets into a numpy structured array """
+        return numpy.frombuffer(buf, dtype=self.dtype)
+
+
+# what the loggers log by default
+LOG_CHANNELS = ['lapTime', 'speed_Mph', 'gas', 'brake', 'steer', 'gear', 'x', 'y', 'z']
+
+# the original fields, decoded when no channels are chosen
+DEFAULT_CHANNELS = ['speed_Kmh', 'speed_Mph', 'lapTime', 'lastLap', 'bestLap', 'lapCount',
+    'gas', 'brake', 'clutch', 'engineRPM', 'steer', 'gear', 'x', 'y', 'z']
+
+default_decoder = UpdateDecoder(DEFAULT_CHANNELS)
+
+
+async def wait_for(event, timeout):
+    """ wait up to timeout seconds for an asyncio.Event, returning whether it was set """
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+class ACSource:
+    """
+    decodes AC packets and passes each update to every subscriber.  The same Update
+    is decoded into for every packet, so subscribers must not keep it.  Only the
+    channels of the UpdateDecoder given (by default the original fields) are decoded
+    """
+
+    def __init__(self, decoder=None):
+        self.decoder = decoder or default_decoder
+        self.event = None
+        self.consumers = []
+        self.stopped = None
+        self.packets = 0
+        self.updates = 0
+        # datagrams neither an update nor the handshake, or updates before the handshake
+        self.dropped = 0
+        self.update = self.decoder.Update()
+        self.decode_time = metrics.histogram('ac_decode_seconds', 'time to decode an update') if metrics.timing else None
+
+    def subscribe(self, fn):
+        self.consumers.append(fn)
+
+    def dispatch(self, data, size=None):
+        """ decode the first size bytes of data (all of it by default) """
+        if size is None:
+            size = len(data)
+
+        self.packets = self.packets + 1
+        if size == UPDATE_SIZE:
+            if self.event:
+                self.updates = self.updates + 1
+                if self.decode_time:
+                    start = time.perf_counter()
+                    update = self.update.unpack_from(data)
+                    self.decode_time.observe(time.perf_counter() - start)
+                else:
+                    update = self.update.unpack_from(data)
+                for fn in self.consumers:
+                    fn(update)
+                return True
+
+            self.dropped = self.dropped + 1
+
+        elif size == Handshake.size:
+            if not self.event:
+                self.event = Handshake.fromData(bytes(data[:size]))
+
+        else:
+            self.dropped = self.dropped + 1
+
+        return False
+
+    def stop(self):
+        if self.stopped:
+            self.stopped.set()
+
+
+class ACListener(ACSource, asyncio.DatagramProtocol):
+    """
+    Where the event loop can watch the socket itself, every datagram waiting is read
+    into one reused buffer each time it is readable.  Otherwise (the Windows proactor
+    loop) asyncio receives them as a datagram protocol.
+    """
+
+    def __init__(self, addr = '127.0.0.1', port=9996, capture=None, retry=2.0, idle_timeout=10.0, decoder=None):
+        super(ACListener,self).__init__(decoder)
+        self.addr = addr
+        self.port = port
+        self.capture = capture
+        self.retry = retry
+        self.idle_timeout = idle_timeout
+        self.transport = None
+        self.sock = None
+        self.buffer = bytearray(4096)
+        self.connected = None
+        self.last_update = 0
+        self.batch = metrics.histogram('ac_receive_batch', 'datagrams read each time the socket is readable',
+            buckets=metrics.BATCH) if metrics.timing else None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.received(data, len(data))
+
+    def readable(self):
+        n = 0
+        while True:
+            try:
+                size = self.sock.recv_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # usually nothing listening yet, the handshake will be retried
+                break
+            n = n + 1
+            self.received(self.buffer, size)
+        if self.batch:
+            self.batch.observe(n)
+
+    def received(self, data, size):
+        if self.capture:
+            self.capture.write(bytes(data[:size]), (self.addr, self.port))
+
+        if self.dispatch(data, size):
+            self.last_update = self.loop.time()
+        elif self.event:
+            self.connected.set()
+
+    def error_received(self, exc):
+        # usually nothing listening yet, the handshake will be retried
+        pass
+
+    def send(self, operation):
+        data = struct.pack('iii',1,1,operation)
+        if self.transport:
+            self.transport.sendto(data)
+        else:
+            try:
+                self.sock.send(data)
+            except OSError:
+                pass
+
+    async def run(self):
+
+        self.loop = asyncio.get_running_loop()
+        self.connected = asyncio.Event()
+        self.stopped = asyncio.Event()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            sock.connect((self.addr, self.port))
+        except OSError:
+            sock.close()
+            raise
+        try:
+            self.loop.add_reader(sock.fileno(), self.readable)
+            self.sock = sock
+        except NotImplementedError:
+            await self.loop.create_datagram_endpoint(lambda: self, sock=sock)
+
+        try:
+            self.send(DISMISS)
+
+            while not self.event and not self.stopped.is_set():
+                print('sending handshake to {self.addr}:{self.port}'.format(self=self))
+                self.send(HANDSHAKE)
+                await wait_for(self.connected, self.retry)
+
+            if not self.event:
+                return
+
+            print('connected')
+            self.last_update = self.loop.time()
+            self.send(SUBSCRIBE_UPDATE)
+
+            # sleep until the idle deadline, pushed back by every update
+            while not self.stopped.is_set():
+                remaining = self.last_update + self.idle_timeout - self.loop.time()
+                if remaining <= 0:
+                    print('updates stopped')
+                    break
+                await wait_for(self.stopped, remaining)
+
+        finally:
+            self.send(DISMISS)
+            if self.transport:
+                self.transport.close()
+            else:
+                self.loop.remove_reader(sock.fileno())
+                sock.close()
+
+
+class ACReplay(ACSource):
+    """ feeds a capture file through the same decode as ACListener """
+
+    def __init__(self, fname, speed=1.0, decoder=None):
+        super(ACReplay,self).__init__(decoder)
+        self.fname = fname
+        self.speed = speed
+
+    async def run(self):
+
+        self.stopped = asyncio.Event()
+
+        async for data, addr in areplay(self.fname, self.speed):
+            if self.stopped.is_set():
+                break
+            self.dispatch(data)
+
+
+class Logger:
+
+    def __init__(self, logattr, event, writer, tsv=False, root='log'):
+        self.event = event
+        self.logattr = logattr
+        self.writer = writer
+        self.tsv = tsv
+        self.isodate = datetime.now().strftime('%Y%m%dT%H%M%S')
+        values = operator.attrgetter(*logattr)
+        # attrgetter of a single name returns the value itself, not a tuple of one
+        self.values = values if len(logattr) > 1 else lambda u: (values(u),)
+        self.f = None
+        self.rows = 0
+        self.lap_bytes = metrics.histogram('lap_bytes', 'size of each lap file', buckets=metrics.BYTES, game='ac')
+        self.write_time = metrics.histogram('ac_write_seconds', 'time to write a row') if metrics.timing else None
+        trackName = event.trackName
+        if(event.trackName != event.trackConfig):
+            trackName = trackName + '_' + event.trackConfig
+        self.path = os.path.join(root, trackName, self.event.carName, self.isodate + '_' + self.event.driverName)
+        self.path = self.path.replace(' ', '_')
+        os.makedirs(self.path, exist_ok=True)
+
+        # the names as sent by AC, since the path joins track and config
+        with open(os.path.join(self.path, 'session.txt'), mode='w') as sf:
+            sf.write('\t'.join(['track', 'config', 'car', 'driver']) + '\n')
+            sf.write('\t'.join([event.trackName, event.trackConfig, event.carName, event.driverName]) + '\n')
+
+        lapfn = os.path.join(self.path, 'laps.txt')
+        self.lf = open(lapfn, mode='w', buffering=1)
+        self.lf.write('\t'.join(['lap', 'time']) + '\n')
+        print('logging to: {path}'.format(path=self.path))
+
+
+    def newlap(self, update):
+        if self.f:
+            self.f.close()
+            self.lap_bytes.observe(self.f.bytes)
+
+        print('lap: {lapCount}, time: {lastLap}, writer: {status}'.format(
+            lapCount=update.lapCount, lastLap=update.lastLap, status=self.writer.status())
+        )
+        if update.lapCount > 0:
+            self.lf.write('\t'.join([str(update.lapCount), str(update.lastLap)]) + '\n')
+            self.lf.flush()
+
+        ext = '.txt' if self.tsv else lapfile.EXT
+        fname = os.path.join(self.path, 'lap_' +  str(update.lapCount + 1) + ext)
+
+        self.f = lapfile.create(fname.replace(' ', '_'), self.logattr, tsv=self.tsv, writer=self.writer,
+            types=log_types)
+        self.update(update)
+
+    def update(self, update):
+        if self.f:
+            if self.write_time:
+                start = time.perf_counter()
+                self.f.write(self.values(update))
+                self.write_time.observe(time.perf_counter() - start)
+            else:
+                self.f.write(self.values(update))
+            self.rows = self.rows + 1
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.lap_bytes.observe(self.f.bytes)
+            self.f = None
+        if self.lf:
+            self.lf.close()
+
+class Recorder:
+    """
+    splits the updates from an AC source into laps, logging a row every update_distance
+    meters, and keeping a livedelta.LapDelta up to date with every row if given one
+    """
+
+    # the channels the source must decode for the laps to be split and gated
+    required = ['lapTime', 'lastLap', 'lapCount', 'x', 'y', 'z']
+
+    def __init__(self, source, logattr, writer, tsv=False, update_distance=0.1, root='log', delta=None):
+        self.source = source
+        self.logattr = logattr
+        self.writer = writer
+        self.tsv = tsv
+        self.root = root
+        self.update_distance = update_distance
+        self.delta = delta
+        self.logger = None
+        # the values of the last update logged, as the updates themselves are reused
+        self.started = False
+        self.lapCount = 0
+        self.lapTime = 0.0
+        self.x = self.y = self.z = 0.0
+        self.gate_time = metrics.histogram('ac_gate_seconds', 'time to gate an update, including any row written') \
+            if metrics.timing else None
+
+    def logged(self, update):
+        self.started = True
+        self.lapCount = update.lapCount
+        self.lapTime = update.lapTime
+        self.x = update.x
+        self.y = update.y
+        self.z = update.z
+
+    def update(self, update):
+        if self.gate_time:
+            start = time.perf_counter()
+            self.gate(update)
+            self.gate_time.observe(time.perf_counter() - start)
+        else:
+            self.gate(update)
+
+    def gate(self, update):
+
+        if not self.logger:
+            self.logger = Logger(self.logattr, self.source.event, self.writer, tsv=self.tsv, root=self.root)
+
+        if not self.started:
+            self.logger.newlap(update)
+            if self.delta:
+                self.delta.newlap(update.lapTime)
+            self.logged(update)
+
+        elif self.lapCount > update.lapCount:
+            # must have re-started the event
+            # so get a new logger
+            self.logger.close()
+            self.logger = Logger(self.logattr, self.source.event, self.writer, tsv=self.tsv, root=self.root)
+            self.logger.newlap(update)
+            if self.delta:
+                self.delta.newlap(update.lapTime)
+            self.logged(update)
+
+        elif self.lapCount < update.lapCount or self.lapTime > (update.lapTime + 5):
+            self.logger.newlap(update)
+            if self.delta:
+                # only a lap that was driven over the line is complete
+                completed = update.lastLap if update.lapCount == self.lapCount + 1 else None
+                self.delta.newlap(update.lapTime, completed)
+            self.logged(update)
+
+        else:
+
+            delta = math.sqrt((update.x - self.x) ** 2 + (update.y - self.y) ** 2 + (update.z - self.z) ** 2)
+
+            if delta > self.update_distance:
+                self.logger.update(update)
+                if self.delta:
+                    self.delta.update(delta, update.lapTime)
+                self.logged(update)
+
+    def close(self):
+        if self.logger:
+            self.logger.close()
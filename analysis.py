@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+"""
+Sector and corner summaries of laps
+
+Corners are found in the resampled laps of plot.load_lap (one sample per
+meter) as the slowest point of `speed_Mph` within `window` meters either way,
+where the car slowed by at least `min_drop` mph and either braked on the way
+in or was turning.  For every corner the summary holds its minimum speed, the
+braking point (where the brake first went on after the previous corner) and
+the throttle pickup (where the throttle went back on after the lift into the
+corner), as distances into the lap.  Sectors are defined per track in a
+`sectors.txt` in the track's log directory, listing the distance each sector
+starts at, otherwise the lap is split into thirds.
+
+Each lap's summary is saved next to it as `lap_n.summary`, keyed by the lap
+file's mtime and size and the track's sectors, so ranking many laps only
+reads their summaries.  Laps in a session archive have theirs next to the
+archive, e.g. `20201112T215006_Driver.lap_2.summary`.
+
+    header:  magic 'RSTS', version (u16), sector definition count (u16),
+             lap file mtime (ns, i64) and size (i64), sectors (u16), corners (u16)
+    values:  f8 sector definition, lap time, length, then the sector arrays
+             and corner arrays, in the order of `sector_fields` and `corner_fields`
+
+    python analysis.py sectors log/imola 0 1600 3300
+    python analysis.py summary log/imola/ks_corvette_c7r/20201112T215006_Scott_Deakin/lap_2.txt
+    python analysis.py rank imola ks_corvette_c7r --sector 2
+    python analysis.py rank imola ks_corvette_c7r --corner 3
+"""
+
+import argparse
+import os
+import struct
+import tempfile
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+import archive
+import catalog
+import plot
+
+MAGIC = b'RSTS'
+VERSION = 1
+SUFFIX = '.summary'
+SECTORS = 'sectors.txt'
+
+header_struct = struct.Struct('<4sHHqqHH')
+sector_fields = ['sector_start', 'sector_time', 'sector_min_speed']
+corner_fields = ['corner_distance', 'corner_min_speed', 'corner_brake', 'corner_throttle']
+
+# detection thresholds, distances in meters
+WINDOW = 50
+APPROACH = 300
+MIN_DROP = 5.0
+STEER = 10.0
+BRAKE = 0.1
+THROTTLE = 0.1
+
+channels = ['distance', 'lapTime', 'speed_Mph', 'gas', 'brake', 'steer']
+
+
+def windows(a, before, after, rows):
+    """ the values of a from i - before to i + after for each i in rows, repeating the ends """
+    return sliding_window_view(numpy.pad(a, (before, after), mode='edge'), before + after + 1)[rows]
+
+
+def rising(mask):
+    """ the indices where mask turns True, including the first if it starts True """
+    return numpy.flatnonzero(mask & ~numpy.concatenate([[False], mask[:-1]]))
+
+
+def detect_corners(data, window=WINDOW, approach=APPROACH, min_drop=MIN_DROP, steer=STEER, brake=BRAKE):
+    """ the sample index of each corner's slowest point, in lap order """
+
+    speed = data['speed_Mph']
+    n = len(speed)
+    if n == 0:
+        return numpy.zeros(0, dtype=numpy.intp)
+
+    rows = numpy.arange(n)
+    apex = numpy.flatnonzero(speed == windows(speed, window, window, rows).min(axis=1))
+    # a run of equal speeds only counts once
+    apex = apex[numpy.diff(apex, prepend=-window - 1) > window]
+
+    drop = numpy.minimum(windows(speed, approach, 0, apex).max(axis=1),
+        windows(speed, 0, approach, apex).max(axis=1)) - speed[apex]
+    braked = windows(data['brake'], approach, 0, apex).max(axis=1) >= brake
+    turning = numpy.abs(windows(data['steer'], window, window, apex)).max(axis=1) >= steer
+
+    return apex[(drop >= min_drop) & (braked | turning)]
+
+
+def sector_starts(length, sectors=None):
+    """ the distance each sector starts at, thirds of the lap without a definition """
+    if not sectors:
+        return numpy.arange(3) * length / 3
+    return numpy.sort(numpy.asarray(sectors, dtype=float))
+
+
+def summarize(data, sectors=None, brake=BRAKE, throttle=THROTTLE):
+    """ the sector and corner summary of a resampled lap, as a dict of arrays """
+
+    missing = [c for c in channels if c not in data]
+    if missing:
+        raise ValueError('laps need the channels: ' + ', '.join(missing))
+
+    dist = data['distance']
+    n = len(dist)
+    length = float(dist[-1]) if n else 0.0
+
+    # sectors, from the lap time where each starts and ends
+    starts = sector_starts(length, sectors)
+    ends = numpy.append(starts[1:], length)
+    inside = starts < length
+    times = numpy.interp(ends, dist, data['lapTime']) - numpy.interp(starts, dist, data['lapTime'])
+    first = numpy.searchsorted(dist, starts[inside])
+    min_speed = numpy.full(len(starts), numpy.nan)
+    if len(first):
+        min_speed[inside] = numpy.minimum.reduceat(data['speed_Mph'], first)
+
+    # corners, each with the braking and throttle before it since the previous corner
+    apex = detect_corners(data, brake=brake)
+    previous = numpy.concatenate([[0], apex[:-1]])
+
+    on = numpy.append(rising(data['brake'] >= brake), n)
+    braking = on[numpy.searchsorted(on, previous, side='right')]
+    braking = numpy.where(braking <= apex, dist[numpy.minimum(braking, n - 1)], numpy.nan)
+
+    gas = data['gas'] >= throttle
+    lifts = numpy.concatenate([[-1], rising(~gas)])
+    pickups = numpy.append(rising(gas), n)
+    lift = lifts[numpy.searchsorted(lifts, apex, side='right') - 1]
+    pickup = pickups[numpy.searchsorted(pickups, lift, side='right')]
+    pickup = numpy.where((lift > previous) & (pickup < n), dist[numpy.minimum(pickup, n - 1)], numpy.nan)
+
+    return {
+        'lap_time': float(data['lapTime'][-1]) if n else numpy.nan,
+        'length': length,
+        'sector_start': starts,
+        'sector_time': numpy.where(inside, times, numpy.nan),
+        'sector_min_speed': min_speed,
+        'corner_distance': dist[apex],
+        'corner_min_speed': data['speed_Mph'][apex],
+        'corner_brake': braking,
+        'corner_throttle': pickup,
+    }
+
+
+def track_dir(lap):
+    """ the log directory of a lap's track, log/<track> for AC and log/gt7 for GT7 """
+    session = os.path.dirname(lap)
+    parent = os.path.dirname(session)
+    if os.path.basename(parent) == 'gt7':
+        return parent
+    return os.path.dirname(parent)
+
+
+def read_sectors(directory):
+    """ the sector start distances defined for a track directory, or None """
+    fname = os.path.join(directory, SECTORS)
+    if not os.path.exists(fname):
+        return None
+    return [float(r['start']) for r in catalog.read_tsv(fname)]
+
+
+def write_sectors(directory, starts):
+    with open(os.path.join(directory, SECTORS), 'w') as f:
+        f.write('\t'.join(['sector', 'start']) + '\n')
+        for i, start in enumerate(sorted(starts)):
+            f.write('\t'.join([str(i + 1), str(start)]) + '\n')
+
+
+def summary_path(lap):
+    """ the summary file next to a lap, or next to the archive holding it """
+    member = archive.split(lap)
+    if member:
+        fname, name = member
+        return os.path.splitext(fname)[0] + '.' + os.path.splitext(name)[0] + SUFFIX
+    return os.path.splitext(lap)[0] + SUFFIX
+
+
+def write_summary(fname, st, definition, summary):
+    """ write a summary to a temporary file then rename it, so concurrent readers never see a partial file """
+    header = header_struct.pack(MAGIC, VERSION, len(definition), st.st_mtime_ns, st.st_size,
+        len(summary['sector_start']), len(summary['corner_distance']))
+    values = numpy.concatenate([definition, [summary['lap_time'], summary['length']]]
+        + [summary[name] for name in sector_fields + corner_fields]).astype('<f8')
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(header + values.tobytes())
+    os.replace(tmp, fname)
+
+
+def read_summary(fname):
+    """ (lap mtime in ns, lap size, sector definition, summary) from a summary file """
+    with open(fname, 'rb') as f:
+        data = f.read()
+    magic, version, ndef, mtime, size, nsectors, ncorners = header_struct.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a lap summary, or an older one')
+
+    values = numpy.frombuffer(data, dtype='<f8', offset=header_struct.size)
+    summary = { 'lap_time': float(values[ndef]), 'length': float(values[ndef + 1]) }
+    pos = ndef + 2
+    for names, count in [(sector_fields, nsectors), (corner_fields, ncorners)]:
+        for name in names:
+            summary[name] = values[pos:pos + count]
+            pos = pos + count
+    return mtime, size, values[:ndef], summary
+
+
+def lap_summary(lap, sectors=None):
+    """
+    the summary of a lap, read from its summary file if neither the lap nor the
+    track's sectors have changed since it was written, otherwise summarized
+    again from the lap and saved
+    """
+
+    if sectors is None:
+        sectors = read_sectors(track_dir(lap))
+    st = archive.stat(lap)
+    definition = numpy.asarray(sectors or [], dtype=float)
+    fname = summary_path(lap)
+
+    try:
+        mtime, size, saved, summary = read_summary(fname)
+        if (mtime, size) == (st.st_mtime_ns, st.st_size) and numpy.array_equal(saved, definition):
+            return summary
+    except (OSError, ValueError, struct.error):
+        pass
+
+    summary = summarize(plot.load_lap(lap), sectors)
+    write_summary(fname, st, definition, summary)
+    return summary
+
+
+def match_corners(reference, distances, tolerance=2 * WINDOW):
+    """ for each reference corner distance, the index of the nearest corner in distances, or -1 if none is close """
+    if not len(distances):
+        return numpy.full(len(reference), -1)
+    gap = numpy.abs(numpy.subtract.outer(reference, distances))
+    nearest = gap.argmin(axis=1)
+    return numpy.where(gap[numpy.arange(len(reference)), nearest] <= tolerance, nearest, -1)
+
+
+def rank(con, track, car, sector=None, corner=None, config=None, driver=None):
+    """
+    the catalog's complete laps of a track and car with their summaries, fastest
+    first through the sector (1 based) or corner if given, else by lap time.
+    Corners are numbered by the fastest lap's, and matched to them by distance.
+    Returns (value, catalog row, summary) for each lap with a value
+    """
+
+    laps = catalog.fastest(con, track, car, limit=-1, config=config, driver=driver, complete=True)
+    summaries = [(r, lap_summary(r['path'])) for r in laps]
+    if not summaries:
+        return []
+
+    ranked = []
+    if corner is not None:
+        reference = summaries[0][1]['corner_distance']
+        if not 0 < corner <= len(reference):
+            raise ValueError('the fastest lap has {n} corners'.format(n=len(reference)))
+        for r, s in summaries:
+            i = match_corners(reference[corner - 1:corner], s['corner_distance'])[0]
+            if i >= 0:
+                # the fastest through a corner carries the most speed
+                ranked.append((float(s['corner_min_speed'][i]), r, s))
+        ranked.sort(key=lambda v: -v[0])
+        return ranked
+
+    for r, s in summaries:
+        value = s['sector_time'][sector - 1] if sector is not None else s['lap_time']
+        if not numpy.isnan(value):
+            ranked.append((float(value), r, s))
+    ranked.sort(key=lambda v: v[0])
+    return ranked
+
+
+def fmt(value, spec='{:.1f}'):
+    return '-' if numpy.isnan(value) else spec.format(value)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Sector and corner summaries of laps')
+    parser.add_argument('--db', default=catalog.DEFAULT_DB, help='catalog database')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('summary', help='show the summary of laps, summarizing any changed')
+    p.add_argument('laps', nargs='+')
+
+    p = commands.add_parser('rank', help='rank the catalog laps of a track and car by a sector or corner')
+    p.add_argument('track')
+    p.add_argument('car')
+    p.add_argument('--sector', type=int, help='sector number, from 1')
+    p.add_argument('--corner', type=int, help='corner number, from 1, as found in the fastest lap')
+    p.add_argument('--config')
+    p.add_argument('--driver')
+    p.add_argument('-n', type=int, default=10, help='number of laps')
+
+    p = commands.add_parser('sectors', help='define the sectors of a track')
+    p.add_argument('track_dir', help='the log directory of the track, e.g. log/imola')
+    p.add_argument('starts', nargs='*', type=float, help='distance each sector starts at, none to show them')
+
+    args = parser.parse_args()
+
+    if args.command == 'summary':
+        for lap in args.laps:
+            s = lap_summary(lap)
+            print('{lap}: {time:.3f}s, {length:.0f}m'.format(lap=lap, time=s['lap_time'], length=s['length']))
+            for i, (start, t, v) in enumerate(zip(s['sector_start'], s['sector_time'], s['sector_min_speed'])):
+                print('  sector {n}\t{start:.0f}m\t{t}s\tmin {v} mph'.format(n=i + 1, start=start, t=fmt(t, '{:.3f}'), v=fmt(v)))
+            for i, (d, v, b, t) in enumerate(zip(s['corner_distance'], s['corner_min_speed'], s['corner_brake'], s['corner_throttle'])):
+                print('  corner {n}\t{d:.0f}m\tmin {v} mph\tbrake {b}m\tthrottle {t}m'.format(
+                    n=i + 1, d=d, v=fmt(v), b=fmt(b, '{:.0f}'), t=fmt(t, '{:.0f}')))
+
+    elif args.command == 'rank':
+        if args.sector is not None and args.corner is not None:
+            parser.error('rank by either a sector or a corner')
+        try:
+            ranked = rank(catalog.connect(args.db), args.track, args.car, args.sector, args.corner, args.config, args.driver)
+        except ValueError as e:
+            parser.error(str(e))
+        for value, r, s in ranked[:args.n]:
+            print('\t'.join([fmt(value, '{:.3f}'), '{:.3f}'.format(s['lap_time']), r['driver'], str(r['lap']), r['path']]))
+
+    else:
+        if args.starts:
+            write_sectors(args.track_dir, args.starts)
+        print(read_sectors(args.track_dir))
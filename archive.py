@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+"""
+Session archives
+
+One file holding every lap of a session, and its laps.txt and session.txt,
+in place of a directory of small files.  Each lap is one compressed block,
+found through an index at the end of the file, so reading a lap seeks
+straight to its block and decompresses only that.
+
+Within a block every channel is stored as the integer bit pattern of its
+values, delta or delta-of-delta encoded (whichever packs smallest), with the
+bytes of each value split into planes, so slowly changing channels like x, y,
+z and lapTime become runs of near zero bytes for zlib or lzma.  The encoding
+is lossless: a lap reads back exactly as it was logged.  TSV laps are parsed
+with integer columns as i8 and the rest as f8, so they write back out as the
+same text, and any that would not are kept as their original text instead.
+Compacting checks every lap writes back byte for byte as its file before the
+session directory can be removed.
+
+    header:  magic 'RSTA', version (u16), reserved (u16)
+    blocks:  compressed laps and files, one after another
+    index:   one entry per member: name, offset, length, kind (file, lap or
+             text lap), codec, rows, last lapTime
+    trailer: index offset (u64), entry count (u32), magic 'RSTA'
+
+A lap inside an archive is addressed as if the archive were its directory,
+e.g. `log/imola/car/20201112T215006_Driver.rsta/lap_2.txt`, which plot.py and
+the catalog both read.
+
+    python archive.py compact log/imola --remove
+    python archive.py list log/imola/car/20201112T215006_Driver.rsta
+    python archive.py extract log/imola/car/20201112T215006_Driver.rsta lap_2.txt
+"""
+
+import argparse
+import lzma
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from collections import OrderedDict
+import numpy
+import lapfile
+
+MAGIC = b'RSTA'
+VERSION = 1
+EXT = '.rsta'
+
+header_struct = struct.Struct('<4sHH')
+entry_struct = struct.Struct('<64sQQBBId')
+trailer_struct = struct.Struct('<QI4s')
+rows_struct = struct.Struct('<II')
+column_struct = struct.Struct('<16s4sBB')
+
+# member kinds, TEXT being a TSV lap kept as its original text
+FILE, LAP, TEXT = range(3)
+
+codecs = {
+    'none': (0, lambda b: b, lambda b: b),
+    'zlib': (1, lambda b: zlib.compress(b, 9), zlib.decompress),
+    'lzma': (2, lambda b: lzma.compress(b, preset=6), lzma.decompress),
+}
+decompressors = { code: dec for code, _, dec in codecs.values() }
+
+
+def planes(u):
+    """ the bytes of every value, grouped by their position in the value """
+    return u.view(numpy.uint8).reshape(-1, u.dtype.itemsize).T.tobytes()
+
+
+def unplanes(data, dt, rows):
+    return numpy.frombuffer(data, dtype=numpy.uint8).reshape(dt.itemsize, rows).T.copy().view(dt).reshape(rows)
+
+
+def encode_column(values):
+    """ (order, bytes) of the smallest delta encoding of a column """
+    u = numpy.ascontiguousarray(values).view('<u{n}'.format(n=values.dtype.itemsize))
+    best = None
+    for order in range(3):
+        if order:
+            u = numpy.concatenate([u[:1], numpy.diff(u)])
+        data = planes(u)
+        size = len(zlib.compress(data, 1))
+        if best is None or size < best[0]:
+            best = (size, order, data)
+    return best[1], best[2]
+
+
+def decode_column(data, t, order, rows):
+    u = unplanes(data, numpy.dtype('<u{n}'.format(n=numpy.dtype(t).itemsize)), rows)
+    for _ in range(order):
+        u = numpy.cumsum(u, dtype=u.dtype)
+    return u.view('<' + t)
+
+
+def lap_columns(lap):
+    """ (name, type) of each channel of a lap, as in a lap file header """
+    return [(name, lap.dtype[name].str[1:]) for name in lap.dtype.names]
+
+
+def encode_lap(lap):
+    """ a lap (a lapfile structured array) as an uncompressed block """
+    cols = lap_columns(lap)
+    out = [rows_struct.pack(len(lap), len(cols))]
+    data = []
+    for name, t in cols:
+        order, encoded = encode_column(lap[name])
+        out.append(column_struct.pack(name.encode('ascii'), t.encode('ascii'), order, 0))
+        data.append(encoded)
+    return b''.join(out + data)
+
+
+def decode_lap(block):
+    rows, ncols = rows_struct.unpack_from(block)
+    pos = rows_struct.size
+    cols = []
+    for _ in range(ncols):
+        name, t, order, _ = column_struct.unpack_from(block, pos)
+        cols.append((name.rstrip(b'\0').decode('ascii'), t.rstrip(b'\0').decode('ascii'), order))
+        pos = pos + column_struct.size
+
+    lap = numpy.empty(rows, dtype=lapfile.dtype([(name, t) for name, t, _ in cols]))
+    for name, t, order in cols:
+        size = numpy.dtype(t).itemsize * rows
+        lap[name] = decode_column(block[pos:pos + size], t, order, rows)
+        pos = pos + size
+    return lap
+
+
+class ArchiveWriter:
+    """ writes an archive to a temporary file, replacing fname with it on close """
+
+    def __init__(self, fname, codec='zlib'):
+        self.fname = fname
+        self.code, self.compress, _ = codecs[codec]
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(fname) or '.', suffix='.tmp')
+        self.f = os.fdopen(fd, 'wb')
+        self.f.write(header_struct.pack(MAGIC, VERSION, 0))
+        self.entries = []
+
+    def add(self, name, kind, data, rows=0, last=float('nan')):
+        block = self.compress(data)
+        self.entries.append((name, self.f.tell(), len(block), kind, rows, last))
+        self.f.write(block)
+
+    def add_file(self, name, data):
+        self.add(name, FILE, data)
+
+    def add_lap(self, name, lap, text=None):
+        """ add a lap, as its TSV text if given rather than encoded """
+        last = float(lap['lapTime'][-1]) if len(lap) and 'lapTime' in lap.dtype.names else float('nan')
+        self.add(name, LAP if text is None else TEXT, encode_lap(lap) if text is None else text, len(lap), last)
+
+    def close(self):
+        offset = self.f.tell()
+        for name, pos, length, kind, rows, last in self.entries:
+            self.f.write(entry_struct.pack(name.encode(), pos, length, kind, self.code, rows, last))
+        self.f.write(trailer_struct.pack(offset, len(self.entries), MAGIC))
+        self.f.close()
+        os.replace(self.tmp, self.fname)
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp)
+
+
+class Entry:
+    """ an archive member, as listed in the index """
+
+    __slots__ = ('name', 'offset', 'length', 'kind', 'codec', 'rows', 'last')
+
+    def __init__(self, name, offset, length, kind, codec, rows, last):
+        self.name = name.rstrip(b'\0').decode()
+        self.offset, self.length, self.kind, self.codec, self.rows, self.last = offset, length, kind, codec, rows, last
+
+
+class Archive:
+    """ random access to the members of an archive """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.f = open(fname, 'rb')
+        try:
+            self.read_index()
+        except Exception:
+            self.f.close()
+            raise
+
+    def read_index(self):
+        magic, version, _ = header_struct.unpack(self.f.read(header_struct.size))
+        if magic != MAGIC:
+            raise ValueError('not a session archive')
+        if version != VERSION:
+            raise ValueError('unsupported session archive version: {version}'.format(version=version))
+
+        self.f.seek(-trailer_struct.size, os.SEEK_END)
+        offset, count, magic = trailer_struct.unpack(self.f.read(trailer_struct.size))
+        if magic != MAGIC:
+            raise ValueError('session archive has no index, it may be truncated')
+        self.f.seek(offset)
+        index = self.f.read(count * entry_struct.size)
+        self.members = OrderedDict()
+        for i in range(count):
+            entry = Entry(*entry_struct.unpack_from(index, i * entry_struct.size))
+            self.members[entry.name] = entry
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def laps(self):
+        return [e for e in self.members.values() if e.kind != FILE]
+
+    def read(self, name):
+        """ the decompressed block of a member """
+        entry = self.members.get(name)
+        if entry is None:
+            raise KeyError('{name} is not in {fname}'.format(name=name, fname=self.fname))
+        self.f.seek(entry.offset)
+        return decompressors[entry.codec](self.f.read(entry.length))
+
+    def read_lap(self, name):
+        block = self.read(name)
+        return parse_tsv(block) if self.members[name].kind == TEXT else decode_lap(block)
+
+
+def split(path):
+    """ (archive, member) for a path inside an archive, like session.rsta/lap_1.bin, else None """
+    head, member = os.path.split(path)
+    if head.endswith(EXT) and os.path.isfile(head):
+        return head, member
+    return None
+
+
+def stat(path):
+    """ os.stat of a file, or of the archive holding it """
+    member = split(path)
+    return os.stat(member[0] if member else path)
+
+
+def read_lap(path):
+    """ a lap inside an archive, as a lapfile structured array """
+    fname, member = split(path)
+    with Archive(fname) as a:
+        return a.read_lap(member)
+
+
+def parse_tsv(data):
+    """ the bytes of a TSV lap as a structured array, integer columns as i8 and the rest as f8 """
+    lines = data.decode().rstrip('\n').split('\n')
+    names = lines[0].split('\t')
+    cells = numpy.array([l.split('\t') for l in lines[1:]], dtype=str).reshape(-1, len(names))
+    cols = []
+    for i, name in enumerate(names):
+        integer = len(cells) and numpy.char.isdigit(numpy.char.lstrip(cells[:, i], '-')).all()
+        cols.append((name, 'i8' if integer else 'f8'))
+    lap = numpy.empty(len(cells), dtype=lapfile.dtype(cols))
+    for i, name in enumerate(names):
+        lap[name] = cells[:, i].astype(lap.dtype[name])
+    return lap
+
+
+def lap_bytes(name, lap):
+    """ a lap as the contents of a lap file, TSV if name ends in .txt """
+    if not name.endswith('.txt'):
+        return lapfile.pack_header(lap_columns(lap)) + lap.tobytes()
+    lines = ['\t'.join(lap.dtype.names)] + ['\t'.join(map(str, row)) for row in lap.tolist()]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def read_file(fname):
+    """
+    a lap file written by the loggers as (structured array, bytes), the bytes
+    being what the array must write back as, without any partial record an
+    interrupted logger left in a binary lap
+    """
+    with open(fname, 'rb') as f:
+        data = f.read()
+    if not data.startswith(lapfile.MAGIC):
+        return parse_tsv(data), data
+
+    lap = lapfile.read_lap(fname, mmap=False)
+    return lap, data[:lapfile.header_size(lap_columns(lap)) + lap.nbytes]
+
+
+def compact(path, codec='zlib', remove=False):
+    """
+    write a session directory to path.rsta, checking every lap writes back the
+    same as its file, and optionally remove the directory.  Returns the
+    archive's name
+    """
+    out = path.rstrip(os.sep) + EXT
+    fnames = sorted(os.listdir(path))
+    if any(os.path.isdir(os.path.join(path, fn)) for fn in fnames):
+        raise ValueError('{path} has sub-directories, it is not a session'.format(path=path))
+
+    w = ArchiveWriter(out, codec)
+    laps = {}
+    try:
+        for fn in fnames:
+            fname = os.path.join(path, fn)
+            # summaries are keyed by the lap file, so would be stale inside the archive
+            if fn.endswith('.tmp') or fn.endswith('.summary'):
+                continue
+            if lapfile.lap_re.match(fn):
+                lap, data = read_file(fname)
+                # a TSV lap that would not write back the same, e.g. with a column of both 1 and 1.5, is kept as text
+                w.add_lap(fn, lap, None if lap_bytes(fn, lap) == data else data)
+                laps[fn] = data
+            else:
+                with open(fname, 'rb') as f:
+                    w.add_file(fn, f.read())
+    except Exception:
+        w.abort()
+        raise
+    w.close()
+
+    with Archive(out) as a:
+        for fn, data in laps.items():
+            entry = a.members[fn]
+            if (a.read(fn) if entry.kind == TEXT else lap_bytes(fn, a.read_lap(fn))) != data:
+                raise ValueError('{fn} did not read back the same from {out}'.format(fn=fn, out=out))
+
+    if remove:
+        shutil.rmtree(path)
+    return out
+
+
+def session_dirs(root):
+    """ every directory under root (or root itself) holding lap files """
+    for path, dirs, files in os.walk(root):
+        if any(lapfile.lap_re.match(fn) for fn in files):
+            dirs[:] = []
+            yield path
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Session archives')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('compact', help='convert session directories into archives')
+    p.add_argument('paths', nargs='+', help='session directories, or directories of sessions')
+    p.add_argument('--codec', choices=list(codecs), default='zlib')
+    p.add_argument('--remove', action='store_true', help='remove each session directory once archived')
+
+    p = sub.add_parser('list', help='list the members of an archive')
+    p.add_argument('archive')
+
+    p = sub.add_parser('extract', help='write a member of an archive out as a file')
+    p.add_argument('archive')
+    p.add_argument('member')
+    p.add_argument('out', nargs='?', help='output filename, defaults to the member name')
+
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        for root in args.paths:
+            for path in session_dirs(root):
+                fnames = os.listdir(path)
+                size = sum(os.path.getsize(os.path.join(path, fn)) for fn in fnames)
+                out = compact(path, args.codec, args.remove)
+                print('{out}: {files} files, {size} bytes -> {asize} bytes'.format(
+                    out=out, files=len(fnames), size=size, asize=os.path.getsize(out)))
+
+    elif args.command == 'list':
+        with Archive(args.archive) as a:
+            for e in a.members.values():
+                print('{name}\t{length}\t{rows}\t{last}'.format(name=e.name, length=e.length,
+                    rows=e.rows if e.kind != FILE else '', last=e.last if e.kind != FILE else ''))
+
+    else:
+        out = args.out or args.member
+        with Archive(args.archive) as a:
+            if a.members[args.member].kind == LAP:
+                with open(out, 'wb') as f:
+                    f.write(lap_bytes(out, a.read_lap(args.member)))
+            else:
+                with open(out, 'wb') as f:
+                    f.write(a.read(args.member))
+        print(out)
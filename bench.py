@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the hot paths, against a history of earlier runs
+
+Every benchmark runs on synthetic data from the simulator's car: lap files of
+a chosen length and channel count, and AC updates and encrypted GT7 packets.
+Each one is timed `--repeat` times and the fastest time per lap, packet or
+row is kept.  The run is appended to a JSON history, and compared with the
+fastest time of each benchmark over the last `--window` runs with the same
+sizes, exiting with an error if any is slower by more than `--threshold`.
+
+    python bench.py
+    python bench.py load_lap_bin salsa20_dec --repeat 10
+    python bench.py --list
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+import numpy
+
+import ac
+import analysis
+import gt7
+import lapfile
+import plot
+import simulator
+from writer import BackgroundWriter
+
+logattr = ac.LOG_CHANNELS
+
+DEFAULT_HISTORY = 'bench-history.json'
+
+
+def synthetic_lap(rows, channels=len(logattr), rate=333, seed=0):
+    """
+    a lap of `rows` samples from the simulator's car at `rate` per second, as a
+    lapfile structured array with the logged channels and any more as noise
+    """
+    names = logattr + ['extra{n}'.format(n=n) for n in range(channels - len(logattr))]
+    lap = numpy.zeros(rows, dtype=lapfile.dtype(lapfile.columns(names)))
+    car = simulator.SyntheticCar(length=rows * 70.0 / rate, seed=seed)
+    values = []
+    for _ in range(rows):
+        car.update(1 / rate)
+        values.append((car.lapTime, car.speed() * 2.23694, car.gas, car.brake, car.steer, car.gear,
+            car.x, car.y, car.z))
+    values = numpy.array(values)
+    for i, name in enumerate(logattr):
+        lap[name] = values[:, i]
+    noise = numpy.random.default_rng(seed)
+    for name in names[len(logattr):]:
+        lap[name] = numpy.cumsum(noise.normal(size=rows))
+    return lap
+
+
+def write_lap(fname, lap, tsv=False):
+    with open(fname, 'wb') as f:
+        w = (lapfile.TsvWriter if tsv else lapfile.LapWriter)(f, list(lap.dtype.names))
+        for row in lap.tolist():
+            w.write(row)
+    return fname
+
+
+def ac_packets(n, rate=333, seed=0):
+    """ n AC updates from the simulator's car """
+    car = simulator.SyntheticCar(seed=seed)
+    packets = []
+    for _ in range(n):
+        car.update(1 / rate)
+        packets.append(simulator.ac_packet(car))
+    return packets
+
+
+def gt7_packets(n, rate=60, seed=0):
+    """ n encrypted GT7 packets from the simulator's car """
+    car = simulator.SyntheticCar(seed=seed)
+    packets = []
+    for tick in range(n):
+        car.update(1 / rate)
+        packets.append(simulator.gt7_packet(car, tick, rate, seed=seed + tick))
+    return packets
+
+
+class Workload:
+    """ the synthetic data, made once as the benchmarks first ask for it """
+
+    def __init__(self, args, directory):
+        self.args = args
+        self.directory = directory
+        self.cache = {}
+
+    def get(self, name, make):
+        if name not in self.cache:
+            self.cache[name] = make()
+        return self.cache[name]
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def lap_files(self, tsv=False):
+        ext = '.txt' if tsv else lapfile.EXT
+        return self.get('laps' + ext, lambda: [
+            write_lap(self.path('lap_{n}{ext}'.format(n=n, ext=ext)),
+                synthetic_lap(self.args.rows, self.args.channels, seed=n), tsv)
+            for n in range(2)])
+
+    def ac_packets(self):
+        return self.get('ac', lambda: ac_packets(self.args.packets))
+
+    def gt7_packets(self):
+        return self.get('gt7', lambda: gt7_packets(self.args.packets))
+
+    def gt7_decrypted(self):
+        return self.get('gt7_decrypted', lambda: [gt7.salsa20_dec(p) for p in self.gt7_packets()])
+
+
+benchmarks = OrderedDict()
+
+
+def benchmark(unit):
+    """
+    register a benchmark, a function of the Workload returning the function to
+    time and how many `unit`s each call processes
+    """
+    def register(fn):
+        benchmarks[fn.__name__] = (fn, unit)
+        return fn
+    return register
+
+
+@benchmark('lap')
+def load_lap_bin(w):
+    file = w.lap_files()[0]
+    return lambda: plot.load_lap(file), 1
+
+
+@benchmark('lap')
+def load_lap_tsv(w):
+    file = w.lap_files(tsv=True)[0]
+    return lambda: plot.load_lap(file), 1
+
+
+@benchmark('chart')
+def split_charts(w):
+    file1, file2 = w.lap_files()
+    out = w.path('split.html')
+    return lambda: plot.split_charts(file1, file2, output=out, browser=False), 1
+
+
+@benchmark('chart')
+def combined_charts(w):
+    file1, file2 = w.lap_files()
+    out = w.path('combined.html')
+    return lambda: plot.combined_charts(file1, file2, output=out, browser=False), 1
+
+
+@benchmark('lap')
+def summarize(w):
+    """ corner and sector summary, including load_lap """
+    file = w.lap_files()[0]
+    return lambda: analysis.summarize(plot.load_lap(file)), 1
+
+
+@benchmark('lap')
+def lap_summary_cached(w):
+    """ a summary read back from its file """
+    file = w.lap_files()[0]
+    analysis.lap_summary(file, sectors=[])
+    return lambda: analysis.lap_summary(file, sectors=[]), 1
+
+
+@benchmark('packet')
+def gt7_decode(w):
+    packets = w.gt7_decrypted()
+    decoder = gt7.PacketDecoder()
+
+    def run():
+        for p in packets:
+            decoder.decode(p)
+    return run, len(packets)
+
+
+@benchmark('packet')
+def salsa20_dec(w):
+    packets = w.gt7_packets()
+
+    def run():
+        for p in packets:
+            gt7.salsa20_dec(p)
+    return run, len(packets)
+
+
+@benchmark('packet')
+def salsa20_dec_many(w):
+    packets = w.gt7_packets()
+    return lambda: gt7.salsa20_dec_many(packets), len(packets)
+
+
+@benchmark('packet')
+def ac_fromdata_gate(w):
+    """ Update.fromData, keeping the updates at least 0.1m apart """
+    packets = w.ac_packets()
+
+    def run():
+        last = None
+        for p in packets:
+            update = ac.default_decoder.Update.fromData(p)
+            if last is None or update.distanceFrom(last) > 0.1:
+                last = update
+    return run, len(packets)
+
+
+def ac_logging(w, name):
+    """ an ACSource dispatching to a Recorder, logging under the workload's directory """
+    writer = BackgroundWriter()
+    writer.start()
+    source = ac.ACSource()
+    source.event = ac.Handshake.fromData(simulator.ac_handshake())
+    recorder = ac.Recorder(source, logattr, writer, root=w.path(name))
+    source.subscribe(recorder.update)
+    return writer, source, recorder
+
+
+@benchmark('packet')
+def ac_dispatch(w):
+    """ in place decode, gating and logging, as logger-ac.py runs """
+    packets = w.ac_packets()
+
+    def run():
+        writer, source, recorder = ac_logging(w, 'dispatch')
+        for p in packets:
+            source.dispatch(p)
+        recorder.close()
+        writer.close()
+    return run, len(packets)
+
+
+@benchmark('row')
+def logger_update(w):
+    packets = w.ac_packets()
+    updates = [ac.default_decoder.Update.fromData(p) for p in packets]
+
+    def run():
+        writer, source, recorder = ac_logging(w, 'logger')
+        recorder.update(updates[0])
+        logger = recorder.logger
+        for update in updates:
+            logger.update(update)
+        recorder.close()
+        writer.close()
+    return run, len(updates)
+
+
+def run_benchmark(name, w, repeat):
+    fn, unit = benchmarks[name]
+    run, count = fn(w)
+    times = []
+    # the loggers' progress is not wanted here
+    with contextlib.redirect_stdout(io.StringIO()):
+        # once to warm up, e.g. bokeh's first import of its templates
+        run()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append((time.perf_counter() - start) / count)
+    return { 'unit': unit, 'count': count, 'min': min(times), 'median': float(numpy.median(times)) }
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def read_history(fname):
+    if not os.path.exists(fname):
+        return []
+    with open(fname) as f:
+        return json.load(f)['runs']
+
+
+def write_history(fname, runs):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({ 'runs': runs }, f, indent=1)
+    os.replace(tmp, fname)
+
+
+def baseline(runs, config, window):
+    """ the fastest time of each benchmark over the last `window` runs of the same sizes """
+    best = {}
+    for run in [r for r in runs if r['config'] == config][-window:]:
+        for name, result in run['results'].items():
+            best[name] = min(best.get(name, result['min']), result['min'])
+    return best
+
+
+def format_time(seconds):
+    for scale, unit in [(1, 's'), (1e-3, 'ms'), (1e-6, 'us')]:
+        if seconds >= scale:
+            return '{t:.2f}{unit}'.format(t=seconds / scale, unit=unit)
+    return '{t:.0f}ns'.format(t=seconds / 1e-9)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths against earlier runs')
+    parser.add_argument('names', nargs='*', metavar='benchmark', help='benchmarks to run, all by default')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks')
+    parser.add_argument('--rows', type=int, default=20000, help='samples in each synthetic lap')
+    parser.add_argument('--channels', type=int, default=len(logattr),
+                help='channels in each synthetic lap, the logged ones then noise')
+    parser.add_argument('--packets', type=int, default=10000, help='AC and GT7 packets to decode')
+    parser.add_argument('--repeat', type=int, default=5, help='times to run each benchmark')
+    parser.add_argument('--history', default=DEFAULT_HISTORY, help='JSON history of the runs')
+    parser.add_argument('--window', type=int, default=5, help='earlier runs to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                help='fail if a benchmark is this fraction slower than its baseline')
+    parser.add_argument('--no-save', action='store_true', help='do not add this run to the history')
+
+    args = parser.parse_args()
+
+    if args.list:
+        for name, (fn, unit) in benchmarks.items():
+            print('{name}\tper {unit}'.format(name=name, unit=unit))
+        sys.exit(0)
+
+    unknown = [n for n in args.names if n not in benchmarks]
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(unknown))
+    if args.channels < len(logattr):
+        parser.error('at least {n} channels are needed'.format(n=len(logattr)))
+
+    config = { 'rows': args.rows, 'channels': args.channels, 'packets': args.packets }
+    runs = read_history(args.history)
+    best = baseline(runs, config, args.window)
+
+    directory = tempfile.mkdtemp(prefix='bench')
+    results = OrderedDict()
+    regressions = []
+    try:
+        w = Workload(args, directory)
+        for name in args.names or benchmarks:
+            result = results[name] = run_benchmark(name, w, args.repeat)
+            line = '{name:<20} {t:>10}/{unit}'.format(name=name, t=format_time(result['min']), unit=result['unit'])
+            if name in best:
+                change = result['min'] / best[name] - 1
+                line = line + '  {change:+.1%} against {t}'.format(change=change, t=format_time(best[name]))
+                if change > args.threshold:
+                    regressions.append(name)
+                    line = line + '  REGRESSION'
+            print(line, flush=True)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if not args.no_save:
+        runs.append({
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': commit(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'config': config,
+            'results': results,
+        })
+        write_history(args.history, runs)
+
+    if regressions:
+        print('{n} regressions beyond {threshold:.0%}: {names}'.format(
+            n=len(regressions), threshold=args.threshold, names=', '.join(regressions)))
+        sys.exit(1)
@@ -0,0 +1,102 @@
+"""
+Raw UDP capture files
+
+Every datagram a logger receives can be appended to a capture file, framed
+with its receive time and source address, so a session can be replayed
+through the same decode and logging path later, without a console attached.
+
+    header: magic 'RSTC', version (u16)
+    frame:  receive time (f8, epoch seconds), source ip (4 bytes),
+            source port (u16), length (u16), datagram
+"""
+
+import os
+import struct
+import socket
+import time
+import asyncio
+
+MAGIC = b'RSTC'
+VERSION = 1
+
+header_struct = struct.Struct('<4sH')
+frame_struct = struct.Struct('<d4sHH')
+
+
+class CaptureWriter:
+    """ append framed datagrams to a capture file, through a BackgroundWriter if given """
+
+    def __init__(self, fname, writer=None):
+        new = not os.path.exists(fname) or os.path.getsize(fname) == 0
+        if not new:
+            with open(fname, 'rb') as f:
+                read_header(f)
+
+        self.f = writer.open(fname, mode='ab') if writer else open(fname, mode='ab')
+        if new:
+            self.f.write(header_struct.pack(MAGIC, VERSION))
+
+    def write(self, data, addr, ts=None):
+        if ts is None:
+            ts = time.time()
+        self.f.write(frame_struct.pack(ts, socket.inet_aton(addr[0]), addr[1], len(data)) + data)
+
+    def close(self):
+        self.f.close()
+
+
+def read_header(f):
+    magic, version = header_struct.unpack(f.read(header_struct.size))
+    if magic != MAGIC:
+        raise ValueError('not a capture file')
+    if version != VERSION:
+        raise ValueError('unsupported capture file version: {version}'.format(version=version))
+
+
+def read_capture(fname):
+    """ yield (receive time, (ip, port), datagram) for every frame in the file """
+    with open(fname, 'rb') as f:
+        read_header(f)
+        while True:
+            head = f.read(frame_struct.size)
+            if len(head) < frame_struct.size:
+                break
+            ts, ip, port, size = frame_struct.unpack(head)
+            data = f.read(size)
+            if len(data) < size:
+                # truncated by an interrupted capture
+                break
+            yield ts, (socket.inet_ntoa(ip), port), data
+
+
+def replay(fname, speed=1.0):
+    """
+    yield (datagram, (ip, port)) like socket.recvfrom, paced to the original
+    receive times divided by `speed`, or as fast as possible if `speed` is 0
+    """
+    start = None
+    for ts, addr, data in read_capture(fname):
+        if speed > 0:
+            if start is None:
+                start = (ts, time.monotonic())
+            wait = start[1] + (ts - start[0]) / speed - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        yield data, addr
+
+
+async def areplay(fname, speed=1.0):
+    """ replay() for asyncio, pacing with the event loop instead of blocking it """
+    loop = asyncio.get_running_loop()
+    start = None
+    for n, (ts, addr, data) in enumerate(read_capture(fname)):
+        if speed > 0:
+            if start is None:
+                start = (ts, loop.time())
+            wait = start[1] + (ts - start[0]) / speed - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        elif n % 256 == 0:
+            # let anything else on the loop run
+            await asyncio.sleep(0)
+        yield data, addr
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+"""
+SQLite catalog of the sessions and laps in the log tree
+
+Indexes every session directory (AC `<track>/<car>/<isodate>_<driver>` and
+GT7 `gt7/<timestamp>`) or session archive (the same with `.rsta`) and every
+lap file in them, with the lap time, sample count and file mtime, so laps can
+be found without walking and parsing the tree.  Updates are incremental: only lap files whose size or mtime changed,
+or sessions whose laps.txt changed, are read again.
+
+A lap is complete if its session's laps.txt lists it.  GT7 sessions have no
+laps.txt, and the GT7 recorder starts a new lap file whenever the lap count
+changes, so a GT7 lap is complete when its session also has the laps before
+and after it, and its time is that of its last sample.
+
+    python catalog.py update
+    python catalog.py fastest imola ks_corvette_c7r -n 10
+
+Lap arguments to plot.py can also be catalog queries, e.g. `fastest:imola/ks_corvette_c7r`
+for the fastest lap or `fastest:imola/ks_corvette_c7r/3` for the third fastest.
+"""
+
+import argparse
+import os
+import sqlite3
+import struct
+import numpy
+import lapfile
+import archive
+
+DEFAULT_DB = os.path.join('log', 'catalog.db')
+
+schema = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    game TEXT,
+    track TEXT,
+    config TEXT,
+    car TEXT,
+    driver TEXT,
+    started TEXT,
+    laps_mtime REAL
+);
+CREATE TABLE IF NOT EXISTS laps (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    path TEXT UNIQUE NOT NULL,
+    lap INTEGER,
+    time REAL,
+    complete INTEGER,
+    samples INTEGER,
+    mtime REAL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS sessions_track_car ON sessions(track, car);
+CREATE INDEX IF NOT EXISTS laps_session ON laps(session);
+CREATE INDEX IF NOT EXISTS laps_time ON laps(time);
+"""
+
+
+def connect(db=DEFAULT_DB):
+    con = sqlite3.connect(db)
+    con.row_factory = sqlite3.Row
+    con.execute('PRAGMA foreign_keys = ON')
+    con.executescript(schema)
+    return con
+
+
+def parse_tsv(text):
+    """ rows of a small header + values TSV, as dicts """
+    lines = text.split('\n')
+    headers = lines[0].split('\t')
+    return [dict(zip(headers, l.split('\t'))) for l in lines[1:] if l.strip()]
+
+
+def read_tsv(fname):
+    with open(fname) as f:
+        return parse_tsv(f.read())
+
+
+def is_gt7(path):
+    """ whether a session directory or archive is one of GT7's, under gt7/ """
+    return os.path.basename(os.path.dirname(path)) == 'gt7'
+
+
+def gt7_complete(laps):
+    """ the numbers of the complete laps of a GT7 session, those with a lap either side """
+    numbers = set(lap for lap, _ in laps)
+    return set(n for n in numbers if n - 1 in numbers and n + 1 in numbers)
+
+
+def session_info(path, rows=None):
+    """
+    game, track, config, car, driver and start time for a session directory, or
+    an archive (named without its extension) given the rows of its session.txt
+    """
+    parent, name = os.path.split(path)
+    if is_gt7(path):
+        return { 'game': 'gt7', 'track': 'gt7', 'config': '', 'car': '', 'driver': '', 'started': name }
+
+    started, _, driver = name.partition('_')
+    parent, car = os.path.split(parent)
+    track = os.path.basename(parent)
+    info = { 'game': 'ac', 'track': track, 'config': '', 'car': car, 'driver': driver, 'started': started }
+
+    if rows is None:
+        sfn = os.path.join(path, 'session.txt')
+        rows = read_tsv(sfn) if os.path.exists(sfn) else []
+    if rows:
+        # named as in the paths, so old and new sessions match
+        info.update({ k: v.replace(' ', '_') for k, v in rows[0].items() })
+        if info['config'] == info['track']:
+            info['config'] = ''
+    return info
+
+
+def lap_stats(fname, size):
+    """ sample count and last lapTime of a lap file, reading only its header and tail """
+
+    if lapfile.is_lapfile(fname):
+        with open(fname, 'rb') as f:
+            cols = lapfile.read_header(f)
+            dt = lapfile.dtype(cols)
+            rows = (size - lapfile.header_size(cols)) // dt.itemsize
+            if rows <= 0 or 'lapTime' not in dt.names:
+                return max(rows, 0), None
+            f.seek(lapfile.header_size(cols) + (rows - 1) * dt.itemsize)
+            last = numpy.frombuffer(f.read(dt.itemsize), dtype=dt)
+            return rows, float(last['lapTime'][0])
+
+    with open(fname, 'rb') as f:
+        data = f.read().rstrip(b'\n')
+    headers = data[:data.find(b'\n')].decode().split('\t') if b'\n' in data else data.decode().split('\t')
+    rows = data.count(b'\n')
+    if rows <= 0 or 'lapTime' not in headers:
+        return rows, None
+    last = data[data.rfind(b'\n') + 1:]
+    return rows, float(last.split(b'\t')[headers.index('lapTime')])
+
+
+class SessionDir:
+    """ the laps of a session directory, for update() """
+
+    def __init__(self, path, files):
+        self.path = path
+        self.laps = []
+        for fn in files:
+            m = lapfile.lap_re.match(fn)
+            if m:
+                self.laps.append((int(m.group(1)), os.path.join(path, fn)))
+        self.lfn = os.path.join(path, 'laps.txt')
+        self.laps_mtime = os.stat(self.lfn).st_mtime if self.laps and os.path.exists(self.lfn) else None
+
+    def info(self):
+        return session_info(self.path)
+
+    def times(self):
+        return read_tsv(self.lfn)
+
+    def stat(self, fname):
+        return os.stat(fname)
+
+    def lap_stats(self, fname, st):
+        return lap_stats(fname, st.st_size)
+
+
+class SessionArchive:
+    """ the laps of a session archive, for update(), with their stats from its index """
+
+    def __init__(self, path):
+        self.path = path
+        self.st = os.stat(path)
+        with archive.Archive(path) as a:
+            self.members = a.members
+            self.laps = []
+            for e in a.laps():
+                m = lapfile.lap_re.match(e.name)
+                if m:
+                    self.laps.append((int(m.group(1)), os.path.join(path, e.name)))
+            self.session = a.read('session.txt').decode() if 'session.txt' in a.members else ''
+            self.laps_text = a.read('laps.txt').decode() if 'laps.txt' in a.members else None
+        # the laps.txt inside changes with the archive
+        self.laps_mtime = self.st.st_mtime if self.laps_text is not None else None
+
+    def info(self):
+        return session_info(self.path[:-len(archive.EXT)], parse_tsv(self.session) if self.session else [])
+
+    def times(self):
+        return parse_tsv(self.laps_text)
+
+    def stat(self, fname):
+        return self.st
+
+    def lap_stats(self, fname, st):
+        e = self.members[os.path.basename(fname)]
+        return e.rows, None if numpy.isnan(e.last) else e.last
+
+
+def update(con, root='log', verbose=False):
+    """ bring the catalog in line with the log tree, returning (added or changed, removed) lap counts """
+
+    known = { r['path']: (r['mtime'], r['size'], r['complete']) for r in con.execute('SELECT path, mtime, size, complete FROM laps') }
+    sessions = { r['path']: (r['id'], r['laps_mtime']) for r in con.execute('SELECT id, path, laps_mtime FROM sessions') }
+    seen = set()
+    changed = 0
+
+    found = []
+    for path, dirs, files in os.walk(root):
+        found.append(SessionDir(path, files))
+        for fn in files:
+            # an archive compacted without --remove is the same session as its directory, which is indexed instead
+            if not fn.endswith(archive.EXT) or fn[:-len(archive.EXT)] in dirs:
+                continue
+            try:
+                found.append(SessionArchive(os.path.join(path, fn)))
+            except (OSError, ValueError, struct.error) as e:
+                print('skipping {fn}: {e}'.format(fn=os.path.join(path, fn), e=e))
+
+    for source in found:
+        path, laps, laps_mtime = source.path, source.laps, source.laps_mtime
+        if not laps:
+            continue
+
+        if path in sessions:
+            session, old_laps_mtime = sessions[path]
+        else:
+            info = source.info()
+            session = con.execute(
+                'INSERT INTO sessions (path, game, track, config, car, driver, started) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, info['game'], info['track'], info['config'], info['car'], info['driver'], info['started'])
+            ).lastrowid
+            old_laps_mtime = None
+
+        times = {}
+        if laps_mtime is not None:
+            times = { int(r['lap']): float(r['time']) for r in source.times() }
+        # a GT7 lap becomes complete when the next one starts, without changing its file
+        gt7 = gt7_complete(laps) if laps_mtime is None and is_gt7(path) else set()
+        relap = laps_mtime != old_laps_mtime
+
+        for lap, fname in laps:
+            seen.add(fname)
+            st = source.stat(fname)
+            complete = lap in times or lap in gt7
+            if not relap and known.get(fname) == (st.st_mtime, st.st_size, int(complete)):
+                continue
+
+            samples, duration = source.lap_stats(fname, st)
+            con.execute(
+                """INSERT INTO laps (session, path, lap, time, complete, samples, mtime, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET time=excluded.time, complete=excluded.complete,
+                    samples=excluded.samples, mtime=excluded.mtime, size=excluded.size""",
+                (session, fname, lap, times[lap] if lap in times else duration, int(complete), samples, st.st_mtime, st.st_size)
+            )
+            changed = changed + 1
+            if verbose:
+                print(fname)
+
+        if relap:
+            con.execute('UPDATE sessions SET laps_mtime = ? WHERE id = ?', (laps_mtime, session))
+
+    removed = [p for p in known if p not in seen]
+    con.executemany('DELETE FROM laps WHERE path = ?', [(p,) for p in removed])
+    con.execute('DELETE FROM sessions WHERE id NOT IN (SELECT DISTINCT session FROM laps)')
+    con.commit()
+
+    return changed, len(removed)
+
+
+def fastest(con, track=None, car=None, limit=10, config=None, driver=None, complete=True):
+    """
+    the fastest laps, optionally filtered by track, car, config and driver.  Only
+    complete laps (in laps.txt, or GT7 laps with a lap either side) unless
+    complete is False, as the time of any other lap (an out lap, or one aborted
+    or still being driven) is just its last sample
+    """
+
+    where = ['l.time > 0']
+    params = []
+    for column, value in [('track', track), ('car', car), ('config', config), ('driver', driver)]:
+        if value is not None:
+            where.append('s.' + column + ' = ?')
+            params.append(value)
+    if complete:
+        where.append('l.complete = 1')
+
+    return con.execute(
+        """SELECT l.path, l.lap, l.time, l.complete, l.samples, s.track, s.config, s.car, s.driver, s.started
+        FROM laps l JOIN sessions s ON s.id = l.session
+        WHERE """ + ' AND '.join(where) + ' ORDER BY l.time LIMIT ?',
+        params + [limit]
+    ).fetchall()
+
+
+def resolve(spec, db=DEFAULT_DB):
+    """ a lap file name, or the file for a `fastest:<track>/<car>[/<n>]` query """
+
+    if not spec or not spec.startswith('fastest:'):
+        return spec
+
+    parts = spec[len('fastest:'):].split('/')
+    track, car = parts[0], parts[1] if len(parts) > 1 else None
+    n = int(parts[2]) if len(parts) > 2 else 1
+
+    laps = fastest(connect(db), track, car, limit=n, complete=True)
+    if len(laps) < n:
+        raise ValueError('no lap matches ' + spec)
+    return laps[n - 1]['path']
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Session and lap catalog')
+    parser.add_argument('--db', default=DEFAULT_DB, help='catalog database')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    up = commands.add_parser('update', help='index new and changed laps')
+    up.add_argument('root', nargs='?', default='log', help='log directory')
+    up.add_argument('-v', '--verbose', action='store_true', help='list the laps indexed')
+
+    fast = commands.add_parser('fastest', help='list the fastest laps')
+    fast.add_argument('track', nargs='?')
+    fast.add_argument('car', nargs='?')
+    fast.add_argument('-n', type=int, default=10, help='number of laps')
+    fast.add_argument('--config')
+    fast.add_argument('--driver')
+    fast.add_argument('--partial', action='store_true', help='include laps not known to be complete')
+
+    args = parser.parse_args()
+    con = connect(args.db)
+
+    if args.command == 'update':
+        changed, removed = update(con, args.root, args.verbose)
+        print('{changed} laps indexed, {removed} removed'.format(changed=changed, removed=removed))
+
+    else:
+        for r in fastest(con, args.track, args.car, args.n, args.config, args.driver, not args.partial):
+            print('\t'.join([
+                '{:.3f}'.format(r['time']), r['track'], r['car'], r['driver'], str(r['lap']), str(r['samples']), r['path']
+            ]))
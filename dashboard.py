@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+Live dashboard of the current lap against the best lap so far
+
+A bokeh server runs on the same asyncio event loop as the AC or GT7
+listener.  The decoded updates only append to the current lap's lists, and
+each open page pulls what is new at a fixed rate into its own
+ColumnDataSource with stream(), so a slow browser never holds up the
+listener.  The pages show speed, pedals, the running delta to the best lap
+and the track map.
+
+    python dashboard.py ac 127.0.0.1
+    python dashboard.py gt7 192.168.1.20
+    python dashboard.py ac --replay session.cap --speed 4
+
+then browse to http://localhost:5006/
+"""
+
+import argparse
+import asyncio
+import numpy
+from bokeh.layouts import column, row
+from bokeh.models import ColumnDataSource, Div
+from bokeh.plotting import figure
+from bokeh.server.server import Server
+
+columns = ['distance', 'lapTime', 'speed', 'gas', 'brake', 'x', 'z']
+
+
+class LiveLaps:
+    """ the samples of the current lap, and the best complete lap so far, from a stream of updates """
+
+    def __init__(self, min_distance=0.5):
+        self.min_distance = min_distance
+        self.lap = None
+        self.rows = { c: [] for c in columns }
+        self.last = None
+        self.best = None
+        self.best_time = None
+        # bumped at every new lap, so the pages know to start again
+        self.version = 0
+        self.updates = 0
+        # GT7 lap times are from the time of day the lap started
+        self.start = None
+
+    def load_best(self, fname):
+        """ start with a lap file as the best lap """
+        import plot
+        data = plot.load_lap(fname)
+        self.best = {
+            'distance': data['distance'], 'lapTime': data['lapTime'], 'speed': data['speed_Mph'],
+            'gas': data['gas'], 'brake': data['brake'], 'x': data['x'], 'z': -data['z'],
+        }
+        self.best_time = float(data['lapTime'][-1])
+        self.version = self.version + 1
+
+    def add(self, lap, lapTime, speed, gas, brake, x, y, z):
+        self.updates = self.updates + 1
+        rows = self.rows
+
+        if lap != self.lap or (rows['lapTime'] and lapTime + 5 < rows['lapTime'][-1]):
+            self.newlap(lap)
+            rows = self.rows
+
+        if self.last:
+            lx, ly, lz = self.last
+            step = ((x - lx) ** 2 + (y - ly) ** 2 + (z - lz) ** 2) ** 0.5
+            if step < self.min_distance:
+                return
+            distance = rows['distance'][-1] + step
+        else:
+            distance = 0.0
+
+        self.last = (x, y, z)
+        rows['distance'].append(distance)
+        rows['lapTime'].append(lapTime)
+        rows['speed'].append(speed)
+        rows['gas'].append(gas)
+        rows['brake'].append(brake)
+        rows['x'].append(x)
+        rows['z'].append(-z)
+
+    def newlap(self, lap):
+        rows = self.rows
+        # only a lap that was seen from its start, and ended by crossing the line, counts
+        if self.lap is not None and lap == self.lap + 1 and rows['lapTime'] and rows['lapTime'][0] < 1.0:
+            time = rows['lapTime'][-1]
+            if self.best_time is None or time < self.best_time:
+                self.best = { c: numpy.array(v) for c, v in rows.items() }
+                self.best_time = time
+
+        self.lap = lap
+        self.rows = { c: [] for c in columns }
+        self.last = None
+        self.version = self.version + 1
+
+    def ac(self, update):
+        """ ACSource consumer """
+        self.add(update.lapCount, update.lapTime, update.speed_Mph, update.gas, update.brake,
+            update.x, update.y, update.z)
+
+    def gt7(self, packet):
+        """ consumer of packets decoded with GT7Recorder.fields """
+        lap = packet.LAPS[0]
+        if lap != self.lap:
+            self.start = packet.DAYTIME_PROGRESSION
+        x, y, z = packet.POSITION
+        self.add(lap, (packet.DAYTIME_PROGRESSION - self.start) / 1000, packet.SPEED * 2.25,
+            packet.THROTTLE, packet.BRAKE, x, y, z)
+
+    def delta(self, distance, lapTime):
+        """ time ahead (-ve) or behind (+ve) the best lap at each distance """
+        if self.best is None or len(self.best['distance']) < 2:
+            return numpy.zeros(len(distance))
+        return lapTime - numpy.interp(distance, self.best['distance'], self.best['lapTime'])
+
+
+class Dashboard:
+    """ one page of the dashboard, pulling new samples from a LiveLaps every 1/rate seconds """
+
+    def __init__(self, laps, doc, rate=10, rollover=20000):
+        self.laps = laps
+        self.doc = doc
+        self.rollover = rollover
+        self.version = None
+        self.cursor = 0
+
+        empty = { c: numpy.zeros(0) for c in columns + ['delta'] }
+        self.source = ColumnDataSource(data=dict(empty))
+        self.best_source = ColumnDataSource(data={ c: numpy.zeros(0) for c in columns })
+        self.pos_source = ColumnDataSource(data={ 'x': [0.0], 'z': [0.0] })
+
+        self.status = Div(text='waiting for updates')
+
+        speed = figure(plot_height=250, tools='xpan,xwheel_zoom,reset', y_axis_label='mph')
+        speed.line('distance', 'speed', source=self.best_source, color='gray', legend_label='best', line_width=2)
+        speed.line('distance', 'speed', source=self.source, legend_label='current', line_width=2)
+        speed.legend.location = 'top_left'
+
+        pedals = figure(plot_height=150, tools='', x_range=speed.x_range, y_axis_label='pedal')
+        pedals.line('distance', 'gas', source=self.best_source, color='gray', line_dash='dashed')
+        pedals.line('distance', 'brake', source=self.best_source, color='gray', line_dash='dashed')
+        pedals.line('distance', 'gas', source=self.source, color='green', line_width=2)
+        pedals.line('distance', 'brake', source=self.source, color='red', line_width=2)
+
+        delta = figure(plot_height=150, tools='', x_range=speed.x_range, x_axis_label='distance',
+            y_axis_label='delta (s)')
+        delta.line('distance', 'delta', source=self.source, line_width=2)
+
+        track = figure(title='Track', plot_width=400, plot_height=550, tools='', match_aspect=True)
+        track.line('x', 'z', source=self.best_source, color='gray', line_width=2)
+        track.line('x', 'z', source=self.source, line_width=2)
+        track.circle_cross('x', 'z', source=self.pos_source, size=20, alpha=0.4)
+
+        traces = column(self.status, speed, pedals, delta)
+        traces.sizing_mode = 'stretch_width'
+        layout = row(traces, track)
+        layout.sizing_mode = 'stretch_width'
+        doc.add_root(layout)
+        doc.title = 'Live Telemetry'
+        doc.add_periodic_callback(self.update, int(1000 / rate))
+
+    def update(self):
+        laps = self.laps
+
+        if self.version != laps.version:
+            self.version = laps.version
+            self.cursor = 0
+            self.source.data = { c: numpy.zeros(0) for c in self.source.data }
+            if laps.best is not None:
+                self.best_source.data = { c: numpy.asarray(laps.best[c], dtype=numpy.float32) for c in columns }
+
+        n = len(laps.rows['distance'])
+        if n <= self.cursor:
+            return
+
+        new = { c: numpy.asarray(v[self.cursor:n], dtype=numpy.float64) for c, v in laps.rows.items() }
+        new['delta'] = laps.delta(new['distance'], new['lapTime'])
+        self.cursor = n
+
+        self.source.stream(new, rollover=self.rollover)
+        self.pos_source.data = { 'x': new['x'][-1:], 'z': new['z'][-1:] }
+        self.status.text = '<strong>lap {lap}</strong> {time:.3f}s, delta {delta:+.3f}s, best {best}'.format(
+            lap=laps.lap, time=new['lapTime'][-1], delta=new['delta'][-1],
+            best='{:.3f}s'.format(laps.best_time) if laps.best_time is not None else '-')
+
+
+async def gt7_source(args, laps):
+    from gt7 import ReceivePort, GT7Listener, GT7Recorder, PacketDecoder, salsa20_dec
+    from capture import areplay
+
+    decoder = PacketDecoder(GT7Recorder.fields)
+
+    def received(data):
+        ddata = salsa20_dec(data)
+        if len(ddata):
+            laps.gt7(decoder.decode(ddata))
+
+    if args.replay:
+        async for data, addr in areplay(args.replay, args.speed):
+            received(data)
+        return
+
+    loop = asyncio.get_running_loop()
+    transport, listener = await loop.create_datagram_endpoint(GT7Listener, local_addr=('0.0.0.0', ReceivePort))
+    listener.add(args.host, received)
+    try:
+        while True:
+            listener.heartbeat(args.host)
+            await asyncio.sleep(1.0)
+    finally:
+        transport.close()
+
+
+async def ac_source(args, laps):
+    from ac import ACListener, ACReplay
+
+    while True:
+        source = ACReplay(args.replay, args.speed) if args.replay else ACListener(args.host)
+        source.subscribe(laps.ac)
+        await source.run()
+        if args.replay:
+            return
+
+
+async def main(args):
+
+    laps = LiveLaps(args.min_distance)
+    if args.reference:
+        laps.load_best(args.reference)
+
+    server = Server({ '/': lambda doc: Dashboard(laps, doc, args.rate, args.rollover) },
+        port=args.port, allow_websocket_origin=args.allow_origin or ['localhost:{port}'.format(port=args.port)])
+    server.start()
+    print('dashboard at http://localhost:{port}/'.format(port=args.port))
+
+    try:
+        await (gt7_source(args, laps) if args.game == 'gt7' else ac_source(args, laps))
+        print('replay finished, {updates} updates'.format(updates=laps.updates))
+        # keep serving the last lap
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Live Telemetry Dashboard')
+    parser.add_argument('game', choices=['ac', 'gt7'])
+    parser.add_argument('host', nargs='?', default='127.0.0.1', help='IP address of the AC host or GT7 console')
+    parser.add_argument('--port', type=int, default=5006, help='port to serve the dashboard on')
+    parser.add_argument('--allow-origin', action='append', metavar='HOST:PORT',
+                help='other host:port the dashboard may be browsed from')
+    parser.add_argument('--rate', type=float, default=10, help='page updates per second')
+    parser.add_argument('--rollover', type=int, default=20000, help='most samples of a lap a page keeps')
+    parser.add_argument('--min-distance', type=float, default=0.5, help='meters between samples')
+    parser.add_argument('--reference', metavar='FILE', help='lap file to start with as the best lap')
+    parser.add_argument('--replay', metavar='FILE', help='replay a capture file instead of listening')
+    parser.add_argument('--speed', type=float, default=1.0,
+                help='replay speed multiplier, 0 for as fast as possible')
+
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print('stopping')
@@ -0,0 +1,446 @@
+"""
+GT7 telemetry packets
+
+The packet layout table, decryption and a decoder that compiles the table
+once into a single struct (and an equivalent numpy dtype for decoding many
+packets at once), so that logging or offline tools can share it.
+
+    decoder = PacketDecoder()
+    p = decoder.decode(salsa20_dec(data))
+    p.SPEED, p['POSITION']
+"""
+
+import os
+import datetime
+import asyncio
+import collections
+import itertools
+import struct
+import numpy
+import lapfile
+import metrics
+# pip3 install salsa20
+from salsa20 import Salsa20_xor
+
+#https://github.com/Nenkai/PDTools/blob/master/SimulatorInterface/SimulatorInterface.cs
+ReceivePort = 33740
+SendPort = 33739
+
+MAGIC = 0x47375330 # 0S7G - G7S0
+KEY = b'Simulator Interface Packet GT7 ver 0.0'
+
+magic_failures = metrics.counter('gt7_magic_failures_total', 'packets dropped as they did not decrypt to the magic number')
+
+data_type_spec = {
+    'FLOAT':{
+        'struct_decrypt':'f',
+        'dtype':'<f4',
+        'bytes':4
+    },
+    'BYTE':{
+        'struct_decrypt':'B',
+        'dtype':'u1',
+        'bytes':1
+    },
+    'INT':{
+        'struct_decrypt':'i',
+        'dtype':'<i4',
+        'bytes':4
+    },
+    'SHORT':{
+        'struct_decrypt':'H',
+        'dtype':'<u2',
+        'bytes':2
+    }
+}
+
+#https://github.com/Nenkai/PDTools/blob/master/PDTools.SimulatorInterface/SimulatorPacketGT7.cs
+packet_data_struct = [
+    (0x04,3,"FLOAT","POSITION"),
+    (0x10,3,"FLOAT","VELOCITY"),
+    (0x1C,3,"FLOAT","ROTATION"),
+    (0x28,1,"FLOAT","ROTATION_NORTH"),
+    (0x2C,3,"FLOAT","VELOCITY_ANGULAR"),
+    (0x38,1,"FLOAT","RIDE_HEIGHT"),
+    (0x3C,1,"FLOAT","RPM"),
+    (0x40,8,"BYTE","IV"),
+    (0x48,1,"FLOAT","UNKNOWN_0x48"),
+    (0x4C,1,"FLOAT","SPEED"),
+    (0x50,1,"FLOAT","TURBO_BOOST"),
+    (0x54,1,"FLOAT","OIL_PRESSURE"),
+    (0x58,1,"FLOAT","UNKNOWN_0x58"),
+    (0x5C,1,"FLOAT","UNKNOWN_0x5C"),
+    (0x60,4,"FLOAT","TYRES_TEMP"),
+    (0x70,1,"INT","TICK"),
+    (0x74,2,"SHORT","LAPS"),
+    (0x78,1,"INT","BEST_LAPTIME"),
+    (0x7C,1,"INT","LAST_LAPTIME"),
+    (0x80,1,"INT","DAYTIME_PROGRESSION"),
+    (0x84,2,"SHORT","RACE_POSITION"),
+    (0x88,4,"SHORT","ALERTS"),
+    (0x90,1,"BYTE", "GEAR"),
+    (0x91,1,"BYTE", "THROTTLE"),
+    (0x92,1,"BYTE", "BRAKE"),
+    (0x94,4,"FLOAT","WHEELS_SPEED"),
+    (0xA4,4,"FLOAT","TYRES_RADIUS"),
+    (0xB4,4,"FLOAT","TYRE_SUSPENSION_TRAVEL"),
+    (0xC4,4,"FLOAT","UNKNOWN"),
+    (0xD4,32,"BYTE","UNKNOWN_RESRVED"),
+    (0xF4,1,"FLOAT","CLUCH"),
+    (0xF8,1,"FLOAT","CLUCH_ENGAGEMENT"),
+    (0xFC,1,"FLOAT","CLUCH_RPM"),
+    (0x100,1,"FLOAT","UNKNOWN_GEAR"),
+    (0x104,8,"FLOAT","UNKNOWN_GEAR_RATIO"),
+    (0x124,1,"INT","CAR_CODE")
+]
+
+PACKET_SIZE = 0x128
+
+
+#https://github.com/Nenkai/PDTools/blob/master/PDTools.Crypto/SimulationInterface/SimulatorInterfaceCryptorGT7.cs
+def salsa20_dec(dat):
+  oiv = dat[0x40:0x44]
+  iv1 = int.from_bytes(oiv, byteorder='little') # Seed IV is always located there
+  iv2 = iv1 ^ 0xDEADBEAF #// Notice DEADBEAF, not DEADBEEF
+  IV = bytearray()
+  IV.extend(iv2.to_bytes(4, 'little'))
+  IV.extend(iv1.to_bytes(4, 'little'))
+  ddata = Salsa20_xor(dat, bytes(IV), KEY[0:32])#.decode()
+  #check magic number
+  magic = int.from_bytes(ddata[0:4], byteorder='little')
+  if magic != MAGIC:
+    magic_failures.inc()
+    return bytearray(b'')
+  return ddata
+
+
+# salsa20 state words: the constant and the 32 byte key, the (a, b, c, d) words of
+# the column then the row quarter rounds, and the (x, y, z) of each quarter round
+# step, z ^= (x + y) <<< n
+SIGMA = numpy.frombuffer(b'expand 32-byte k', dtype='<u4')
+KEY_WORDS = numpy.frombuffer(KEY[0:32], dtype='<u4')
+QUARTER_ROUNDS = [(0, 4, 8, 12), (5, 9, 13, 1), (10, 14, 2, 6), (15, 3, 7, 11),
+    (0, 1, 2, 3), (5, 6, 7, 4), (10, 11, 8, 9), (15, 12, 13, 14)]
+STEPS = [(x, y, z, n) for a, b, c, d in QUARTER_ROUNDS
+    for (x, y, z), n in zip(((a, d, b), (b, a, c), (c, b, d), (d, c, a)), (7, 9, 13, 18))]
+
+
+def salsa20_keystream(seeds, size=PACKET_SIZE, lanes=65536):
+  """
+  the keystream for each seed IV, as a (seeds, size) uint8 array.  Each state
+  word is an array across every block of every packet (`lanes` blocks at a
+  time), so each step of the rounds is one numpy operation on all of them
+  """
+  seeds = numpy.asarray(seeds, dtype=numpy.uint32)
+  blocks = -(-size // 64)
+  state = numpy.empty((16, len(seeds), blocks), dtype=numpy.uint32)
+  state[[0, 5, 10, 15]] = SIGMA[:, None, None]
+  state[1:5] = KEY_WORDS[:4, None, None]
+  state[11:15] = KEY_WORDS[4:, None, None]
+  # the nonce is the seed xor DEADBEAF then the seed, the block counter is 64 bits
+  state[6] = (seeds ^ numpy.uint32(0xDEADBEAF))[:, None]
+  state[7] = seeds[:, None]
+  state[8] = numpy.arange(blocks, dtype=numpy.uint32)
+  state[9] = 0
+  state = state.reshape(16, -1)
+
+  out = numpy.empty_like(state)
+  for start in range(0, state.shape[1], lanes):
+    x = state[:, start:start + lanes].copy()
+    w = list(x)
+    t = numpy.empty(x.shape[1], dtype=numpy.uint32)
+    u = numpy.empty_like(t)
+    for _ in range(10):
+      for a, b, c, n in STEPS:
+        numpy.add(w[a], w[b], out=t)
+        numpy.left_shift(t, n, out=u)
+        numpy.right_shift(t, 32 - n, out=t)
+        numpy.bitwise_or(u, t, out=u)
+        numpy.bitwise_xor(w[c], u, out=w[c])
+    numpy.add(x, state[:, start:start + lanes], out=out[:, start:start + lanes])
+
+  # words in order within each block, blocks in order within each packet
+  words = numpy.ascontiguousarray(out.reshape(16, len(seeds), blocks).transpose(1, 2, 0), dtype='<u4')
+  return words.view(numpy.uint8).reshape(len(seeds), blocks * 64)[:, :size]
+
+
+def salsa20_dec_many(packets, size=PACKET_SIZE):
+  """
+  salsa20_dec for many packets at once, with the keystreams generated in numpy.
+  Returns the packets that decrypted to the magic number, as one contiguous
+  (n, size) uint8 array for PacketDecoder.decode_many, and a mask of which did.
+  Packets of any other size fail, as they would the magic check.
+  """
+  packets = list(packets)
+  ok = numpy.array([len(p) == size for p in packets], dtype=bool)
+  data = numpy.frombuffer(b''.join(itertools.compress(packets, ok)), dtype=numpy.uint8).reshape(-1, size)
+
+  seeds = data[:, 0x40:0x44].copy().view('<u4')[:, 0]
+  ddata = data ^ salsa20_keystream(seeds, size)
+  # the seed is left in the clear, as salsa20_dec leaves it decrypted
+  magic = ddata[:, 0:4].copy().view('<u4')[:, 0] == MAGIC
+
+  valid = numpy.zeros(len(packets), dtype=bool)
+  valid[ok] = magic
+  failures = len(packets) - int(magic.sum())
+  if failures:
+    magic_failures.inc(failures)
+  return ddata[magic], valid
+
+
+def salsa20_dec_frames(frames, batch=4096):
+  """
+  decrypt an iterable of (data, addr) frames a batch at a time, yielding
+  (data, addr, ddata) with an empty ddata for the packets salsa20_dec would reject
+  """
+  frames = iter(frames)
+  for chunk in iter(lambda: list(itertools.islice(frames, batch)), []):
+    ddata, valid = salsa20_dec_many(data for data, addr in chunk)
+    rows = iter(ddata)
+    for (data, addr), ok in zip(chunk, valid):
+      yield data, addr, next(rows) if ok else bytearray(b'')
+
+
+def salsa20_enc(ddata, seed):
+  """ encrypt a decrypted packet the way the console does, leaving the seed IV in the clear """
+  iv1 = seed & 0xFFFFFFFF
+  iv2 = iv1 ^ 0xDEADBEAF
+  IV = iv2.to_bytes(4, 'little') + iv1.to_bytes(4, 'little')
+  dat = bytearray(Salsa20_xor(bytes(ddata), IV, KEY[0:32]))
+  dat[0x40:0x44] = iv1.to_bytes(4, 'little')
+  return bytes(dat)
+
+
+class Packet:
+    """ decoded packet values, with a named accessor per field added by PacketDecoder """
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+class PacketDecoder:
+    """
+    compiles a packet layout into one struct.Struct and a numpy dtype
+
+    Only the fields in `names` are decoded (all of them by default), the rest
+    of the packet is skipped as padding.  Fields with a count of one decode to
+    a scalar, the rest to a tuple.
+    """
+
+    def __init__(self, names=None, layout=packet_data_struct, size=PACKET_SIZE):
+
+        fmt = ['<']
+        dt = { 'names': [], 'formats': [], 'offsets': [], 'itemsize': size }
+        accessors = {}
+        pos = 0
+        index = 0
+
+        for start, count, t, name in sorted(layout):
+            if names is not None and name not in names:
+                continue
+
+            spec = data_type_spec[t]
+            if start > pos:
+                fmt.append('{pad}x'.format(pad=start - pos))
+            fmt.append('{count}{code}'.format(count=count, code=spec['struct_decrypt']))
+
+            dt['names'].append(name)
+            dt['formats'].append(spec['dtype'] if count == 1 else (spec['dtype'], (count,)))
+            dt['offsets'].append(start)
+
+            if count == 1:
+                accessors[name] = property(lambda p, i=index: p.values[i])
+            else:
+                accessors[name] = property(lambda p, s=slice(index, index + count): p.values[s])
+
+            pos = start + count * spec['bytes']
+            index = index + count
+
+        self.names = dt['names']
+        self.struct = struct.Struct(''.join(fmt))
+        self.dtype = numpy.dtype(dt)
+        self.Packet = type('Packet', (Packet,), dict(accessors, __slots__=()))
+
+    def decode(self, buf, offset=0):
+        """ decode a single decrypted packet """
+        return self.Packet(self.struct.unpack_from(buf, offset))
+
+    def decode_many(self, buf):
+        """ decode a contiguous buffer of decrypted packets into a numpy structured array """
+        return numpy.frombuffer(buf, dtype=self.dtype)
+
+
+class Sequencer:
+    """
+    passes decoded packets on to `consumer` in TICK order, through a jitter buffer
+    of up to `depth` packets, counting the ticks lost, duplicated and reordered
+
+    Packets in order go straight through.  One arriving after a gap is held until
+    the missing ticks turn up or `depth` packets are waiting, when the missing ticks
+    are given up as lost.  A jump of more than `resync` ticks either way (a new
+    session, or the game paused) starts counting again from the new tick.
+    """
+
+    def __init__(self, consumer, depth=3, resync=600):
+        self.consumer = consumer
+        self.depth = depth
+        self.resync = resync
+        self.pending = {}
+        self.next = None
+        self.highest = None
+        # recently lost ticks, to tell a late packet from a duplicate
+        self.skipped = collections.deque(maxlen=256)
+        self.received = 0
+        self.lost = 0
+        self.late = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.resyncs = 0
+
+    def push(self, packet):
+        tick = packet.TICK
+        self.received = self.received + 1
+
+        if self.next is None or abs(tick - self.next) > self.resync:
+            if self.next is not None:
+                self.flush()
+                self.resyncs = self.resyncs + 1
+            self.next = tick
+            self.highest = tick
+
+        if tick < self.next:
+            if tick in self.skipped:
+                self.late = self.late + 1
+            else:
+                self.duplicates = self.duplicates + 1
+            return
+
+        if tick in self.pending:
+            self.duplicates = self.duplicates + 1
+            return
+
+        if tick < self.highest:
+            self.reordered = self.reordered + 1
+        else:
+            self.highest = tick
+
+        self.pending[tick] = packet
+        self.release()
+
+        if len(self.pending) > self.depth:
+            # give up on the gap
+            first = min(self.pending)
+            self.lost = self.lost + first - self.next
+            self.skipped.extend(range(max(self.next, first - self.skipped.maxlen), first))
+            self.next = first
+            self.release()
+
+    def release(self):
+        pending = self.pending
+        while self.next in pending:
+            packet = pending.pop(self.next)
+            self.next = self.next + 1
+            self.consumer(packet)
+
+    def flush(self):
+        """ pass on every packet still waiting, in order """
+        for tick in sorted(self.pending):
+            self.lost = self.lost + tick - self.next
+            self.consumer(self.pending.pop(tick))
+            self.next = tick + 1
+
+    def __str__(self):
+        return '{self.received} packets, {self.lost} lost, {self.late} late, {self.duplicates} duplicates, ' \
+            '{self.reordered} reordered'.format(self=self)
+
+
+class GT7Listener(asyncio.DatagramProtocol):
+    """
+    one socket on ReceivePort shared by any number of consoles, with each
+    packet handed to the handler added for its source address (or just its ip)
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.handlers = {}
+        self.unknown = 0
+
+    def add(self, ip, handler, port=SendPort):
+        self.handlers[(ip, port)] = handler
+        self.handlers.setdefault(ip, handler)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        handler = self.handlers.get(addr) or self.handlers.get(addr[0])
+        if handler:
+            handler(data)
+        else:
+            self.unknown = self.unknown + 1
+
+    def error_received(self, exc):
+        pass
+
+    def heartbeat(self, ip, port=SendPort):
+        self.transport.sendto(b'A', (ip, port))
+
+
+class GT7Recorder:
+    """ logs decoded packets to a lap file per lap, under <root>/gt7/<timestamp> """
+
+    header = ['lapTime', 'speed_Mph', 'gas', 'brake', 'steer', 'gear', 'x', 'y', 'z']
+
+    # the packet fields needed for the header
+    fields = ['POSITION', 'SPEED', 'TICK', 'LAPS', 'DAYTIME_PROGRESSION', 'GEAR', 'THROTTLE', 'BRAKE']
+
+    def __init__(self, writer, root='log', tsv=False):
+        self.writer = writer
+        self.tsv = tsv
+        timestamp = datetime.datetime.now().replace(microsecond=0).isoformat().replace('-', '').replace(':', '')
+        self.path = os.path.join(root, 'gt7', timestamp)
+        os.makedirs(self.path, exist_ok=True)
+
+        self.lastLap = None
+        self.fout = None
+        self.startTime = None
+        self.rows = 0
+        self.lap_bytes = metrics.histogram('lap_bytes', 'size of each lap file', buckets=metrics.BYTES, game='gt7')
+
+    def update(self, packet):
+
+        lap = packet.LAPS[0]
+        dayTime = packet.DAYTIME_PROGRESSION
+
+        if self.lastLap != lap:
+
+            if self.fout:
+                self.fout.close()
+                self.lap_bytes.observe(self.fout.bytes)
+                print(f"\nwriter: {self.writer.status()}")
+
+            # open a new logger file
+            ext = '.txt' if self.tsv else lapfile.EXT
+            self.fout = lapfile.create(os.path.join(self.path, f'lap-{lap}{ext}'), self.header,
+                tsv=self.tsv, writer=self.writer)
+
+            # clear the lap
+            self.startTime = dayTime
+            self.lastLap = lap
+
+        if self.fout:
+            x, y, z = packet.POSITION
+            lapTime = dayTime - self.startTime
+            self.fout.write([lapTime/1000, packet.SPEED*2.25, packet.THROTTLE, packet.BRAKE, 0,
+                packet.GEAR & 0x0f, x, y, z])
+            self.rows = self.rows + 1
+
+    def close(self):
+        if self.fout:
+            self.fout.close()
+            self.lap_bytes.observe(self.fout.bytes)
+            self.fout = None
@@ -0,0 +1,148 @@
+"""
+Cache of resampled laps
+
+Resampled laps (the dicts of arrays returned by plot.load_lap) are cached by
+file path, mtime, size and interpolation length, first in memory (least
+recently used first out) and then on disk as .npz files, each tier with its
+own size cap.  Cached arrays are read only, as they are shared between
+callers.
+
+    cache = LapCache(DEFAULT_DIR)
+    data = cache.get('lap_1.bin', 0, plot.load_lap)
+"""
+
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+import numpy
+import archive
+
+DEFAULT_DIR = os.path.join('log', '.lapcache')
+
+
+class LapCache:
+
+    def __init__(self, directory=None, memory_bytes=256 * 1024 * 1024, disk_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.disk_used = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, file, ilen):
+        st = archive.stat(file)
+        return (os.path.abspath(file), st.st_mtime_ns, st.st_size, ilen)
+
+    def get(self, file, ilen, loader, reference=None):
+        """
+        the resampled lap, from the cache or else loader(file, ilen=ilen), or
+        loader(file, reference=reference) for laps aligned to a reference lap
+        """
+
+        key = self.key(file, ilen)
+        if reference:
+            key = key + self.key(reference, 0)
+
+        data = self.memory.get(key)
+        if data is not None:
+            self.memory.move_to_end(key)
+            self.hits = self.hits + 1
+            return data
+
+        data = self.load(key)
+        if data is not None:
+            self.disk_hits = self.disk_hits + 1
+        else:
+            self.misses = self.misses + 1
+            data = loader(file, reference=reference) if reference else loader(file, ilen=ilen)
+            for v in data.values():
+                v.flags.writeable = False
+            self.save(key, data)
+
+        self.remember(key, data)
+        return data
+
+    def remember(self, key, data):
+        self.memory[key] = data
+        self.memory_used = self.memory_used + nbytes(data)
+        while self.memory_used > self.memory_bytes and len(self.memory) > 1:
+            _, old = self.memory.popitem(last=False)
+            self.memory_used = self.memory_used - nbytes(old)
+
+    def filename(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+
+    def load(self, key):
+        if not self.directory:
+            return None
+        fname = self.filename(key)
+        try:
+            with numpy.load(fname) as npz:
+                data = { name: npz[name] for name in npz.files }
+        except (OSError, ValueError):
+            return None
+        # keep the most recently used files the newest
+        os.utime(fname)
+        for v in data.values():
+            v.flags.writeable = False
+        return data
+
+    def save(self, key, data):
+        if not self.directory:
+            return
+
+        # write then rename, so concurrent readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            numpy.savez(f, **data)
+        os.replace(tmp, self.filename(key))
+
+        if self.disk_used is None:
+            self.disk_used = sum(e.stat().st_size for e in self.entries())
+        else:
+            self.disk_used = self.disk_used + os.path.getsize(self.filename(key))
+
+        if self.disk_used > self.disk_bytes:
+            self.evict()
+
+    def entries(self):
+        return [e for e in os.scandir(self.directory) if e.name.endswith('.npz')]
+
+    def evict(self):
+        """ remove the least recently used files until the disk tier is under its cap """
+        entries = sorted(self.entries(), key=lambda e: e.stat().st_mtime)
+        self.disk_used = sum(e.stat().st_size for e in entries)
+        for e in entries[:-1]:
+            if self.disk_used <= self.disk_bytes:
+                break
+            try:
+                size = e.stat().st_size
+                os.remove(e.path)
+                self.disk_used = self.disk_used - size
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'memory_laps': len(self.memory),
+            'memory_bytes': self.memory_used,
+            'disk_bytes': self.disk_used,
+        }
+
+    def __str__(self):
+        return 'lap cache: {hits} memory hits, {disk_hits} disk hits, {misses} misses'.format(**self.stats())
+
+
+def nbytes(data):
+    return sum(v.nbytes for v in data.values())
@@ -0,0 +1,40 @@
+"""
+Reading lap files, of any format, for analysis
+
+The one parser of binary, TSV and archived laps and the path distance along
+them, shared by the plots and the live delta's reference lap so the two
+always agree, without the logger importing bokeh through plot.py.
+"""
+
+import numpy
+from numpy.lib.recfunctions import structured_to_unstructured
+import lapfile
+import archive
+
+
+def read_lap(file):
+    """ return the channel names and a 2D array of values, one row per channel """
+
+    if archive.split(file):
+        lap = archive.read_lap(file)
+        names = list(lap.dtype.names)
+        return names, structured_to_unstructured(lap, dtype=numpy.float64).T
+
+    if lapfile.is_lapfile(file):
+        lap = lapfile.read_lap(file)
+        names = list(lap.dtype.names)
+        return names, structured_to_unstructured(lap, dtype=numpy.float64).T
+
+    with open(file,'r') as dest_f:
+        names = dest_f.readline().rstrip('\n').split('\t')
+        values = numpy.loadtxt(dest_f, delimiter='\t', ndmin=2)
+
+    return names, values.T
+
+
+def path_distance(x, y, z):
+    """ cumulative 3D distance travelled at each point """
+    dist = numpy.zeros(len(x))
+    step = numpy.hypot(numpy.hypot(numpy.diff(x), numpy.diff(y)), numpy.diff(z))
+    numpy.cumsum(step, out=dist[1:])
+    return dist
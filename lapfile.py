@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+Binary lap files
+
+A lap file starts with a small header naming each channel and its type,
+followed by one fixed width little-endian record per logged sample.  Records
+are appended as the samples arrive, so a file is valid even if the logger
+stops mid-lap, and the whole lap can be mapped straight into a numpy
+structured array with named columns.
+
+    header:  magic 'RSTL', version (u16), column count (u16)
+    column:  name (16 bytes, nul padded), numpy type code (4 bytes, e.g. 'f4')
+    records: column values packed in header order
+
+Use `python lapfile.py lap_1.bin [lap_1.txt]` to export a lap as TSV
+"""
+
+import struct
+import argparse
+import os
+import re
+import numpy
+
+MAGIC = b'RSTL'
+VERSION = 1
+EXT = '.bin'
+
+# the name of a lap file, binary or TSV, and its lap number
+lap_re = re.compile(r'^lap[_-](\d+)\.(bin|txt)$')
+
+header_struct = struct.Struct('<4sHH')
+column_struct = struct.Struct('<16s4s')
+
+# channels that need more than a float32
+channel_types = {
+    'lapTime': 'f8',
+    'lapCount': 'i4',
+    'gear': 'i4',
+}
+default_type = 'f4'
+
+# numpy type code to struct format character
+struct_codes = {
+    'f4': 'f',
+    'f8': 'd',
+    'i1': 'b',
+    'u1': 'B',
+    'i2': 'h',
+    'u2': 'H',
+    'i4': 'i',
+    'u4': 'I',
+}
+
+
+def columns(names, types=None):
+    """ (name, type) of each channel, looked up in types (e.g. a packet schema's) then channel_types """
+    types = types or {}
+    return [(name, types.get(name) or channel_types.get(name, default_type)) for name in names]
+
+
+def pack_header(cols):
+    out = [header_struct.pack(MAGIC, VERSION, len(cols))]
+    for name, t in cols:
+        out.append(column_struct.pack(name.encode('ascii'), t.encode('ascii')))
+    return b''.join(out)
+
+
+def read_header(f):
+    magic, version, ncols = header_struct.unpack(f.read(header_struct.size))
+    if magic != MAGIC:
+        raise ValueError('not a lap file')
+    if version != VERSION:
+        raise ValueError('unsupported lap file version: {version}'.format(version=version))
+
+    cols = []
+    for _ in range(ncols):
+        name, t = column_struct.unpack(f.read(column_struct.size))
+        cols.append((name.rstrip(b'\0').decode('ascii'), t.rstrip(b'\0').decode('ascii')))
+    return cols
+
+
+def header_size(cols):
+    return header_struct.size + column_struct.size * len(cols)
+
+
+def dtype(cols):
+    return numpy.dtype([(name, '<' + t) for name, t in cols])
+
+
+def is_lapfile(fname):
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class LapWriter:
+    """ append binary records to an open binary file """
+
+    def __init__(self, f, names, types=None):
+        self.f = f
+        self.names = names
+        cols = columns(names, types)
+        self.record = struct.Struct('<' + ''.join(struct_codes[t] for _, t in cols))
+        header = pack_header(cols)
+        self.f.write(header)
+        self.bytes = len(header)
+
+    def write(self, values):
+        self.f.write(self.record.pack(*values))
+        self.bytes = self.bytes + self.record.size
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class TsvWriter:
+    """ the original tab separated text format, written to a binary file """
+
+    def __init__(self, f, names, types=None):
+        self.f = f
+        self.names = names
+        header = ('\t'.join(names) + '\n').encode()
+        self.f.write(header)
+        self.bytes = len(header)
+
+    def write(self, values):
+        line = ('\t'.join(map(str, values)) + '\n').encode()
+        self.f.write(line)
+        self.bytes = self.bytes + len(line)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def create(fname, names, tsv=False, writer=None, types=None):
+    """ start a new lap file, queued through a BackgroundWriter if given """
+    f = writer.open(fname) if writer else open(fname, mode='wb')
+    return (TsvWriter if tsv else LapWriter)(f, names, types)
+
+
+def read_lap(fname, mmap=True):
+    """ return the lap as a numpy structured array, one field per channel """
+    with open(fname, 'rb') as f:
+        cols = read_header(f)
+        dt = dtype(cols)
+        offset = header_size(cols)
+        # ignore any partial record left by an interrupted logger
+        rows = (os.fstat(f.fileno()).st_size - offset) // dt.itemsize
+
+        if rows <= 0:
+            return numpy.zeros(0, dtype=dt)
+
+        if mmap:
+            return numpy.memmap(fname, dtype=dt, mode='r', offset=offset, shape=(rows,))
+
+        f.seek(offset)
+        return numpy.fromfile(f, dtype=dt, count=rows)
+
+
+def export_tsv(src, dst):
+    lap = read_lap(src, mmap=False)
+    with open(dst, mode='wb') as f:
+        w = TsvWriter(f, list(lap.dtype.names))
+        for row in lap.tolist():
+            w.write(row)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Export a binary lap file as TSV')
+    parser.add_argument('lap', help='binary lap file')
+    parser.add_argument('out', nargs='?', help='output filename, defaults to the lap with a .txt extension')
+
+    args = parser.parse_args()
+
+    out = args.out or os.path.splitext(args.lap)[0] + '.txt'
+    export_tsv(args.lap, out)
+    print(out)
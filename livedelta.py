@@ -0,0 +1,86 @@
+"""
+Running time delta of the current lap to a reference lap
+
+The reference lap is turned into a lookup of its lap time at every `step`
+meters of cumulative path distance (as plot.load_lap measures it), so the
+time the reference took to reach any distance is one index and one linear
+interpolation away: the cost of each update does not grow with the length of
+the reference lap or the distance covered since the last one.  The reference
+is a chosen lap file, or the best complete lap of the session, kept from the
+rows as they are logged rather than read back from its file.
+
+    delta = LapDelta()
+    delta.subscribe(lambda d: print(d))
+    delta.newlap(lapTime)                 # at the start of every lap
+    delta.update(step, lapTime)           # for every row, with the meters since the last
+"""
+
+import numpy
+from lapdata import read_lap, path_distance
+
+
+def lookup(distance, lapTime, step=1.0):
+    """ the lap time at every step meters along the lap, as a list for fast indexing """
+    grid = numpy.arange(0, distance[-1] + step, step)
+    return numpy.interp(grid, distance, lapTime).tolist()
+
+
+def read_reference(fname, step=1.0):
+    """ lookup() for a lap file """
+    names, values = read_lap(fname)
+    lap = dict(zip(names, values))
+    return lookup(path_distance(lap['x'], lap['y'], lap['z']), lap['lapTime'], step)
+
+
+class LapDelta:
+    """ time ahead (-ve) or behind (+ve) the reference lap, at every row logged """
+
+    def __init__(self, reference=None, step=1.0):
+        self.step = step
+        self.fixed = reference is not None
+        self.times = read_reference(reference, step) if reference else None
+        self.best = None
+        self.consumers = []
+        self.distance = 0.0
+        self.delta = None
+        self.distances = []
+        self.lapTimes = []
+
+    def subscribe(self, fn):
+        self.consumers.append(fn)
+
+    def newlap(self, lapTime, completed=None):
+        """
+        start a lap at lapTime, after completing the last one in `completed`
+        seconds, which becomes the reference if it is the best so far
+        """
+        if completed and not self.fixed and len(self.distances) > 1 and self.lapTimes[0] < 1.0:
+            if self.best is None or completed < self.best:
+                self.times = lookup(self.distances, self.lapTimes, self.step)
+                self.best = completed
+
+        self.distance = 0.0
+        self.delta = None
+        self.distances = [0.0]
+        self.lapTimes = [lapTime]
+
+    def update(self, step, lapTime):
+        self.distance = self.distance + step
+        if not self.fixed:
+            self.distances.append(self.distance)
+            self.lapTimes.append(lapTime)
+
+        times = self.times
+        if times is None:
+            return
+
+        position = self.distance / self.step
+        i = int(position)
+        if i >= len(times) - 1:
+            reference = times[-1]
+        else:
+            reference = times[i] + (times[i + 1] - times[i]) * (position - i)
+
+        self.delta = lapTime - reference
+        for fn in self.consumers:
+            fn(self.delta)
@@ -1,263 +1,115 @@
 #!/usr/bin/env python
 
-from socket import *
-from select import select
-from copy import copy
-from datetime import datetime
-import struct
 import argparse
-import os
-import threading
-import math
-from queue import Queue, Empty
-
-class Handshake:
-    fmt = '<100s100sII100s100s'
-    size = struct.calcsize(fmt)
-
-    def __init__(self, t):
-        carName, driverName, self.identifier, self.version, trackName, trackConfig = t
-
-        self.carName, self.driverName, self.trackName, self.trackConfig = map(
-            lambda s: s.decode('utf-16', errors='ignore').split('%')[0] ,
-            [carName, driverName, trackName, trackConfig]
-        )
-
-    @classmethod
-    def fromData(cls, d):
-        return cls(struct.unpack(Handshake.fmt, d))
-        
-    def __str__(self):
-        return '{self.carName}, {self.driverName}, {self.trackName}, {self.trackConfig}'.format(self=self)
-
-
-class Update:
-    fmt = '<8x2f24x4I5fI236x3f'
-    size = struct.calcsize(fmt)
-
-    def __init__(self, t):
-        self.speed_Kmh, self.speed_Mph, \
-        self.lapTime, self.lastLap, self.bestLap, self.lapCount, \
-        self.gas, self.brake, self.clutch, self.engineRPM, self.steer, \
-        self.gear, self.x, self.y, self.z = t
-
-        self.lapTime = self.lapTime / 1000
-        self.lastLap = self.lastLap / 1000
-        self.bestLap = self.bestLap / 1000
-
-    @classmethod
-    def fromData(cls, d):
-        return cls(struct.unpack(Update.fmt, d))
-
-    def __str__(self):
-        return '{self.speed_Kmh}, {self.gas}, {self.brake}, {self.engineRPM}, {self.x}, {self.y}, {self.z}'.format(self=self)
-
-    def coords(self):
-        return [self.x, self.y, self.z]
-
-    def distanceFrom(self, other):
-        [x1,y1,z1] = self.coords()  # first coordinates
-        [x2,y2,z2] = other.coords()  # second coordinates
-        return (((x2-x1)**2)+((y2-y1)**2)+((z2-z1)**2))**(1/2)
-
-
-class ACListener(threading.Thread):
-
-    def __init__(self, addr = '127.0.0.1', port=9996):
-        super(ACListener,self).__init__()
-        self.addr = addr
-        self.port = port
-        self.socket = socket(AF_INET,SOCK_DGRAM)
-        self.socket.setblocking(0)
-        self.connected = False
-        self.event = None
-        self.updates = Queue()
-        self.idle = 0
-
-    def run(self):
-
-        self.running = True
-
-        self.dismiss()
-
-        while self.running and not self.event:
-            self.event = self.handshake()
-
-        if self.event:
-            print('connected')
-
-            self.startUpdate()
-
-            while self.running:
-                self.nextUpdate()
-
-        self.dismiss()
-        self.close()
-
-    def stop(self):
-        self.running = False
-
-    def recv(self, size):
-        chunks = []
-        bytes_recv = 0
-
-        ready = select([self.socket], [], [], 2)
-        if ready[0]:
-
-            while bytes_recv < size:
-                chunk = self.socket.recv(size - bytes_recv)
-                if chunk == b'':
-                    raise RuntimeError("socket connection broken")
-
-                chunks.append(chunk)
-                bytes_recv = bytes_recv + len(chunk)
-
-            return b''.join(chunks)
-
-    def handshake(self):
-        print('sending handshake to {self.addr}:{self.port}'.format(self=self))
-        pkt = struct.pack('iii',1,1,0)
-        self.socket.sendto(pkt, (self.addr, self.port))
-        h = self.recv(Handshake.size)
-        if h:
-            return Handshake.fromData(h)
-
-    def startUpdate(self):
-        pkt = struct.pack('iii',1,1,1)
-        self.socket.sendto(pkt, (self.addr, self.port))
-
-    def nextUpdate(self):
-        u = self.recv(Update.size)
-        if u:
-            self.idle = 0
-            self.updates.put(Update.fromData(u), block=False)
-        else:
-            self.idle = self.idle + 1
-
-        if self.idle > 5:
-            print('updates stopped')
-            self.running = False
-
-    def dismiss(self):
-        pkt = struct.pack('iii',1,1,3)
-        self.socket.sendto(pkt, (self.addr, self.port))
-
-    def close(self):
-        self.dismiss()
-        self.socket.close()
-
-class Logger:
-
-    def __init__(self, logattr, event):
-        self.event = event
-        self.logattr = logattr
-        self.isodate = datetime.now().strftime('%Y%m%dT%H%M%S')
-        self.f = None
-        trackName = event.trackName
-        if(event.trackName != event.trackConfig):
-            trackName = trackName + '_' + event.trackConfig
-        self.path = os.path.join('log', trackName, self.event.carName, self.isodate + '_' + self.event.driverName)
-        self.path = self.path.replace(' ', '_')
-        os.makedirs(self.path, exist_ok=True)
-
-        lapfn = os.path.join(self.path, 'laps.txt')
-        self.lf = open(lapfn, mode='w', buffering=1)
-        self.lf.write('\t'.join(['lap', 'time']) + '\n')
-        print('logging to: {path}'.format(path=self.path))
-
-
-    def newlap(self, update):
-        if self.f:
-            self.f.close()
-
-        print('lap: {lapCount}, time: {lastLap}'.format(
-            lapCount=update.lapCount, lastLap=update.lastLap)
-        )
-        if update.lapCount > 0:
-            self.lf.write('\t'.join([str(update.lapCount), str(update.lastLap)]) + '\n')
-            self.lf.flush()
-
-        fname = os.path.join(self.path, 'lap_' +  str(update.lapCount + 1) + '.txt')
-
-        self.f = open(fname.replace(' ', '_'), mode='w', buffering=1)
-        self.f.write('\t'.join(logattr) + '\n')
-        self.update(update)
-
-    def update(self, update):
-        if self.f:
-            out = map(lambda a: str(getattr(update, a)), self.logattr)
-            self.f.write('\t'.join(out) + '\n')
-            self.f.flush()
-
-    def close(self):
-        if self.f:
-            self.f.close()
-        if self.lf:
-            self.lf.close()
+import asyncio
+import time
+import metrics
+from writer import BackgroundWriter
+from capture import CaptureWriter
+from ac import ACListener, ACReplay, Recorder, UpdateDecoder, LOG_CHANNELS, channel_names, update_layout
+from livedelta import LapDelta
+
+class DeltaPrinter:
+    """ shows the live delta, at most every interval seconds """
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.next = 0
+
+    def __call__(self, delta):
+        now = time.monotonic()
+        if now >= self.next:
+            self.next = now + self.interval
+            print('delta: {delta:+.3f}  '.format(delta=delta), end='\r', flush=True)
+
+async def main(args, logattr):
+
+    # before the source, which only times its packets if asked to
+    reporter = metrics.start(args)
+
+    writer = BackgroundWriter(args.flush_interval, args.flush_bytes, args.fsync)
+    writer.start()
+
+    # only what is logged, and what the recorder needs, is decoded
+    decoder = UpdateDecoder(Recorder.required + logattr)
+
+    capture = None
+    if args.replay:
+        source = ACReplay(args.replay, args.speed, decoder=decoder)
+    else:
+        if args.capture:
+            capture = CaptureWriter(args.capture, writer)
+        source = ACListener(args.host, args.port, capture, decoder=decoder)
+
+    delta = None
+    if args.delta or args.reference:
+        delta = LapDelta(args.reference)
+        delta.subscribe(DeltaPrinter())
+
+    recorder = Recorder(source, logattr, writer, tsv=args.tsv, delta=delta)
+    source.subscribe(recorder.update)
+
+    metrics.counter('ac_packets_total', 'datagrams received', fn=lambda: source.packets)
+    metrics.counter('ac_updates_total', 'updates decoded', fn=lambda: source.updates)
+    metrics.counter('ac_dropped_total', 'datagrams of an unknown size, or updates before the handshake',
+        fn=lambda: source.dropped)
+    metrics.counter('ac_rows_total', 'rows logged this session',
+        fn=lambda: recorder.logger.rows if recorder.logger else 0)
+
+    try:
+        await source.run()
+    finally:
+        recorder.close()
+        if capture:
+            capture.close()
+        writer.close()
+        if reporter:
+            reporter.close()
 
 if __name__ == '__main__':
 
-    logattr = ['lapTime', 'speed_Mph', 'gas', 'brake', 'steer', 'gear', 'x', 'y', 'z']
     parser = argparse.ArgumentParser(description='Assetto Corsa Telemetry Logger')
     parser.add_argument('host', nargs='?', default='127.0.0.1',
                     help='host IP address running AC')
     parser.add_argument('port', nargs='?', type=int, default=9996,
                 help='UDP port AC is listening on')     
+    parser.add_argument('--tsv', action='store_true',
+                help='log laps as tab separated text instead of binary')
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                help='seconds between flushes of the lap file')
+    parser.add_argument('--flush-bytes', type=int, default=64 * 1024,
+                help='flush the lap file once this many bytes are buffered')
+    parser.add_argument('--fsync', action='store_true',
+                help='fsync each lap file when the lap completes')
+    parser.add_argument('--capture', metavar='FILE',
+                help='append the raw packets received to a capture file')
+    parser.add_argument('--replay', metavar='FILE',
+                help='replay a capture file instead of connecting to AC')
+    parser.add_argument('--speed', type=float, default=1.0,
+                help='replay speed multiplier, 0 for as fast as possible')
+    parser.add_argument('--delta', action='store_true',
+                help='show the live delta to the best lap of the session')
+    parser.add_argument('--reference', metavar='FILE',
+                help='show the live delta to this lap file instead')
+    parser.add_argument('--channels', default=','.join(LOG_CHANNELS),
+                help='comma separated channels to log, a per wheel field logs all four wheels')
+    parser.add_argument('--list-channels', action='store_true',
+                help='list the channels that can be logged')
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
 
-    acl = ACListener(args.host, args.port)
-    acl.start()
-
-    logger = None
-
-    lastUpdate = None
-    finished = False
-    update_distance = 0.1
-
-    while acl.is_alive() and not finished:
-
-        try:
-            update = acl.updates.get(timeout=1) # to allow windows to use CTRL+C
-
-            if not logger:
-                logger = Logger(logattr, acl.event)
-
-            if not update:
-                continue
-
-            if not lastUpdate:
-                logger.newlap(update)
-                lastUpdate = copy(update)
-
-            elif lastUpdate.lapCount > update.lapCount:
-                # must have re-started the event
-                # so get a new logger
-                logger.close()
-                logger = Logger(logattr, acl.event)
-                logger.newlap(update)
-                lastUpdate = copy(update)
-
-            elif lastUpdate.lapCount < update.lapCount or lastUpdate.lapTime > (update.lapTime + 5):
-                logger.newlap(update)
-                lastUpdate = copy(update)
-
-            else:
-                
-                delta = lastUpdate.distanceFrom(update)
-
-                if delta > update_distance:
-                    logger.update(update)
-                    lastUpdate = copy(update)
-
-        except Empty:
-            pass
+    if args.list_channels:
+        for start, count, t, name in update_layout:
+            print('{name}\t{t}{wheels}'.format(name=name, t=t, wheels=' per wheel' if count > 1 else ''))
+        parser.exit()
 
-        except KeyboardInterrupt:
-            print('stopping')
-            finished = True
+    try:
+        logattr = channel_names(args.channels.split(','))
+    except ValueError as e:
+        parser.error(str(e))
 
-    if logger:
-        logger.close()
-    acl.stop()
-    acl.join()
+    try:
+        asyncio.run(main(args, logattr))
+    except KeyboardInterrupt:
+        print('stopping')
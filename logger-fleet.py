@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Log many AC and GT7 rigs from one process
+
+Every rig's sockets share one asyncio event loop and one background writer.
+Each AC rig gets its own listener, reconnecting whenever its session ends.
+All GT7 consoles share the single socket on the GT7 receive port, and their
+packets are routed by source address.  Each rig logs under log/<name>/.
+
+    python logger-fleet.py rig1=ac:192.168.1.10 rig2=ac:192.168.1.11 rig3=gt7:192.168.1.20
+"""
+
+import argparse
+import asyncio
+import os
+import time
+import metrics
+from writer import BackgroundWriter
+from ac import ACListener, Recorder, LOG_CHANNELS
+from gt7 import ReceivePort, SendPort, GT7Listener, GT7Recorder, PacketDecoder, Sequencer, salsa20_dec
+
+
+class ACRig:
+
+    def __init__(self, name, host, port, writer, args):
+        self.name = name
+        self.host = host
+        self.port = port or 9996
+        self.writer = writer
+        self.args = args
+        self.root = os.path.join(args.log, name)
+        self.source = None
+        self.recorder = None
+        self.errors = 0
+        # counts from previous sessions
+        self.done = [0, 0, 0]
+
+    def counters(self):
+        """ packets, rows and dropped datagrams, over every session """
+        packets, rows, dropped = self.done
+        if self.source:
+            packets = packets + self.source.packets
+            dropped = dropped + self.source.dropped
+        if self.recorder and self.recorder.logger:
+            rows = rows + self.recorder.logger.rows
+        return packets, rows, dropped
+
+    async def run(self):
+        backoff = self.args.backoff
+        while True:
+            self.source = ACListener(self.host, self.port)
+            self.recorder = Recorder(self.source, LOG_CHANNELS, self.writer, tsv=self.args.tsv, root=self.root)
+            self.source.subscribe(self.recorder.update)
+            try:
+                await self.source.run()
+                backoff = self.args.backoff
+            except Exception as e:
+                # only this rig waits and reconnects, the rest of the fleet carries on
+                self.errors = self.errors + 1
+                print('{name}: {e!r}, reconnecting in {backoff:.0f}s'.format(name=self.name, e=e, backoff=backoff))
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.args.max_backoff)
+            finally:
+                self.done = list(self.counters())
+                self.recorder.close()
+
+
+class GT7Rig:
+
+    decoder = PacketDecoder(GT7Recorder.fields)
+
+    def __init__(self, name, host, port, writer, args, listener):
+        self.name = name
+        self.host = host
+        self.port = port or SendPort
+        self.listener = listener
+        self.args = args
+        self.recorder = GT7Recorder(writer, root=os.path.join(args.log, name), tsv=args.tsv)
+        self.sequencer = Sequencer(self.recorder.update, args.jitter)
+        self.packets = 0
+        self.dropped = 0
+        self.errors = 0
+        listener.add(self.host, self.received, self.port)
+
+    def counters(self):
+        """ packets, rows and packets dropped as they failed decryption """
+        return self.packets, self.recorder.rows, self.dropped
+
+    def received(self, data):
+        self.packets = self.packets + 1
+        ddata = salsa20_dec(data)
+        if len(ddata) == 0:
+            self.dropped = self.dropped + 1
+            return
+        try:
+            self.sequencer.push(self.decoder.decode(ddata))
+        except Exception as e:
+            self.errors = self.errors + 1
+            print('{name}: {e}'.format(name=self.name, e=e))
+
+    async def run(self):
+        try:
+            # heartbeats are per console and by the clock, not by packet count
+            while True:
+                try:
+                    self.listener.heartbeat(self.host, self.port)
+                except Exception as e:
+                    self.errors = self.errors + 1
+                    print('{name}: {e!r}'.format(name=self.name, e=e))
+                await asyncio.sleep(self.args.heartbeat)
+        finally:
+            self.sequencer.flush()
+            self.recorder.close()
+
+
+def parse_target(target):
+    """ [name=]ac|gt7:host[:port] """
+    name, _, spec = target.rpartition('=')
+    kind, _, addr = spec.partition(':')
+    host, _, port = addr.partition(':')
+    if kind not in ('ac', 'gt7') or not host:
+        raise argparse.ArgumentTypeError('expected [name=]ac|gt7:host[:port], got ' + target)
+    return name or (kind + '-' + host + ('-' + port if port else '')), kind, host, int(port) if port else None
+
+
+async def stats(rigs, interval):
+    last = { rig.name: (rig.counters(), time.monotonic()) for rig in rigs }
+    while True:
+        await asyncio.sleep(interval)
+        lines = []
+        for rig in rigs:
+            (packets, rows, dropped), now = rig.counters(), time.monotonic()
+            (lpackets, lrows, _), then = last[rig.name]
+            dt = now - then
+            lines.append(('{name}: {pps:.1f} pkt/s, {rps:.1f} rows/s, {packets} packets, {rows} rows, '
+                '{dropped} dropped, {errors} errors').format(
+                name=rig.name, pps=(packets - lpackets) / dt, rps=(rows - lrows) / dt, packets=packets, rows=rows,
+                dropped=dropped, errors=rig.errors))
+            last[rig.name] = ((packets, rows, dropped), now)
+        print('\n'.join(lines))
+
+
+async def main(args):
+
+    reporter = metrics.start(args)
+
+    writer = BackgroundWriter(args.flush_interval, args.flush_bytes, args.fsync)
+    writer.start()
+
+    loop = asyncio.get_running_loop()
+    listener = None
+    rigs = []
+
+    for name, kind, host, port in args.targets:
+        if kind == 'ac':
+            rigs.append(ACRig(name, host, port, writer, args))
+        else:
+            if not listener:
+                transport, listener = await loop.create_datagram_endpoint(GT7Listener,
+                    local_addr=('0.0.0.0', args.gt7_port))
+            rigs.append(GT7Rig(name, host, port, writer, args, listener))
+
+    print('logging {n} rigs: {names}'.format(n=len(rigs), names=', '.join(rig.name for rig in rigs)))
+
+    for rig in rigs:
+        metrics.counter('fleet_packets_total', 'datagrams received from each rig',
+            fn=lambda rig=rig: rig.counters()[0], rig=rig.name)
+        metrics.counter('fleet_rows_total', 'rows logged for each rig',
+            fn=lambda rig=rig: rig.counters()[1], rig=rig.name)
+        metrics.counter('fleet_dropped_total', 'datagrams from each rig dropped without being decoded',
+            fn=lambda rig=rig: rig.counters()[2], rig=rig.name)
+        metrics.counter('fleet_errors_total', 'packets that failed to decode or log and connections that failed, per rig',
+            fn=lambda rig=rig: rig.errors, rig=rig.name)
+        if isinstance(rig, GT7Rig):
+            metrics.counter('fleet_ticks_lost_total', 'ticks never received from each GT7 rig',
+                fn=lambda rig=rig: rig.sequencer.lost, rig=rig.name)
+
+    try:
+        await asyncio.gather(stats(rigs, args.stats), *[rig.run() for rig in rigs])
+    finally:
+        if listener:
+            listener.transport.close()
+        writer.close()
+        if reporter:
+            reporter.close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Multi-rig AC and GT7 Telemetry Logger')
+    parser.add_argument('targets', nargs='*', type=parse_target, metavar='[name=]ac|gt7:host[:port]',
+                help='rigs to log')
+    parser.add_argument('--targets-file', metavar='FILE',
+                help='file with one target per line')
+    parser.add_argument('--log', default='log', help='directory to log under')
+    parser.add_argument('--gt7-port', type=int, default=ReceivePort,
+                help='local UDP port GT7 consoles send to')
+    parser.add_argument('--heartbeat', type=float, default=1.0,
+                help='seconds between heartbeats to each GT7 console')
+    parser.add_argument('--jitter', type=int, default=3,
+                help='GT7 packets held back waiting for a missing tick before it is counted as lost')
+    parser.add_argument('--backoff', type=float, default=1.0,
+                help='seconds before an AC rig that failed reconnects, doubling each time it fails again')
+    parser.add_argument('--max-backoff', type=float, default=60.0,
+                help='longest wait before an AC rig reconnects')
+    parser.add_argument('--stats', type=float, default=10.0,
+                help='seconds between throughput reports')
+    parser.add_argument('--tsv', action='store_true',
+                help='log laps as tab separated text instead of binary')
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                help='seconds between flushes of the lap files')
+    parser.add_argument('--flush-bytes', type=int, default=64 * 1024,
+                help='flush a lap file once this many bytes are buffered')
+    parser.add_argument('--fsync', action='store_true',
+                help='fsync each lap file when the lap completes')
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.targets_file:
+        with open(args.targets_file) as f:
+            args.targets = args.targets + [parse_target(l.strip()) for l in f if l.strip() and not l.startswith('#')]
+
+    if not args.targets:
+        parser.error('no targets given')
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print('stopping')
@@ -0,0 +1,291 @@
+"""
+Counters, gauges and histograms for the loggers and plotting
+
+Metrics live in a registry (REGISTRY by default), named and labelled as
+Prometheus expects.  Counters and gauges can read a function instead of
+being updated, so the existing counters (packets, rows, bytes written ...)
+cost nothing extra to export.  Histograms of the per packet stages are only
+created when `timing` is turned on, as timing every packet is not free.
+
+A Reporter thread prints a structured `metrics {...}` log line and/or writes
+a Prometheus text file (for the node exporter's textfile collector) at a
+fixed interval, and serve() exposes /metrics over HTTP.
+
+    packets = metrics.counter('ac_packets_total', 'datagrams received', rig='a')
+    packets.inc()
+    with metrics.histogram('plot_load_lap_seconds', buckets=metrics.SECONDS).time():
+        ...
+"""
+
+import bisect
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# per packet stages, in seconds
+LATENCY = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 5e-3, 0.025, 0.1)
+# loading and rendering, in seconds
+SECONDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# sizes, in bytes
+BYTES = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+# counts per batch
+BATCH = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# create the per packet stage histograms
+timing = False
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def inc(self, n=1):
+        self.value = self.value + n
+
+    def get(self):
+        return self.fn() if self.fn else self.value
+
+    def samples(self):
+        yield '', {}, self.get()
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def time(self):
+        return Timer(self)
+
+    def quantile(self, q):
+        """ the upper bound of the bucket the q'th quantile falls in """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, n in zip(self.buckets + [float('inf')], self.counts):
+            total = total + n
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        total = 0
+        for bound, n in zip(self.buckets, self.counts):
+            total = total + n
+            yield '_bucket', { 'le': repr(float(bound)) }, total
+        yield '_bucket', { 'le': '+Inf' }, self.count
+        yield '_sum', {}, self.sum
+        yield '_count', {}, self.count
+
+
+def timed(histogram):
+    """ decorate a function to observe the seconds each call takes """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with histogram.time():
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class Timer:
+    """ observe the seconds a with block takes """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.histogram.observe(self.seconds)
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{k}="{v}"'.format(k=k, v=str(v).replace('"', '\\"')) for k, v in sorted(labels.items())) + '}'
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def add(self, cls, name, help, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None or not isinstance(metric, cls):
+                metric = self.metrics[key] = cls(*args)
+            if help:
+                self.help[name] = help
+        return metric
+
+    def counter(self, name, help='', fn=None, **labels):
+        metric = self.add(Counter, name, help, labels)
+        if fn:
+            metric.fn = fn
+        return metric
+
+    def gauge(self, name, help='', fn=None, **labels):
+        metric = self.add(Gauge, name, help, labels)
+        if fn:
+            metric.fn = fn
+        return metric
+
+    def histogram(self, name, help='', buckets=LATENCY, **labels):
+        return self.add(Histogram, name, help, labels, buckets)
+
+    def render(self):
+        """ the Prometheus text exposition of every metric """
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        last = None
+        for (name, labels), metric in metrics:
+            if name != last:
+                if name in self.help:
+                    lines.append('# HELP {name} {help}'.format(name=name, help=self.help[name]))
+                lines.append('# TYPE {name} {kind}'.format(name=name, kind=metric.kind))
+                last = name
+            for suffix, extra, value in metric.samples():
+                lines.append('{name}{suffix}{labels} {value}'.format(
+                    name=name, suffix=suffix, labels=label_text(dict(labels, **extra)), value=value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """ the current values, with the count, mean and p99 of each histogram """
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        values = {}
+        for (name, labels), metric in metrics:
+            key = name + label_text(dict(labels))
+            if isinstance(metric, Histogram):
+                values[key] = {
+                    'count': metric.count,
+                    'mean': metric.sum / metric.count if metric.count else 0.0,
+                    'p99': metric.quantile(0.99),
+                }
+            else:
+                values[key] = metric.get()
+        return values
+
+    def write(self, fname):
+        """ write the text exposition to a file, replacing it whole """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname) or '.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, fname)
+
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+class Reporter(threading.Thread):
+    """ every interval seconds, print a structured log line and/or write a Prometheus text file """
+
+    def __init__(self, interval=10.0, textfile=None, log=True, registry=REGISTRY):
+        super(Reporter, self).__init__(daemon=True)
+        self.interval = interval
+        self.textfile = textfile
+        self.log = log
+        self.registry = registry
+        self.stopped = threading.Event()
+
+    def report(self):
+        if self.log:
+            print('metrics ' + json.dumps(dict(self.registry.snapshot(), ts=round(time.time(), 3))), flush=True)
+        if self.textfile:
+            self.registry.write(self.textfile)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def close(self):
+        """ stop, after a last report """
+        self.stopped.set()
+        self.report()
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """ serve the metrics at http://host:port/metrics from a daemon thread """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    """ the metrics options shared by the loggers """
+    parser.add_argument('--metrics-interval', type=float, default=0,
+                help='seconds between metrics log lines, 0 for none')
+    parser.add_argument('--metrics-file', metavar='FILE',
+                help='write Prometheus metrics to this file every interval (10s if not given)')
+    parser.add_argument('--metrics-port', type=int,
+                help='serve Prometheus metrics on this local port at /metrics')
+    parser.add_argument('--timing', action='store_true',
+                help='time every packet through decode, gating and writing')
+
+
+def start(args):
+    """ start reporting as the options ask, returning the Reporter to close, if any """
+    global timing
+    timing = args.timing
+    if args.metrics_port:
+        serve(args.metrics_port)
+    if args.metrics_interval or args.metrics_file:
+        reporter = Reporter(args.metrics_interval or 10.0, args.metrics_file, log=bool(args.metrics_interval))
+        reporter.start()
+        return reporter
+    return None
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+Render comparison reports for whole sessions at once
+
+For every session directory or archive given (or found under a directory
+given), each completed lap in its laps.txt, or for GT7 each lap the catalog
+counts as complete, is compared against the session's best lap and against
+the catalog's all-time best lap for the track and car.  Pairs of laps can
+also be listed in a file, one `<reference> <lap>` pair per line.
+
+Every reference lap is loaded and resampled once into the lap cache before
+the reports are rendered, headless, by a pool of worker processes, which then
+only load the reference from the cache.  An index.html linking every report
+is written to the output directory.
+
+    python plot-batch.py log/imola/ks_corvette_c7r/20201112T215006_Scott_Deakin
+    python plot-batch.py --pairs pairs.txt --out reports
+"""
+
+import argparse
+import html
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import archive
+import catalog
+import lapcache
+import plot
+
+
+def archive_session(fname):
+    """ the catalog's view of a session archive, or None if it cannot be read """
+    try:
+        return catalog.SessionArchive(fname)
+    except (OSError, ValueError, struct.error) as e:
+        print('skipping {fname}: {e}'.format(fname=fname, e=e))
+        return None
+
+
+def sessions(paths):
+    """ every session directory or archive with laps and a laps.txt, or of GT7, at or under the given paths """
+    for path in paths:
+        if os.path.isfile(path):
+            found = [archive_session(path)]
+        else:
+            found = []
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                found.append(catalog.SessionDir(root, files))
+                # an archive compacted without --remove is the same session as its directory
+                found.extend(archive_session(os.path.join(root, fn)) for fn in sorted(files)
+                    if fn.endswith(archive.EXT) and fn[:-len(archive.EXT)] not in dirs)
+        for source in found:
+            if source and source.laps and (source.laps_mtime is not None or catalog.is_gt7(source.path)):
+                yield source
+
+
+def lap_time(fname):
+    """ the last lapTime of a lap file, or of a lap in an archive from its index """
+    member = archive.split(fname)
+    if not member:
+        samples, seconds = catalog.lap_stats(fname, os.path.getsize(fname))
+        return seconds
+    with archive.Archive(member[0]) as a:
+        last = a.members[member[1]].last
+    return None if numpy.isnan(last) else last
+
+
+def session_jobs(con, source, out, log='log'):
+    """ (reference, lap, output, label) for each completed lap against the session best and the all-time best """
+
+    files = dict(source.laps)
+    if source.laps_mtime is not None:
+        times = { int(r['lap']): float(r['time']) for r in source.times() }
+    else:
+        times = { lap: lap_time(files[lap]) or 0 for lap in catalog.gt7_complete(source.laps) }
+    laps = sorted((t, files[lap]) for lap, t in times.items() if lap in files and t > 0)
+    if not laps:
+        return []
+
+    path = source.path[:-len(archive.EXT)] if source.path.endswith(archive.EXT) else source.path
+    info = source.info()
+    references = [('session', laps[0][1])]
+    best = catalog.fastest(con, info['track'], info['car'], limit=1, config=info['config'] or None, complete=True)
+    if best and os.path.abspath(best[0]['path']) != os.path.abspath(laps[0][1]):
+        references.append(('best', best[0]['path']))
+
+    name = os.path.relpath(path, log)
+    if name.startswith('..'):
+        name = os.path.basename(path)
+    jobs = []
+    for label, reference in references:
+        for t, fname in laps:
+            if fname == reference:
+                continue
+            lap = os.path.splitext(os.path.basename(fname))[0]
+            output = os.path.join(out, name, lap + '-' + label + '.html')
+            jobs.append((reference, fname, output, label))
+    return jobs
+
+
+def pair_jobs(fname, out):
+    jobs = []
+    with open(fname) as f:
+        pairs = [l.split() for l in f if l.strip() and not l.startswith('#')]
+    for n, (reference, lap) in enumerate(pairs, 1):
+        jobs.append((reference, lap, os.path.join(out, 'pair-{n}.html'.format(n=n)), 'pair'))
+    return jobs
+
+
+# set in each worker by init_worker
+align = 'distance'
+
+
+def init_worker(cache, how):
+    global align
+    plot.lap_cache = lapcache.LapCache(cache)
+    align = how
+
+
+def load_reference(reference):
+    """ load a reference lap into the cache, returning the seconds it took """
+    start = time.perf_counter()
+    plot.get_lap(reference)
+    return time.perf_counter() - start
+
+
+def render(job):
+    """ render one report, returning its output, size and the seconds it took """
+    reference, lap, output, label = job
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    plot.compare_charts([reference, lap], output=output, align=align, browser=False)
+    return output, os.path.getsize(output), time.perf_counter() - start
+
+
+def write_index(out, jobs, results):
+    rows = []
+    for (reference, lap, output, label), (_, size, seconds) in zip(jobs, results):
+        ref_time, lap_seconds = lap_time(reference), lap_time(lap)
+        delta = '{:+.3f}'.format(lap_seconds - ref_time) if ref_time and lap_seconds else ''
+        rows.append('<tr><td><a href="{href}">{lap}</a></td><td>{time}</td><td>{label}</td><td>{ref}</td><td>{delta}</td>'
+            '<td>{size}</td><td>{seconds:.2f}</td></tr>'.format(
+            href=html.escape(os.path.relpath(output, out)), lap=html.escape(lap), label=label,
+            time='{:.3f}'.format(lap_seconds) if lap_seconds else '', ref=html.escape(reference),
+            delta=delta, size=size, seconds=seconds))
+
+    with open(os.path.join(out, 'index.html'), 'w') as f:
+        f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Sim Telemetry Reports</title></head><body>\n')
+        f.write('<h1>Sim Telemetry Reports</h1>\n<table>\n')
+        f.write('<tr><th>lap</th><th>time</th><th>against</th><th>reference</th><th>delta</th><th>bytes</th><th>render (s)</th></tr>\n')
+        f.write('\n'.join(rows) + '\n</table>\n</body></html>\n')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Batch Telemetry Reports')
+    parser.add_argument('sessions', nargs='*', help='session directories or archives, or directories to find sessions under')
+    parser.add_argument('--pairs', metavar='FILE', help='file of `<reference> <lap>` pairs to compare')
+    parser.add_argument('--out', default='reports', help='output directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--align', choices=['distance', 'track'], default='distance',
+                help='match laps up by distance travelled, or by position along the reference lap')
+    parser.add_argument('--log', default='log', help='log directory to index for the all-time best laps')
+    parser.add_argument('--db', default=catalog.DEFAULT_DB, help='catalog database')
+    parser.add_argument('--cache', default=lapcache.DEFAULT_DIR, help='resampled lap cache directory')
+
+    args = parser.parse_args()
+
+    if not args.sessions and not args.pairs:
+        parser.error('no sessions or pairs given')
+
+    jobs = []
+    if args.sessions:
+        con = catalog.connect(args.db)
+        catalog.update(con, args.log)
+        for source in sessions(args.sessions):
+            jobs.extend(session_jobs(con, source, args.out, args.log))
+    if args.pairs:
+        jobs.extend(pair_jobs(args.pairs, args.out))
+
+    if not jobs:
+        print('nothing to render')
+        raise SystemExit(1)
+
+    os.makedirs(args.out, exist_ok=True)
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args.cache, args.align)) as pool:
+        references = sorted(set(job[0] for job in jobs))
+        loaded = list(pool.map(load_reference, references))
+        print('{n} reference laps loaded in {seconds:.2f}s'.format(n=len(references), seconds=sum(loaded)))
+
+        results = []
+        for job, (output, size, seconds) in zip(jobs, pool.map(render, jobs)):
+            print('{output}: {size} bytes, rendered in {seconds:.2f}s'.format(output=output, size=size, seconds=seconds))
+            results.append((output, size, seconds))
+
+    write_index(args.out, jobs, results)
+
+    elapsed = time.perf_counter() - start
+    print('{n} reports in {elapsed:.2f}s ({cpu:.2f}s rendering) with {workers} workers, index at {index}'.format(
+        n=len(results), elapsed=elapsed, cpu=sum(r[2] for r in results), workers=args.workers,
+        index=os.path.join(args.out, 'index.html')))
@@ -1,91 +1,176 @@
-from bokeh.plotting import figure, output_file, show
+from bokeh.plotting import figure, output_file, show, save
 from bokeh.events import MouseMove
 from bokeh.layouts import column, row
-from bokeh.models import Div, ColumnDataSource, RangeTool, LinearAxis, Range1d, Title, FileInput, CustomJS, HoverTool, Span
-import csv
+from bokeh.palettes import Category10_10, Category20_20
+from bokeh.models import Div, ColumnDataSource, RangeTool, LinearAxis, Range1d, Title, FileInput, CustomJS, HoverTool, Span, DataRange1d
 from datetime import datetime
 import argparse
 import numpy
+import functools
 import math
+import os
+import time
+import archive
+import metrics
+import catalog
+import lapcache
+from trackline import TrackLine
+from lapdata import read_lap, path_distance
 
-def distance(a, b):
-    return math.sqrt( (a[0] - b[0]) **2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2)
 
+def resample(x, xp, fp):
+    """ linearly interpolate every row of fp, sampled at xp, onto x in one pass """
 
+    if len(xp) < 2:
+        return numpy.repeat(fp[:, :1], len(x), axis=1)
+
+    # index of the segment each point falls in, matching numpy.interp
+    hi = numpy.clip(numpy.searchsorted(xp, x, side='right'), 1, len(xp) - 1)
+    lo = hi - 1
+    span = xp[hi] - xp[lo]
+    w = numpy.divide(x - xp[lo], span, out=numpy.zeros(len(x)), where=span > 0)
+    numpy.clip(w, 0, 1, out=w)
+
+    flo = fp[:, lo]
+    return flo + (fp[:, hi] - flo) * w
+
+
+@metrics.timed(metrics.histogram('plot_load_lap_seconds', 'time to load and resample a lap', buckets=metrics.SECONDS))
 def load_lap(file, ilen=0):
 
-    data = {}
-    i = {}
-    last_point = None
-    dt = 0
-    with open(file,'r') as dest_f:
-        reader = csv.reader(dest_f, delimiter='\t')
+    names, values = read_lap(file)
+    data = dict(zip(names, values))
 
-        dist = []
-        headers = next(reader, None)
-        for h in headers:
-            data[h] = []
+    dist = path_distance(data['x'], data['y'], data['z'])
 
-        for row in reader:
+    total_dist = math.ceil(dist[-1])  
 
-            for h, v in zip(headers, row):
-                data[h].append(float(v))
+    # how many interpolation points?  
+    if ilen == 0:
+        ilen =  total_dist
+    
+    i = { 'distance': numpy.arange(ilen) }
 
-            cur_point = (data['x'][-1], data['y'][-1], data['z'][-1])
-            if last_point:
-                # calc the delta
-                dt = dt + distance(last_point, cur_point)
+    # what is the ratio to the total distance of each point?
+    iratio = total_dist / ilen
 
-            dist.append(dt)
-            last_point = cur_point
+    ird = i['distance'] * iratio
+
+    i.update(zip(names, resample(ird, dist, values)))
+
+    return i
 
-        total_dist = math.ceil(dist[-1])  
+# set to a LapCache to reuse resampled laps between charts and runs
+lap_cache = None
 
-        # how many interpolation points?  
-        if ilen == 0:
-            ilen =  total_dist
-        
-        i['distance'] = list(range(ilen))
+def get_lap(file, ilen=0):
+    """ load_lap, through lap_cache if there is one """
+    if lap_cache:
+        return lap_cache.get(file, ilen, load_lap)
+    return load_lap(file, ilen=ilen)
 
-        # what is the ratio to the total distance of each point?
-        iratio = total_dist / ilen
 
-        ird = list(map(lambda x: x * iratio, i['distance']))
+@functools.lru_cache(maxsize=16)
+def track_line(file, mtime_ns):
+    """ the TrackLine of a reference lap, built once for each version of the file """
+    ref = get_lap(file)
+    return TrackLine(ref['x'], ref['y'], ref['z'])
 
-        for d in data:
-            i[d] = numpy.interp(ird, dist, data[d]).tolist()
+
+def align_lap(file, reference):
+    """
+    resample a lap onto the distance points of the reference lap by where each
+    sample is along the reference lap's path, rather than by its own distance
+    travelled, so different lines through a corner stay aligned
+    """
+
+    line = track_line(os.path.abspath(reference), archive.stat(reference).st_mtime_ns)
+
+    names, values = read_lap(file)
+    data = dict(zip(names, values))
+
+    dist = line.lap_distance(data['x'], data['y'], data['z'])
+
+    i = { 'distance': numpy.arange(len(line.distance)) }
+    i.update(zip(names, resample(line.distance, dist, values)))
 
     return i
 
-def invert_data(data):
-    return list(map( lambda x: -x, data))
+
+def get_aligned_lap(file, reference):
+    """ align_lap, through lap_cache if there is one """
+    if lap_cache:
+        return lap_cache.get(file, 0, align_lap, reference=reference)
+    return align_lap(file, reference)
+
+
+def invert_data(data, out=None):
+    return numpy.negative(data, out=out)
+
+
+def compare_laps(files, channels=None, align='distance'):
+    """
+    resample every lap onto the distance grid of the first (reference) lap, as one
+    2D array per channel with a row per lap, and the time delta of every lap to the
+    reference as 'delta'.  Laps are matched up by the distance they travelled, or
+    with align='track' by their position along the reference lap's path
+    """
+
+    ref = get_lap(files[0])
+    ilen = len(ref['distance'])
+    if align == 'track':
+        laps = [ref] + [get_aligned_lap(f, files[0]) for f in files[1:]]
+    else:
+        laps = [ref] + [get_lap(f, ilen=ilen) for f in files[1:]]
+
+    if channels is None:
+        channels = [c for c in ref if c != 'distance' and all(c in lap for lap in laps)]
+
+    data = { c: numpy.vstack([lap[c] for lap in laps]) for c in channels }
+    data['distance'] = ref['distance']
+    data['delta'] = data['lapTime'] - data['lapTime'][0]
+
+    return data
+
+
+def lap_time(t):
+    return datetime.fromtimestamp(t).strftime('%M:%S:%f')[:-3]
+
+
+def lap_colors(n):
+    """ the reference lap in green and the compare lap in blue, or a palette colour per lap """
+    if n <= 2:
+        return ['green', 'blue']
+    return (Category10_10 if n <= 10 else Category20_20) * (n // 20 + 1)
 
 
-def combined_charts(file1, file2, output='plot.html', plot_width=1000, plot_height=600):
+def lap_columns(laps, traces):
+    """
+    ColumnDataSource data with a `<name><n>` column per trace and lap, numbered from 1.
+    The columns are float32 (int32 for the distance), which bokeh embeds in the page
+    as binary rather than as a JSON list of numbers
+    """
 
-    data1 = load_lap(file1)
-    ilen = len(data1['distance'])
+    data = { 'distance': laps['distance'].astype(numpy.int32) }
+    for name, channel in traces:
+        values = laps[channel].astype(numpy.float32)
+        if name == 'z':
+            invert_data(values, out=values)
+        for n, v in enumerate(values, 1):
+            data[name + str(n)] = v
+    for n, v in enumerate(laps['delta'][1:].astype(numpy.float32), 2):
+        data['delta' + str(n)] = v
+    return data
 
-    data2 = load_lap(file2, ilen=ilen)
 
-    delta = []
-    for i,j in zip(data1['lapTime'],data2['lapTime']):
-        delta.append(float(j) - float(i))
+@metrics.timed(metrics.histogram('plot_render_seconds', 'time to build and write a page', buckets=metrics.SECONDS))
+def combined_charts(file1, file2, output='plot.html', plot_width=1000, plot_height=600, align='distance', browser=True):
 
-    data = {
-        'distance': data1['distance'],
-        'mph1': data1['speed_Mph'],
-        'mph2': data2['speed_Mph'],
-        'gas1': data1['gas'],
-        'gas2': data2['gas'],
-        'brake1': data1['brake'],
-        'brake2': data2['brake'],
-        'delta': delta,
-        'x1': data1['x'],
-        'z1': invert_data(data1['z']),
-        'x2': data2['x'],
-        'z2': invert_data(data2['z'])
-    }
+    laps = compare_laps([file1, file2], ['lapTime', 'speed_Mph', 'gas', 'brake', 'x', 'z'], align=align)
+    ilen = len(laps['distance'])
+
+    data = lap_columns(laps, [('mph', 'speed_Mph'), ('gas', 'gas'), ('brake', 'brake'), ('x', 'x'), ('z', 'z')])
+    data['delta'] = data.pop('delta2')
 
     # calculate a starting range
     range_start=int(ilen * 0.25)
@@ -101,10 +186,10 @@ def combined_charts(file1, file2, output='plot.html', plot_width=1000, plot_heig
     ))
 
     pos_source = ColumnDataSource(data=dict(
-        x1=[ data['x1'][range_mid] ],
-        z1=[ data['z1'][range_mid] ],
-        x2=[ data['x2'][range_mid] ],
-        z2=[ data['z2'][range_mid] ],
+        x1=data['x1'][range_mid:range_mid + 1],
+        z1=data['z1'][range_mid:range_mid + 1],
+        x2=data['x2'][range_mid:range_mid + 1],
+        z2=data['z2'][range_mid:range_mid + 1],
     ))
 
     source = ColumnDataSource(data=data)
@@ -119,8 +204,7 @@ def combined_charts(file1, file2, output='plot.html', plot_width=1000, plot_heig
         tools='xpan', x_axis_label='distance', y_axis_label='mph',
             x_range=(range_start, range_end))
 
-    lap1time = datetime.fromtimestamp(data1['lapTime'][-1]).strftime('%M:%S:%f')[:-3]
-    lap2time = datetime.fromtimestamp(data2['lapTime'][-1]).strftime('%M:%S:%f')[:-3]
+    lap1time, lap2time = [lap_time(t) for t in laps['lapTime'][:, -1]]
 
     p.add_layout(Title(text="(2) " + lap2time + ' | ' + file2, text_font_style="normal"), 'above')
     p.add_layout(Title(text="(1) " + lap1time + ' | ' + file1, text_font_style="bold"), 'above')
@@ -243,36 +327,103 @@ def combined_charts(file1, file2, output='plot.html', plot_width=1000, plot_heig
     row1.sizing_mode = 'stretch_width'
     col = column(row1, select)
     col.sizing_mode = 'stretch_width'
-    show(col)
-
-
-def split_charts(file1, file2, output='plot.html', plot_width=1000, plot_height=600):
-
-    data1 = load_lap(file1)
-    ilen = len(data1['distance'])
-
-    data2 = load_lap(file2, ilen=ilen)
-
-    delta = []
-    for i,j in zip(data1['lapTime'],data2['lapTime']):
-        delta.append(float(j) - float(i))
-
-    data = {
-        'distance': data1['distance'],
-        'mph1': data1['speed_Mph'],
-        'mph2': data2['speed_Mph'],
-        'gas1': data1['gas'],
-        'gas2': data2['gas'],
-        'brake1': data1['brake'],
-        'brake2': data2['brake'],
-        'steer1': data1['steer'],
-        'steer2': data2['steer'],
-        'delta': delta,
-        'x1': data1['x'],
-        'z1': invert_data(data1['z']),
-        'x2': data2['x'],
-        'z2': invert_data(data2['z'])
-    }
+    if browser:
+        show(col)
+    else:
+        save(col)
+
+
+def minmax_levels(data, max_points):
+    """
+    decimate the columns of data into levels with buckets of 4, 8, 16 ... samples,
+    halving the rows at each level until there are no more than max_points.  Each
+    bucket keeps its min and max, in the order they happened, so peaks such as
+    braking points survive at every level.  Level 0 is data itself
+    """
+
+    levels = [data]
+    dist = data['distance']
+    n = len(dist)
+    b = 4
+
+    while len(levels[-1]['distance']) > max_points and b < n:
+        nb = -(-n // b)
+        pad = nb * b - n
+
+        # both points of a bucket share the x of its first and middle samples
+        x = numpy.pad(dist, (0, pad), mode='edge').reshape(nb, b)
+        level = { 'distance': numpy.column_stack([x[:, 0], x[:, b // 2]]).ravel() }
+
+        for name, values in data.items():
+            if name == 'distance':
+                continue
+            v = numpy.pad(values, (0, pad), mode='edge').reshape(nb, b)
+            imin = v.argmin(axis=1)
+            imax = v.argmax(axis=1)
+            lo = numpy.take_along_axis(v, imin[:, None], axis=1)[:, 0]
+            hi = numpy.take_along_axis(v, imax[:, None], axis=1)[:, 0]
+            min_first = imin <= imax
+            level[name] = numpy.column_stack([
+                numpy.where(min_first, lo, hi), numpy.where(min_first, hi, lo)
+            ]).ravel()
+
+        levels.append(level)
+        b = b * 2
+
+    return levels
+
+
+def fixed_range(values):
+    """ a y range over all of the values, as bokeh would pad it, that does not follow the sliced traces """
+    lo, hi = float(numpy.nanmin(values)), float(numpy.nanmax(values))
+    pad = (hi - lo) * 0.05 or 0.5
+    return DataRange1d(start=lo - pad, end=hi + pad)
+
+
+def lod_level(span, max_points, nlevels):
+    """ the finest level that draws no more than max_points over span samples, as in lod_update """
+    if span <= max_points:
+        return 0
+    return min(nlevels - 1, math.ceil(math.log2(span / max_points)))
+
+
+def lod_slice(level, start, end):
+    """ the rows of a level from start to end, with a row either side to reach the edges """
+    dist = level['distance']
+    lo = max(0, numpy.searchsorted(dist, start, side='right') - 1)
+    hi = numpy.searchsorted(dist, end, side='left') + 1
+    return { name: values[lo:hi] for name, values in level.items() }
+
+
+def split_charts(file1, file2, output='plot.html', plot_width=1000, plot_height=600, align='distance', browser=True):
+    compare_charts([file1, file2], output=output, plot_width=plot_width, plot_height=plot_height, align=align,
+        browser=browser)
+
+
+@metrics.timed(metrics.histogram('plot_render_seconds', 'time to build and write a page', buckets=metrics.SECONDS))
+def compare_charts(files, output='plot.html', plot_width=1000, plot_height=600, align='distance', max_points=2000,
+        browser=True):
+    """
+    split charts of any number of laps, against the first.  The traces and the delta
+    overview draw at most about max_points points per line, from levels of min/max
+    decimated data that get finer as the selected range narrows.  The page is opened
+    in a browser, or with browser=False only saved
+    """
+
+    traces = [
+        ('mph', 'speed_Mph', '#1f77b4'),
+        ('gas', 'gas', 'green'),
+        ('brake', 'brake', 'red'),
+        ('steer', 'steer', 'orange'),
+    ]
+
+    laps = compare_laps(files, ['lapTime', 'speed_Mph', 'gas', 'brake', 'steer', 'x', 'z'], align=align)
+    nlaps = len(files)
+    ilen = len(laps['distance'])
+    numbers = [str(n) for n in range(1, nlaps + 1)]
+    colors = lap_colors(nlaps)
+
+    data = lap_columns(laps, [(name, channel) for name, channel, _ in traces] + [('x', 'x'), ('z', 'z')])
 
     # calculate a starting range
     range_start=int(ilen * 0.25)
@@ -280,108 +431,59 @@ def split_charts(file1, file2, output='plot.html', plot_width=1000, plot_height=
     range_mid = int( (range_end - range_start) / 2 + range_start  )
 
     # some initial data for the track, using the range determined above
-    track_source = ColumnDataSource(data=dict(
-        x1=data['x1'][range_start:range_end], 
-        z1=data['z1'][range_start:range_end], 
-        x2=data['x2'][range_start:range_end],
-        z2=data['z2'][range_start:range_end]
-    ))
+    track_source = ColumnDataSource(data={
+        c + n: data[c + n][range_start:range_end] for n in numbers for c in ('x', 'z')
+    })
 
-    pos_source = ColumnDataSource(data=dict(
-        x1=[ data['x1'][range_mid] ],
-        z1=[ data['z1'][range_mid] ],
-        x2=[ data['x2'][range_mid] ],
-        z2=[ data['z2'][range_mid] ],
-    ))
+    pos_source = ColumnDataSource(data={
+        c + n: data[c + n][range_mid:range_mid + 1] for n in numbers for c in ('x', 'z')
+    })
 
     source = ColumnDataSource(data=data)
 
+    # the decimated levels of the traces, the current one sliced to the selected range
+    trace_columns = ['distance'] + [c for c in data if c[0] not in 'xz']
+    levels = minmax_levels({ c: data[c] for c in trace_columns }, max_points)
+    level_sources = [ColumnDataSource(data=level) for level in levels[1:]]
+    level = lod_level(range_end - range_start, max_points, len(levels))
+    view_source = ColumnDataSource(data=lod_slice(levels[level], range_start, range_end))
+
     # output to static HTML file
     output_file(output, title='AC Telemetry')
 
     trace_height = int(plot_height/4)
 
-    # main plot showing the telemetry
-    fig_mph = figure(
-        plot_height=trace_height, plot_width=int(plot_width * .6),
-        toolbar_location=None,
-        tools='xpan', x_axis_label='distance', y_axis_label='mph',
-            x_range=(range_start, range_end))
-
-    lap1time = datetime.fromtimestamp(data1['lapTime'][-1]).strftime('%M:%S:%f')[:-3]
-    lap2time = datetime.fromtimestamp(data2['lapTime'][-1]).strftime('%M:%S:%f')[:-3]
-
-
-    # add all the telemetry lines
-    fig_mph.line('distance', 'mph1', name='mph1', muted_alpha=0.2, source=source, legend_label="lap1", line_width=2)
-    fig_mph.line('distance', 'mph2', name='mph2', muted_alpha=0.2, source=source, legend_label="lap2", line_width=2, line_dash='dashed')
-    fig_mph.legend.location = "top_left"
-    fig_mph.legend.click_policy="mute"
-
-    mph_hover_tool = HoverTool(
-        tooltips = [('mph1', '@mph1{0.00 a}'), ('mph2', '@mph2{0.00 a}'),('delta', '@delta{0.00 a}')],
-        mode = 'vline',
-        names=['mph1']
-    )
-    fig_mph.add_tools(mph_hover_tool)
-
-    # main plot showing the telemetry
-    fig_gas = figure(
-        plot_height=trace_height, plot_width=int(plot_width * .6),
-        toolbar_location=None,
-        tools='xpan', x_axis_label='distance', y_axis_label='gas',
-            x_range=fig_mph.x_range)
-    fig_gas.line('distance', 'gas1', name='gas1', muted_alpha=0.2, source=source, color='green', legend_label="lap1", line_width=2)
-    fig_gas.line('distance', 'gas2', name='gas2', muted_alpha=0.2, source=source, color='green', legend_label="lap2", line_width=2, line_dash='dashed')
-    fig_gas.legend.location = "top_left"
-    fig_gas.legend.click_policy="mute"
-
-    gas_hover_tool = HoverTool(
-        tooltips = [('gas1', '@gas1{0.00 a}'), ('gas2', '@gas2{0.00 a}'),('delta', '@delta{0.00 a}')],
-        mode = 'vline',
-        names=['gas1']
-    )
-    fig_gas.add_tools(gas_hover_tool)
-
-    # main plot showing the telemetry
-    fig_brake = figure(
-        plot_height=trace_height, plot_width=int(plot_width * .6),
-        toolbar_location=None,
-        tools='xpan', x_axis_label='distance', y_axis_label='brake',
-            x_range=fig_mph.x_range)
-    fig_brake.line('distance', 'brake1', name='brake1', muted_alpha=0.2, source=source, color='red', legend_label="lap1", line_width=2)
-    fig_brake.line('distance', 'brake2', name='brake2', muted_alpha=0.2, source=source, color='red', legend_label="lap2", line_width=2, line_dash='dashed')
-    fig_brake.legend.location = "top_left"
-    fig_brake.legend.click_policy="mute"
-
-    brake_hover_tool = HoverTool(
-        tooltips = [('brake1', '@brake1{0.00 a}'), ('brake2', '@brake2{0.00 a}'),('delta', '@delta{0.00 a}')],
-        mode = 'vline',
-        names=['brake1']
-    )
-    fig_brake.add_tools(brake_hover_tool)
-
-    # main plot showing the telemetry
-    fig_steer = figure(
-        plot_height=trace_height, plot_width=int(plot_width * .6),
-        toolbar_location=None,
-        tools='xpan', x_axis_label='distance', y_axis_label='steer',
-            x_range=fig_mph.x_range)
-    fig_steer.line('distance', 'steer1', name='steer1', muted_alpha=0.2, source=source, color='orange', legend_label="lap1", line_width=2)
-    fig_steer.line('distance', 'steer2', name='steer2', muted_alpha=0.2, source=source, color='orange', legend_label="lap2", line_width=2, line_dash='dashed')
-    fig_steer.legend.location = "top_left"
-    fig_steer.legend.click_policy="mute"
+    figs = []
+    for name, channel, color in traces:
+        fig = figure(
+            plot_height=trace_height, plot_width=int(plot_width * .6),
+            toolbar_location=None,
+            tools='xpan', x_axis_label='distance', y_axis_label=name,
+                x_range=figs[0].x_range if figs else (range_start, range_end),
+                y_range=fixed_range(laps[channel]))
+
+        # the reference lap solid, the others dashed and, when there are many, in their own colours
+        for n in numbers:
+            fig.line('distance', name + n, name=name + n, muted_alpha=0.2, source=view_source,
+                color=color if nlaps <= 2 else colors[int(n) - 1], legend_label='lap' + n, line_width=2,
+                line_dash='solid' if n == '1' else 'dashed')
+        fig.legend.location = "top_left"
+        fig.legend.click_policy="mute"
+
+        hover_tool = HoverTool(
+            tooltips = [(name + n, '@' + name + n + '{0.00 a}') for n in numbers] +
+                [('delta' + n, '@delta' + n + '{0.00 a}') for n in numbers[1:]],
+            mode = 'vline',
+            names=[name + '1']
+        )
+        fig.add_tools(hover_tool)
+        figs.append(fig)
+
+    fig_steer = figs[-1]
     fig_steer.y_range.flipped = True
 
-    steer_hover_tool = HoverTool(
-        tooltips = [('steer1', '@steer1{0.00 a}'), ('steer2', '@steer2{0.00 a}'),('delta', '@delta{0.00 a}')],
-        mode = 'vline',
-        names=['steer1']
-    )
-    fig_steer.add_tools(steer_hover_tool)
-
     # zoom plot used to narrow down the other plots
-    # shows the delta from lap1 to lap2
+    # shows the delta from lap1 to every other lap
     select = figure(title="Drag the middle and edges of the selection box to change the range above",
                     plot_height=130, plot_width=plot_width,
                     x_axis_type=None, y_axis_label='delta (s)',
@@ -392,55 +494,52 @@ def split_charts(file1, file2, output='plot.html', plot_width=1000, plot_height=
     # would be visible with the range currently set
     track = figure(title='Track', plot_width=int(plot_width * .4), plot_height=plot_height, 
         tools='', toolbar_location=None, x_axis_label='meters', y_axis_label='meters')
-    track.line('x1', 'z1', source=track_source, line_width=2, muted_alpha=0.2, legend_label='lap1', color='green')
-    track.line('x2', 'z2', source=track_source, line_width=2, muted_alpha=0.2, legend_label='lap2', color='blue', line_dash='dashed')
-    track.circle_cross('x1', 'z1', source=pos_source, size=20, color='green', alpha=0.2)
-    track.circle_cross('x2', 'z2', source=pos_source, size=20, color='blue', alpha=0.2)
+    for n, color in zip(numbers, colors):
+        track.line('x' + n, 'z' + n, source=track_source, line_width=2, muted_alpha=0.2, legend_label='lap' + n,
+            color=color, line_dash='solid' if n == '1' else 'dashed')
+        track.circle_cross('x' + n, 'z' + n, source=pos_source, size=20, color=color, alpha=0.2)
     track.legend.location = "top_left"
     track.legend.click_policy="mute"
     # make sure the units are kept the same on x,z
     track.match_aspect = True
 
     # this is the little block that shows the current range
-    range_tool = RangeTool(x_range=fig_mph.x_range)
+    range_tool = RangeTool(x_range=figs[0].x_range)
     range_tool.overlay.fill_color = "navy"
     range_tool.overlay.fill_alpha = .2
 
-    # the range selection uses a plot of the delta
-    select.line('distance', 'delta', source=source)
+    # the range selection uses a plot of the deltas
+    for n in numbers[1:]:
+        select.line('distance', 'delta' + n, source=level_sources[-1] if level_sources else source, color=colors[int(n) - 1] if nlaps > 2 else '#1f77b4')
     select.add_tools(range_tool)
     select.toolbar.active_multi = range_tool
 
     mid_span = Span(location=range_mid, dimension='height', line_dash='solid', 
         line_color='black', line_width=3, line_alpha=0.2)
-    fig_mph.add_layout(mid_span)
-    fig_gas.add_layout(mid_span)
-    fig_brake.add_layout(mid_span)
-    fig_steer.add_layout(mid_span)
+    for fig in figs:
+        fig.add_layout(mid_span)
     select.add_layout(mid_span)
 
-    hover_update = CustomJS(args=dict(src=source, pos_source=pos_source, mid_span=mid_span), code= """
+    hover_update = CustomJS(args=dict(src=source, pos_source=pos_source, mid_span=mid_span, laps=nlaps), code= """
         var s = src.data
         var p = pos_source.data
         var mid = Math.floor(cb_obj.x)
 
         mid_span.location = mid
 
-        p['x1'][0] = s['x1'][mid]
-        p['z1'][0] = s['z1'][mid]
-        p['x2'][0] = s['x2'][mid]
-        p['z2'][0] = s['z2'][mid]
+        for (let n = 1; n <= laps; n++) {
+            p['x' + n][0] = s['x' + n][mid]
+            p['z' + n][0] = s['z' + n][mid]
+        }
 
         pos_source.change.emit()
     """)
 
-    fig_mph.js_on_event(MouseMove, hover_update)
-    fig_gas.js_on_event(MouseMove, hover_update)
-    fig_brake.js_on_event(MouseMove, hover_update)
-    fig_steer.js_on_event(MouseMove, hover_update)
+    for fig in figs:
+        fig.js_on_event(MouseMove, hover_update)
 
     # when the range changes, update the track points we are plotting
-    trk_update = CustomJS(args=dict(src=source, dst=track_source, mid_span=mid_span, pos_source=pos_source), code= """
+    trk_update = CustomJS(args=dict(src=source, dst=track_source, mid_span=mid_span, pos_source=pos_source, laps=nlaps), code= """
         var s = src.data
         var d = dst.data
         var p = pos_source.data
@@ -450,40 +549,65 @@ def split_charts(file1, file2, output='plot.html', plot_width=1000, plot_height=
 
         mid_span.location = mid
 
-        p['x1'][0] = s['x1'][mid]
-        p['z1'][0] = s['z1'][mid]
-        p['x2'][0] = s['x2'][mid]
-        p['z2'][0] = s['z2'][mid]
+        for (let n = 1; n <= laps; n++) {
+            p['x' + n][0] = s['x' + n][mid]
+            p['z' + n][0] = s['z' + n][mid]
+            d['x' + n] = s['x' + n].slice(start, end)
+            d['z' + n] = s['z' + n].slice(start, end)
+        }
 
-        d['x1'] = s['x1'].slice(start, end)
-        d['z1'] = s['z1'].slice(start, end)
-        d['x2'] = s['x2'].slice(start, end)
-        d['z2'] = s['z2'].slice(start, end)
         dst.change.emit()
         pos_source.change.emit()
     """)
 
-    fig_mph.x_range.js_on_change('start', trk_update) 
-    fig_mph.x_range.js_on_change('end', trk_update) 
+    figs[0].x_range.js_on_change('start', trk_update) 
+    figs[0].x_range.js_on_change('end', trk_update) 
+
+    # when the range changes, switch the traces to the finest level that keeps
+    # them within max_points, sliced to the range
+    lod_update = CustomJS(args=dict(src=source, levels=level_sources, view=view_source, max_points=max_points), code= """
+        const span = cb_obj.end - cb_obj.start
+        const k = span <= max_points ? 0 : Math.min(levels.length, Math.ceil(Math.log2(span / max_points)))
+        const s = k == 0 ? src.data : levels[k - 1].data
+        const dist = s['distance']
+
+        // the rows in range, and one either side to reach the edges
+        let lo = 0, hi = dist.length
+        while (lo < hi) {
+            const m = (lo + hi) >> 1
+            if (dist[m] <= cb_obj.start) lo = m + 1; else hi = m
+        }
+        const start = Math.max(0, lo - 1)
+        lo = start, hi = dist.length
+        while (lo < hi) {
+            const m = (lo + hi) >> 1
+            if (dist[m] < cb_obj.end) lo = m + 1; else hi = m
+        }
+        const end = lo + 1
+
+        const d = {}
+        for (const name of Object.keys(view.data)) {
+            d[name] = s[name].slice(start, end)
+        }
+        view.data = d
+    """)
+
+    figs[0].x_range.js_on_change('start', lod_update)
+    figs[0].x_range.js_on_change('end', lod_update)
 
     # allow dynamic sizing
-    fig_mph.sizing_mode = 'stretch_width'
-    fig_gas.sizing_mode = 'stretch_width'
-    fig_brake.sizing_mode = 'stretch_width'
-    fig_steer.sizing_mode = 'stretch_width'
-    #p.width_policy = 'max'
-    #track.sizing_mode = 'stretch_width'
-    #track.width_policy = 'min'
+    for fig in figs:
+        fig.sizing_mode = 'stretch_width'
     select.sizing_mode = 'stretch_width'
     # display the charts
-    trace_col = column(fig_mph, fig_gas, fig_brake, fig_steer)
+    trace_col = column(*figs)
     trace_col.sizing_mode = 'stretch_width'
     row1 = row(trace_col, track)
     row1.sizing_mode = 'stretch_width'
-    subtitle =  column(
-        Div(text='<strong>(1) ' + lap1time + '</strong> | ' + file1),
-        Div(text="<strong>(2) " + lap2time + '</strong> | ' + file2)
-    )
+    subtitle =  column(*[
+        Div(text='<strong>(' + n + ') ' + lap_time(t) + '</strong> | ' + f)
+        for n, t, f in zip(numbers, laps['lapTime'][:, -1], files)
+    ])
     subtitle.sizing_mode = 'stretch_width'
     title = row( 
         Div(text='<h1 style="margin:0;">Sim Telemetry</h1>'),
@@ -492,19 +616,49 @@ def split_charts(file1, file2, output='plot.html', plot_width=1000, plot_height=
     title.sizing_mode = 'stretch_width'
     col = column(title, row1, select)
     col.sizing_mode = 'stretch_width'
-    show(col)
+    if browser:
+        show(col)
+    else:
+        save(col)
 
 
 if __name__ == '__main__':
 
 
     parser = argparse.ArgumentParser(description='Raw Telemetry Plotter')
-    parser.add_argument('lap1', nargs='?', help='reference lap file')
-    parser.add_argument('lap2', nargs='?', help='compare lap file')  
-    parser.add_argument('out', nargs='?', default='plot.html', help='output filename')
+    parser.add_argument('laps', nargs='+', metavar='lap',
+                help='lap files, or catalog queries like fastest:<track>/<car>/2, the first is the reference lap.  '
+                    'A last argument ending .html is the output filename')
+    parser.add_argument('--out', default='plot.html', help='output filename')
+    parser.add_argument('--align', choices=['distance', 'track'], default='distance',
+                help='match laps up by distance travelled, or by position along the reference lap')
+    parser.add_argument('--db', default=catalog.DEFAULT_DB, help='catalog database for lap queries')
+    parser.add_argument('--cache', default=lapcache.DEFAULT_DIR, help='resampled lap cache directory')
+    parser.add_argument('--cache-size', type=int, default=1024, help='resampled lap cache size cap in MB')
+    parser.add_argument('--no-cache', action='store_true', help='always load and resample the laps')
+    parser.add_argument('--metrics-file', metavar='FILE', help='write the load and render times as Prometheus metrics')
 
     args = parser.parse_args()
 
-    print(args.out)
+    if not args.no_cache:
+        lap_cache = lapcache.LapCache(args.cache, disk_bytes=args.cache_size * 1024 * 1024)
+
+    # the output file is the last positional argument, if it is a page
+    if args.laps[-1].endswith('.html'):
+        args.out = args.laps.pop()
+    if len(args.laps) < 2:
+        parser.error('at least two laps are needed')
+
+    laps = [catalog.resolve(lap, args.db) for lap in args.laps]
+
+    start = time.perf_counter()
+    compare_charts(laps, output=args.out, align=args.align)
+
+    print('{out}: {size} bytes, rendered in {seconds:.2f}s'.format(
+        out=args.out, size=os.path.getsize(args.out), seconds=time.perf_counter() - start))
+
+    if lap_cache:
+        print(lap_cache)
 
-    split_charts(args.lap1, args.lap2, output=args.out)
\ No newline at end of file
+    if args.metrics_file:
+        metrics.REGISTRY.write(args.metrics_file)
\ No newline at end of file
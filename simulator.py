@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+Local stand-ins for AC and GT7 telemetry
+
+Serves synthetic laps over the same UDP protocols as the games, so the
+loggers can be exercised and load tested without a console:
+
+    python simulator.py ac --rate 333
+    python logger-ac.py 127.0.0.1
+
+    python simulator.py gt7 --rate 60
+    python logger-gt7.py 127.0.0.1
+
+The AC server answers handshake, subscribe and dismiss commands and sends
+RTCarInfo updates to every subscriber.  The GT7 server sends encrypted
+packets to every address that has sent a heartbeat recently.  Both support
+any number of clients and report what they have sent, to compare against
+what the loggers received.
+"""
+
+from socket import *
+from select import select
+import argparse
+import math
+import random
+import struct
+import threading
+import time
+import os
+import numpy
+
+import ac
+import gt7
+
+
+class SyntheticCar:
+    """
+    drives laps of a closed loop with a few corners, slowing for each one
+    and varying a little from lap to lap
+    """
+
+    def __init__(self, length=4000.0, corners=8, top_speed=70.0, corner_speed=25.0, seed=0):
+        self.length = length
+        self.corners = corners
+        self.top_speed = top_speed
+        self.corner_speed = corner_speed
+        self.random = random.Random(seed)
+
+        self.s = 0.0
+        self.lapTime = 0.0
+        self.lastLap = 0.0
+        self.bestLap = 0.0
+        self.lapCount = 0
+        self.pace = 1.0
+        self.update(0.0)
+
+    def update(self, dt):
+        """ advance the car by dt seconds """
+
+        self.s = self.s + self.speed() * dt
+        self.lapTime = self.lapTime + dt
+
+        if self.s >= self.length:
+            self.s = self.s - self.length
+            self.lapCount = self.lapCount + 1
+            self.lastLap = self.lapTime
+            self.bestLap = min(self.bestLap or self.lastLap, self.lastLap)
+            self.lapTime = 0.0
+            self.pace = self.random.uniform(0.97, 1.03)
+
+        theta = 2 * math.pi * self.s / self.length
+        phase = self.corners * theta
+
+        # tighter radius through the corners
+        r = self.length / (2 * math.pi) * (1 + 0.15 * math.cos(phase))
+        self.x = r * math.cos(theta)
+        self.y = 5 * math.sin(theta)
+        self.z = r * math.sin(theta)
+
+        # accelerating out of a corner, braking into the next
+        closing = math.sin(phase)
+        self.gas = 1.0 if closing > -0.3 else 0.0
+        self.brake = min(1.0, -closing - 0.3) if closing < -0.3 else 0.0
+        self.steer = 90 * math.cos(phase) * (1 - self.speed() / self.top_speed)
+        self.gear = 2 + int(4 * self.speed() / self.top_speed)
+        self.rpm = 3000 + 5000 * (self.speed() / self.top_speed)
+
+    def speed(self):
+        """ speed in m/s at the current position """
+        phase = self.corners * 2 * math.pi * self.s / self.length
+        dip = 0.5 + 0.5 * math.cos(phase)
+        return self.pace * (self.top_speed - (self.top_speed - self.corner_speed) * dip)
+
+
+def ac_handshake(carName='ks_corvette_c7r', driverName='Simulator', trackName='imola', trackConfig='imola'):
+    """ the handshake response, with the names padded out with '%' as AC does """
+    return struct.pack(ac.Handshake.fmt,
+        *[(n + '%' * 50).encode('utf-16-le')[:100] if isinstance(n, str) else n
+            for n in [carName, driverName, 1, 1, trackName, trackConfig]])
+
+
+def ac_packet(car):
+    """ an RTCarInfo update for the car's current state """
+    speed = car.speed()
+    return ac.default_decoder.struct.pack(speed * 3.6, speed * 2.23694,
+        int(car.lapTime * 1000), int(car.lastLap * 1000), int(car.bestLap * 1000), car.lapCount,
+        car.gas, car.brake, 0.0, car.rpm, car.steer, car.gear, car.x, car.y, car.z)
+
+
+gt7_plain = numpy.zeros((), dtype=gt7.PacketDecoder().dtype)
+
+
+def gt7_packet(car, tick, rate=60, seed=None):
+    """ an encrypted GT7 packet for the car's current state, at `tick` of a `rate` per second stream """
+    p = gt7_plain
+    p['POSITION'] = (car.x, car.y, car.z)
+    p['SPEED'] = car.speed()
+    p['RPM'] = car.rpm
+    p['TICK'] = tick
+    p['LAPS'] = (car.lapCount + 1, 0)
+    p['LAST_LAPTIME'] = int(car.lastLap * 1000) or -1
+    p['BEST_LAPTIME'] = int(car.bestLap * 1000) or -1
+    p['DAYTIME_PROGRESSION'] = int(tick * 1000 / rate)
+    p['THROTTLE'] = int(car.gas * 255)
+    p['BRAKE'] = int(car.brake * 255)
+    p['GEAR'] = car.gear
+    data = bytearray(p.tobytes())
+    struct.pack_into('<I', data, 0, gt7.MAGIC)
+    if seed is None:
+        seed = int.from_bytes(os.urandom(4), 'little')
+    return gt7.salsa20_enc(data, seed)
+
+
+class SimServer(threading.Thread):
+    """ sends a packet to every client at `rate` per second, handling requests in between """
+
+    def __init__(self, host, port, rate, car=None):
+        super(SimServer, self).__init__()
+        self.daemon = True
+        self.rate = rate
+        self.car = car or SyntheticCar()
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.setblocking(0)
+        self.clients = {}
+        self.sent = {}
+        self.ticks = 0
+        self.late = 0
+
+    def run(self):
+
+        self.running = True
+        interval = 1 / self.rate
+        next_tick = time.monotonic()
+
+        while self.running:
+
+            ready = select([self.socket], [], [], max(0, next_tick - time.monotonic()))
+            if ready[0]:
+                try:
+                    while True:
+                        data, addr = self.socket.recvfrom(4096)
+                        self.request(data, addr)
+                except (BlockingIOError, ConnectionResetError):
+                    pass
+
+            now = time.monotonic()
+            if now < next_tick:
+                continue
+
+            self.car.update(interval)
+            self.ticks = self.ticks + 1
+            for addr in self.active(now):
+                try:
+                    self.socket.sendto(self.packet(addr), addr)
+                    self.sent[addr] = self.sent.get(addr, 0) + 1
+                except OSError:
+                    pass
+
+            next_tick = next_tick + interval
+            if now - next_tick > 1:
+                # can't keep up, so stop trying to catch up
+                self.late = self.late + int((now - next_tick) / interval)
+                next_tick = now
+
+        self.socket.close()
+
+    def stop(self):
+        self.running = False
+
+    def status(self):
+        clients = ', '.join('{ip}:{port} {n}'.format(ip=a[0], port=a[1], n=n) for a, n in self.sent.items())
+        return 'ticks: {ticks}, late: {late}, sent: [{clients}]'.format(ticks=self.ticks, late=self.late, clients=clients)
+
+
+class ACServer(SimServer):
+
+    command = struct.Struct('iii')
+
+    def __init__(self, host='127.0.0.1', port=9996, rate=333, car=None,
+            carName='ks_corvette_c7r', driverName='Simulator', trackName='imola', trackConfig='imola'):
+        super(ACServer, self).__init__(host, port, rate, car)
+        self.handshake = ac_handshake(carName, driverName, trackName, trackConfig)
+
+    def request(self, data, addr):
+        if len(data) != self.command.size:
+            return
+        identifier, version, operation = self.command.unpack(data)
+        if operation == ac.HANDSHAKE:
+            self.socket.sendto(self.handshake, addr)
+        elif operation == ac.SUBSCRIBE_UPDATE:
+            self.clients[addr] = True
+        elif operation == ac.DISMISS:
+            self.clients.pop(addr, None)
+
+    def active(self, now):
+        return list(self.clients)
+
+    def packet(self, addr):
+        return ac_packet(self.car)
+
+
+class GT7Server(SimServer):
+
+    def __init__(self, host='127.0.0.1', port=gt7.SendPort, rate=60, car=None, heartbeat_timeout=5.0):
+        super(GT7Server, self).__init__(host, port, rate, car)
+        self.heartbeat_timeout = heartbeat_timeout
+
+    def request(self, data, addr):
+        # any datagram counts as a heartbeat, the console replies to its source
+        self.clients[addr] = time.monotonic()
+
+    def active(self, now):
+        return [a for a, t in self.clients.items() if now - t < self.heartbeat_timeout]
+
+    def packet(self, addr):
+        return gt7_packet(self.car, self.ticks, self.rate)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='AC and GT7 telemetry simulator')
+    parser.add_argument('game', choices=['ac', 'gt7'], help='protocol to serve')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, help='port to listen on, defaults to the game\'s')
+    parser.add_argument('--rate', type=float, help='packets per second per client, defaults to the game\'s')
+    parser.add_argument('--length', type=float, default=4000.0, help='lap length in meters')
+    parser.add_argument('--duration', type=float, help='stop after this many seconds')
+
+    args = parser.parse_args()
+
+    car = SyntheticCar(length=args.length)
+    if args.game == 'ac':
+        server = ACServer(args.host, args.port or 9996, args.rate or 333, car)
+    else:
+        server = GT7Server(args.host, args.port or gt7.SendPort, args.rate or 60, car)
+
+    server.start()
+    print('serving {game} on {host}:{port}'.format(game=args.game, host=args.host,
+        port=server.socket.getsockname()[1]))
+
+    start = time.monotonic()
+    try:
+        while server.is_alive():
+            time.sleep(5)
+            print(server.status())
+            if args.duration and time.monotonic() - start > args.duration:
+                break
+    except KeyboardInterrupt:
+        print('stopping')
+
+    server.stop()
+    server.join()
+    print(server.status())
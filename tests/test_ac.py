@@ -0,0 +1,53 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ac
+import lapfile
+import simulator
+from writer import BackgroundWriter
+
+
+def record(tmp_path, channels, tsv=False):
+    """ replay synthetic updates through a Recorder logging only channels, returning the lap files """
+    writer = BackgroundWriter()
+    writer.start()
+    source = ac.ACSource(ac.UpdateDecoder(ac.Recorder.required + channels))
+    source.event = ac.Handshake.fromData(simulator.ac_handshake())
+    recorder = ac.Recorder(source, channels, writer, tsv=tsv, root=str(tmp_path))
+    source.subscribe(recorder.update)
+    car = simulator.SyntheticCar(seed=1)
+    for _ in range(500):
+        car.update(1 / 333)
+        source.dispatch(simulator.ac_packet(car))
+    recorder.close()
+    writer.close()
+    return sorted(os.path.join(d, f) for d, _, files in os.walk(str(tmp_path)) for f in files if f.startswith('lap_'))
+
+
+def test_single_channel_lap(tmp_path):
+    laps = record(tmp_path, ['gas'])
+    lap = lapfile.read_lap(laps[0], mmap=False)
+    assert lap.dtype.names == ('gas',)
+    assert len(lap) > 1
+
+
+def test_single_channel_tsv_lap(tmp_path):
+    laps = record(tmp_path, ['gas'], tsv=True)
+    with open(laps[0]) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == 'gas'
+    assert len(lines) > 2
+    float(lines[1])
+
+
+def test_dropped_datagrams():
+    source = ac.ACSource()
+    car = simulator.SyntheticCar(seed=1)
+    # an update before the handshake, a datagram of no known size, then the handshake and an update
+    assert not source.dispatch(simulator.ac_packet(car))
+    assert not source.dispatch(b'\0' * 12)
+    assert not source.dispatch(simulator.ac_handshake())
+    assert source.dispatch(simulator.ac_packet(car))
+    assert (source.packets, source.updates, source.dropped) == (4, 1, 2)
@@ -0,0 +1,63 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+import archive
+import lapfile
+
+# 95.69522666931152 has no float32, and the integer columns must not come back as 255.0
+TSV = (b'lapTime\tspeed\tthrottle\tgear\tx\n'
+    b'0.0\t95.69522666931152\t255\t3\t-12.5\n'
+    b'0.016\t95.70001220703125\t254\t-1\tnan\n')
+
+
+def session(tmp_path, files):
+    path = tmp_path / '20201112T215006_Driver'
+    path.mkdir()
+    for name, data in files.items():
+        (path / name).write_bytes(data)
+    return str(path)
+
+
+def test_tsv_lap_round_trip(tmp_path):
+    path = session(tmp_path, {'lap_1.txt': TSV, 'laps.txt': b'lap\ttime\n1\t0.016\n'})
+    out = archive.compact(path, remove=True)
+    assert not os.path.exists(path)
+
+    with archive.Archive(out) as a:
+        assert a.members['lap_1.txt'].kind == archive.LAP
+        lap = a.read_lap('lap_1.txt')
+        assert a.read('laps.txt') == b'lap\ttime\n1\t0.016\n'
+    assert lap['speed'][0] == 95.69522666931152
+    assert lap.dtype['throttle'] == numpy.int64
+    assert archive.lap_bytes('lap_1.txt', lap) == TSV
+
+
+def test_tsv_lap_kept_as_text(tmp_path):
+    # a column of both integers and floats would write back as 1.0
+    text = b'lapTime\tgas\n0.0\t1\n0.5\t0.5\n'
+    out = archive.compact(session(tmp_path, {'lap_1.txt': text}))
+
+    with archive.Archive(out) as a:
+        assert a.members['lap_1.txt'].kind == archive.TEXT
+        assert a.read('lap_1.txt') == text
+        assert a.read_lap('lap_1.txt')['gas'].tolist() == [1.0, 0.5]
+        assert [e.name for e in a.laps()] == ['lap_1.txt']
+
+
+def test_binary_lap_round_trip(tmp_path):
+    cols = [('lapTime', 'f8'), ('speed', 'f4'), ('gear', 'i4')]
+    lap = numpy.zeros(100, dtype=lapfile.dtype(cols))
+    lap['lapTime'] = numpy.arange(100) / 60
+    lap['speed'] = numpy.linspace(0, 250, 100)
+    lap['gear'] = numpy.arange(100) // 20
+    data = lapfile.pack_header(cols) + lap.tobytes()
+    # a partial record left by an interrupted logger is not part of the lap
+    out = archive.compact(session(tmp_path, {'lap_1.bin': data + b'\0' * 5}))
+
+    with archive.Archive(out) as a:
+        entry = a.members['lap_1.bin']
+        assert (entry.rows, entry.last) == (100, 99 / 60)
+        assert archive.lap_bytes('lap_1.bin', a.read_lap('lap_1.bin')) == data
@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+import catalog
+import lapfile
+
+
+def write_lap(fname, seconds):
+    cols = lapfile.columns(['lapTime', 'speed_Mph'])
+    lap = numpy.zeros(10, dtype=lapfile.dtype(cols))
+    lap['lapTime'] = numpy.linspace(0, seconds, 10)
+    with open(fname, 'wb') as f:
+        f.write(lapfile.pack_header(cols) + lap.tobytes())
+
+
+def test_gt7_complete_laps(tmp_path):
+    session = tmp_path / 'log' / 'gt7' / '20260101T120000'
+    session.mkdir(parents=True)
+    for lap, seconds in [(0, 30.0), (1, 95.0), (2, 94.0)]:
+        write_lap(str(session / 'lap-{lap}.bin'.format(lap=lap)), seconds)
+
+    con = catalog.connect(str(tmp_path / 'catalog.db'))
+    catalog.update(con, str(tmp_path / 'log'))
+    # lap 2 is still being driven, as far as the catalog can tell
+    assert [(r['lap'], r['time']) for r in catalog.fastest(con, 'gt7')] == [(1, 95.0)]
+
+    write_lap(str(session / 'lap-3.bin'), 5.0)
+    catalog.update(con, str(tmp_path / 'log'))
+    assert [(r['lap'], r['time']) for r in catalog.fastest(con, 'gt7')] == [(2, 94.0), (1, 95.0)]
+    assert len(catalog.fastest(con, 'gt7', complete=False)) == 4
@@ -0,0 +1,77 @@
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gt7
+import simulator
+
+
+def sequence(ticks, depth=3):
+    """ push packets with the given ticks through a Sequencer, returning it and the ticks passed on """
+    out = []
+    s = gt7.Sequencer(lambda p: out.append(p.TICK), depth)
+    for tick in ticks:
+        s.push(SimpleNamespace(TICK=tick))
+    return s, out
+
+
+def counts(s):
+    return s.lost, s.late, s.duplicates, s.reordered
+
+
+def test_sequencer_in_order():
+    s, out = sequence(range(100, 110))
+    assert out == list(range(100, 110))
+    assert counts(s) == (0, 0, 0, 0)
+
+
+def test_sequencer_reordered_and_duplicates():
+    s, out = sequence([1, 3, 2, 2, 4, 4])
+    assert out == [1, 2, 3, 4]
+    assert counts(s) == (0, 0, 2, 1)
+
+
+def test_sequencer_lost_then_late():
+    # 2 is given up once 3 more packets wait behind it, then arrives anyway
+    s, out = sequence([1, 3, 4, 5, 6, 2, 7])
+    assert out == [1, 3, 4, 5, 6, 7]
+    assert counts(s) == (1, 1, 0, 0)
+
+
+def test_sequencer_flush():
+    s, out = sequence([1, 3, 5])
+    assert out == [1]
+    s.flush()
+    assert out == [1, 3, 5]
+    assert s.lost == 2
+
+
+def test_sequencer_resync():
+    s, out = sequence([1, 2, 5000, 5001])
+    assert out == [1, 2, 5000, 5001]
+    assert (s.resyncs, s.lost) == (1, 0)
+
+
+def test_salsa20_dec_many():
+    car = simulator.SyntheticCar(seed=1)
+    packets = []
+    for tick in range(20):
+        car.update(1 / 60)
+        packets.append(simulator.gt7_packet(car, tick, seed=tick * 7919))
+    # a packet that does not decrypt to the magic number, and a short one
+    packets[3] = bytes(gt7.PACKET_SIZE)
+    packets[7] = packets[7][:100]
+
+    ddata, valid = gt7.salsa20_dec_many(packets)
+    assert valid.tolist() == [i not in (3, 7) for i in range(20)]
+    assert len(gt7.salsa20_dec(packets[3])) == 0
+    expected = [bytes(gt7.salsa20_dec(p)) for p, ok in zip(packets, valid) if ok]
+    assert [row.tobytes() for row in ddata] == expected
+
+
+def test_salsa20_dec_many_nothing_valid():
+    ddata, valid = gt7.salsa20_dec_many([b'\0' * 10, bytes(gt7.PACKET_SIZE)])
+    assert ddata.shape == (0, gt7.PACKET_SIZE)
+    assert not valid.any()
@@ -0,0 +1,35 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+from trackline import TrackLine
+
+RADIUS = 300.0
+LENGTH = 2 * numpy.pi * RADIUS
+
+
+def circle(distance):
+    """ x, y, z of points at the given distances round a circular track """
+    a = distance / RADIUS
+    return RADIUS * numpy.sin(a), numpy.zeros(len(a)), RADIUS - RADIUS * numpy.cos(a)
+
+
+def test_lap_distance_uneven_sampling():
+    line = TrackLine(*circle(numpy.linspace(0, LENGTH, 2000)))
+    # from just before the line to just after it, the first half of the samples
+    # covering 60% of the lap, as a car slow on one half and fast on the other
+    distance = numpy.concatenate([
+        numpy.linspace(-5, 0.6 * LENGTH, 1000, endpoint=False),
+        numpy.linspace(0.6 * LENGTH, LENGTH + 5, 1000)])
+    position = line.lap_distance(*circle(distance))
+    assert numpy.abs(position - distance).max() < 0.5
+
+
+def test_lap_distance_starting_after_the_line():
+    line = TrackLine(*circle(numpy.linspace(0, LENGTH, 2000)))
+    distance = numpy.linspace(3, LENGTH - 3, 500) ** 1.5 / LENGTH ** 0.5
+    position = line.lap_distance(*circle(distance))
+    assert numpy.abs(position - distance).max() < 0.5
+    assert (numpy.diff(position) >= 0).all()
@@ -0,0 +1,132 @@
+"""
+Positions along a reference lap's path
+
+A TrackLine is the polyline driven on a reference lap, with its points
+bucketed into a uniform grid of square cells in the x/z (ground) plane, so
+the nearest point of the line to any sample is found by searching the 3x3
+block of cells around it rather than the whole line.  Projecting every sample
+of another lap onto the line gives its true position along the track, so laps
+on different racing lines can be compared at the same place on the track.
+
+    line = TrackLine(ref['x'], ref['y'], ref['z'])
+    position = line.lap_distance(x, y, z)
+"""
+
+import numpy
+
+
+class TrackLine:
+
+    def __init__(self, x, y, z, cell=10.0):
+        self.points = numpy.column_stack([x, y, z]).astype(numpy.float64)
+        self.cell = cell
+
+        # path distance at each point, and the length of the segment from it to the next
+        self.segments = numpy.linalg.norm(numpy.diff(self.points, axis=0), axis=1)
+        self.distance = numpy.zeros(len(self.points))
+        numpy.cumsum(self.segments, out=self.distance[1:])
+        self.length = self.distance[-1]
+
+        # cells are numbered from 0, with a border of empty cells all round so that
+        # the neighbours of every cell have their own keys
+        self.origin = numpy.array([self.points[:, 0].min(), self.points[:, 2].min()])
+        cx, cz = self.cells(self.points[:, 0], self.points[:, 2])
+        self.shape = (cx.max() + 3, cz.max() + 3)
+
+        keys = self.key(cx, cz)
+        self.order = numpy.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def cells(self, x, z):
+        cx = numpy.floor((numpy.asarray(x) - self.origin[0]) / self.cell).astype(numpy.int64)
+        cz = numpy.floor((numpy.asarray(z) - self.origin[1]) / self.cell).astype(numpy.int64)
+        return cx, cz
+
+    def key(self, cx, cz):
+        return (cx + 1) * self.shape[1] + (cz + 1)
+
+    def nearest(self, x, y, z):
+        """ index of the nearest point of the line to each of the given points """
+
+        q = numpy.column_stack([x, y, z]).astype(numpy.float64)
+        cx, cz = self.cells(x, z)
+        # anything off the grid looks in the border, and finds nothing close
+        numpy.clip(cx, -1, self.shape[0] - 2, out=cx)
+        numpy.clip(cz, -1, self.shape[1] - 2, out=cz)
+
+        best = numpy.zeros(len(q), dtype=numpy.int64)
+        best_d = numpy.full(len(q), numpy.inf)
+
+        for dx in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                key = self.key(cx + dx, cz + dz)
+                start = numpy.searchsorted(self.keys, key, side='left')
+                count = numpy.searchsorted(self.keys, key, side='right') - start
+                # the j'th point of every cell at once
+                for j in range(count.max(initial=0)):
+                    m = numpy.flatnonzero(count > j)
+                    idx = self.order[start[m] + j]
+                    d = numpy.square(self.points[idx] - q[m]).sum(axis=1)
+                    closer = d < best_d[m]
+                    best[m[closer]] = idx[closer]
+                    best_d[m[closer]] = d[closer]
+
+        # anything within a cell of a point is in the 3x3 block around it, so only
+        # points further than that from all of those might have missed a closer one
+        far = numpy.flatnonzero(best_d > self.cell * self.cell)
+        for chunk in numpy.array_split(far, max(1, len(far) // 256)):
+            if len(chunk):
+                d = numpy.square(q[chunk, None, :] - self.points[None, :, :]).sum(axis=2)
+                best[chunk] = d.argmin(axis=1)
+
+        return best
+
+    def project(self, x, y, z):
+        """ distance along the line of the closest point on it to each of the given points """
+
+        q = numpy.column_stack([x, y, z]).astype(numpy.float64)
+        i = self.nearest(x, y, z)
+        last = len(self.segments) - 1
+
+        position = None
+        best_d = None
+        # the closest point is on one of the segments either side of the nearest point
+        for seg in (numpy.clip(i - 1, 0, last), numpy.clip(i, 0, last)):
+            p0 = self.points[seg]
+            v = self.points[seg + 1] - p0
+            vv = numpy.square(v).sum(axis=1)
+            t = numpy.divide(((q - p0) * v).sum(axis=1), vv, out=numpy.zeros(len(q)), where=vv > 0)
+            numpy.clip(t, 0, 1, out=t)
+            d = numpy.square(p0 + v * t[:, None] - q).sum(axis=1)
+            s = self.distance[seg] + t * self.segments[seg]
+            if position is None:
+                position, best_d = s, d
+            else:
+                closer = d < best_d
+                position[closer] = s[closer]
+
+        return position
+
+    def lap_distance(self, x, y, z):
+        """
+        project() for the samples of a whole lap, in order, unwrapped across the
+        start line and never decreasing, for use as the lap's distance
+        """
+
+        position = self.project(x, y, z)
+        if not len(position):
+            return position
+        half = self.length / 2
+
+        # consecutive samples are close together on the track, so a jump of more than
+        # half a lap between them is crossing the line, whatever the spacing of the samples
+        step = numpy.diff(position)
+        wraps = numpy.zeros(len(position))
+        numpy.cumsum((step < -half) * self.length - (step > half) * self.length, out=wraps[1:])
+        position = position + wraps
+
+        # a lap starting just before the line starts at a small negative distance
+        if position[0] > half:
+            position = position - self.length
+
+        return numpy.maximum.accumulate(position)
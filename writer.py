@@ -0,0 +1,145 @@
+"""
+Background lap file writer
+
+Keeps file I/O off the thread that drains the telemetry feed.  Writes are
+queued as bytes and a single writer thread batches them into the files,
+flushing once `flush_bytes` are buffered or `flush_interval` seconds have
+passed, and optionally fsyncing each file as it is closed (a lap boundary).
+"""
+
+import os
+import threading
+import time
+from queue import Queue, Empty
+import metrics
+
+OPEN, WRITE, FLUSH, CLOSE, STOP = range(5)
+
+
+class WriterFile:
+    """ binary file-like handle whose writes are queued to a BackgroundWriter """
+
+    def __init__(self, writer, name, mode='wb'):
+        self.writer = writer
+        self.name = name
+        self.mode = mode
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        self.writer.put(WRITE, self, data)
+        return len(data)
+
+    def flush(self):
+        if not self.closed:
+            self.writer.put(FLUSH, self)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.put(CLOSE, self)
+
+
+class BackgroundWriter(threading.Thread):
+
+    def __init__(self, flush_interval=1.0, flush_bytes=64 * 1024, fsync=False):
+        super(BackgroundWriter, self).__init__()
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.fsync = fsync
+        self.ops = Queue()
+        self.error = None
+
+        # only the producer updates queued_bytes and only the writer
+        # updates written_bytes, so neither needs a lock
+        self.queued_bytes = 0
+        self.written_bytes = 0
+        self.lag = 0
+
+        metrics.gauge('writer_queue_depth', 'operations queued for the background writer', fn=self.ops.qsize)
+        metrics.gauge('writer_pending_bytes', 'bytes queued but not yet written', fn=self.pending)
+        metrics.gauge('writer_lag_seconds', 'how long the last operation written waited in the queue',
+            fn=lambda: self.lag)
+        metrics.counter('writer_written_bytes_total', 'bytes handed to the OS', fn=lambda: self.written_bytes)
+
+    def open(self, fname, mode='wb'):
+        f = WriterFile(self, fname, mode)
+        self.put(OPEN, f)
+        return f
+
+    def put(self, op, f=None, data=b''):
+        self.queued_bytes = self.queued_bytes + len(data)
+        self.ops.put((op, f, data, time.monotonic()))
+
+    def pending(self):
+        """ bytes queued but not yet handed to the OS """
+        return self.queued_bytes - self.written_bytes
+
+    def status(self):
+        return '{pending} bytes pending, {lag:.3f}s behind'.format(pending=self.pending(), lag=self.lag)
+
+    def run(self):
+
+        files = {}
+        unflushed = 0
+        last_flush = time.monotonic()
+        running = True
+
+        while running:
+
+            batch = []
+            try:
+                batch.append(self.ops.get(timeout=self.flush_interval))
+                # take everything else that is already waiting
+                while True:
+                    batch.append(self.ops.get_nowait())
+            except Empty:
+                pass
+
+            for op, f, data, queued in batch:
+                try:
+                    if op == OPEN:
+                        files[f] = open(f.name, mode=f.mode, buffering=self.flush_bytes)
+
+                    elif op == WRITE:
+                        files[f].write(data)
+                        unflushed = unflushed + len(data)
+                        self.written_bytes = self.written_bytes + len(data)
+
+                    elif op == FLUSH:
+                        files[f].flush()
+
+                    elif op == CLOSE:
+                        out = files.pop(f)
+                        out.flush()
+                        if self.fsync:
+                            os.fsync(out.fileno())
+                        out.close()
+
+                    elif op == STOP:
+                        running = False
+
+                except (OSError, KeyError) as e:
+                    self.error = e
+                    print('writer: {name}: {e}'.format(name=f.name if f else '', e=e))
+
+                self.lag = time.monotonic() - queued
+
+            now = time.monotonic()
+            if unflushed >= self.flush_bytes or now - last_flush >= self.flush_interval:
+                for out in files.values():
+                    out.flush()
+                unflushed = 0
+                last_flush = now
+
+            if self.ops.empty():
+                self.lag = 0
+
+        for out in files.values():
+            out.close()
+
+    def close(self):
+        """ write out everything queued and stop the thread """
+        self.put(STOP)
+        self.join()